@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import logging
+import datetime
+
+from Metrics import Metrics
+
+
+class AdmissionControl:
+    """bounds the snippet task backlog, shedding stale and excess tasks during bursts
+
+    new tasks are dropped when their footage is older than max_age_sec (it may have rotated out
+    by the time a worker gets to it) and merged into a waiting or running task with the same output.
+    waiting tasks go stale the same way, and past max_pending the tasks ranked first by the
+    shedding policy are dropped. every dropped task or message is appended to dropped_file as a
+    json line so it can be backfilled later.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    policies = ('oldest', 'priority', 'boxless')
+
+    def __init__(self, max_pending=1000, max_age_sec=3600, policy=('boxless', 'priority', 'oldest'),
+                 dropped_file='/skailogs/snpm_dropped.jsonl') -> None:
+        """
+        Args:
+            max_pending (int): max tasks waiting for a worker. <= 0 is unbounded
+            max_age_sec (float): tasks ending longer ago than this are dropped. <= 0 never goes stale
+            policy (tuple): policies ranking which waiting tasks are dropped first, by decreasing weight.
+                oldest: earliest end time. priority: lowest priority. boxless: tasks without boxes to draw
+            dropped_file (str): json lines record of dropped tasks / messages. None doesn't record
+        """
+        for name in policy:
+            if name not in self.policies:
+                printmsg = f'unknown shedding policy {name}. choices are {self.policies}'
+                self.error_logger.error(printmsg)
+                raise Exception(printmsg)
+        self.max_pending = max_pending
+        self.max_age = datetime.timedelta(seconds=max_age_sec) if max_age_sec > 0 else None
+        self.policy = tuple(policy)
+        self.dropped_file = dropped_file
+
+    def is_stale(self, task, now) -> bool:
+        return self.max_age is not None and task.end_time < now - self.max_age
+
+    def get_drop_rank(self, task) -> tuple:
+        """sort key of task under the shedding policy. lowest is dropped first"""
+        rank = []
+        for name in self.policy:
+            if name == 'oldest':
+                rank.append(task.end_time)
+            elif name == 'priority':
+                rank.append(task.priority)
+            elif name == 'boxless':
+                rank.append(len(task.bboxes) > 0)
+        return tuple(rank)
+
+    def admit(self, tasks, queued_tasks, now) -> list:
+        """filters new tasks before they are scheduled
+
+        Args:
+            tasks (list): new SnippetGenerator.Task list
+            queued_tasks (iterable): tasks already waiting, parked or running
+            now (datetime): current utc time
+
+        Returns:
+            admitted (list): tasks to schedule. the rest were dropped and recorded
+        """
+        queued_outputs = {str(t) for t in queued_tasks}
+        admitted = []
+        for task in tasks:
+            if self.is_stale(task, now):
+                self.record_task(task, 'stale')
+            elif str(task) in queued_outputs:
+                # same event sent again. the queued task writes the same files
+                self.logger.info(f'merged duplicate task {task} into the queued one')
+                Metrics.inc('snpm_dropped_total', reason='duplicate')
+            else:
+                queued_outputs.add(str(task))
+                admitted.append(task)
+        return admitted
+
+    def shed(self, scheduler, get_camera, now) -> list:
+        """drops stale waiting tasks and the lowest ranked ones past max_pending
+
+        Args:
+            scheduler (FairTaskScheduler): waiting tasks
+            get_camera (callable): camera key of a task, as pushed to the scheduler
+            now (datetime): current utc time
+
+        Returns:
+            dropped (list): dropped tasks
+        """
+        dropped = []
+        if self.max_age is None and (self.max_pending <= 0 or len(scheduler) <= self.max_pending):
+            return dropped
+        waiting = scheduler.get_tasks()
+        for task in waiting:
+            if self.is_stale(task, now):
+                dropped.append((task, 'stale'))
+        excess = len(waiting) - len(dropped) - self.max_pending
+        if self.max_pending > 0 and excess > 0:
+            stale = {id(task) for task, _reason in dropped}
+            ranked = sorted((t for t in waiting if id(t) not in stale), key=self.get_drop_rank)
+            dropped.extend((task, 'backlog') for task in ranked[:excess])
+
+        for task, reason in dropped:
+            scheduler.remove(task, get_camera(task))
+            self.record_task(task, reason)
+        if len(dropped) > 0:
+            printmsg = f'shed {len(dropped)} tasks. waiting tasks: {len(scheduler)}'
+            self.logger.warning(printmsg)
+            self.error_logger.warning(printmsg)
+        return [task for task, _reason in dropped]
+
+    def record_task(self, task, reason) -> None:
+        self.logger.warning(f'dropping task {task}: {reason}')
+        self.record(self.dropped_file, reason, output_file=str(task), cam_folder=task.cam_folder,
+                    start_time=task.start_time.isoformat(), end_time=task.end_time.isoformat(),
+                    event_type=task.event_type, priority=task.priority, boxes=len(task.bboxes))
+
+    @classmethod
+    def record(cls, dropped_file, reason, **fields) -> None:
+        """appends a dropped task / message record. safe to call from other processes (e.g. the listener)"""
+        Metrics.inc('snpm_dropped_total', reason=reason)
+        if dropped_file is None:
+            return
+        line = json.dumps({'dropped_at': time.time(), 'reason': reason, **fields}, default=str)
+        try:
+            with open(dropped_file, 'a') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            printmsg = f'could not record dropped {fields}: {e}'
+            cls.logger.error(printmsg)
+            cls.error_logger.error(printmsg)
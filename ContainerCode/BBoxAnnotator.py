@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import math
+import logging
+
+import numpy as np
+import cv2
+
+from SegmentIndex import SegmentIndex
+from Metrics import Metrics
+
+
+class BBoxAnnotator:
+    """draws protobuf bboxes on a stream of frames, interpolating in between box updates with trackers
+
+    frames are fed in order by frame index, so the same annotator works on frames read back
+    from a written snippet or straight from the decoded camera segments. box updates are mapped
+    to frame indexes once up front (see DrawSchedule).
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    tracker_types = ['BOOSTING', 'MIL', 'KCF', 'TLD', 'MEDIANFLOW', 'GOTURN', 'MOSSE', 'CSRT']
+    tracker_type = 'BOOSTING'  # tracker used for interpolation
+    tracking_max_side = 640  # automatic tracking scale keeps the long frame side at most this many pixels
+
+    # rectangle settings
+    primary_object_color = (0, 255, 0)  # bgr. draw in green
+    thickness = 2
+
+    class DrawSchedule:
+        """box update timeline mapped once to the frame indexes of a constant frame rate snippet
+
+        frame k is at start_time + k / fps. an update is drawn on the first frame at or after its timestamp.
+        timestamps are int64 ns relative to start_time, so the per frame work is array lookups.
+        """
+
+        def __init__(self, boxes_to_draw, start_time, end_time, fps) -> None:
+            """
+            Args:
+                boxes_to_draw (BoxStore): box updates to draw
+                start_time (datetime): utc time of frame 0
+                end_time (datetime): utc time after the last frame
+                fps (float): frames per second
+            """
+            self.start_ns = SegmentIndex.datetime_to_ns(start_time)
+            self.fps = fps
+            self.frame_count = int(math.ceil((end_time - start_time).total_seconds() * fps)) + 1
+            self.frame_ns = (np.arange(self.frame_count, dtype=np.float64) * (1e9 / fps)).astype(np.int64)
+            self.update_ns = boxes_to_draw.ts - self.start_ns
+            self.update_frames = np.searchsorted(self.frame_ns, self.update_ns, side='left')
+            # updates landing on frame k are bounds[k] to bounds[k + 1] (update_frames is sorted like the updates)
+            self.bounds = np.searchsorted(self.update_frames, np.arange(self.frame_count + 1), side='left').tolist()
+
+        def get_updates(self, k) -> range:
+            """indexes of the box updates landing on frame k"""
+            if k < 0 or k >= self.frame_count:
+                return range(0)
+            return range(self.bounds[k], self.bounds[k + 1])
+
+    @classmethod
+    def create_tracker(cls, tracker_type=None):
+        if tracker_type is None:
+            tracker_type = 'BOOSTING'  # 'KCF'
+        elif tracker_type not in cls.tracker_types:
+            printmsg = f'{tracker_type} not in tracker types {cls.tracker_types}'
+            cls.logger.error(printmsg)
+            cls.error_logger.error(printmsg)
+
+        if tracker_type == 'BOOSTING':
+            return cv2.legacy.TrackerBoosting_create()
+        elif tracker_type == 'MIL':
+            return cv2.TrackerMIL_create()
+        elif tracker_type == 'KCF':
+            return cv2.TrackerKCF_create()
+        elif tracker_type == 'TLD':
+            return cv2.legacy.TrackerTLD_create()
+        elif tracker_type == 'MEDIANFLOW':
+            return cv2.legacy.TrackerMedianFlow_create()
+        elif tracker_type == 'GOTURN':
+            return cv2.TrackerGOTURN_create()
+        elif tracker_type == 'MOSSE':
+            return cv2.legacy.TrackerMOSSE_create()
+        elif tracker_type == "CSRT":
+            return cv2.TrackerCSRT_create()
+
+    def __init__(self, boxes_to_draw, frame_w, frame_h, start_time, end_time, fps, interpolate=True,
+                 flip_bbox_xy=False, tracking_scale=0.0) -> None:
+        """
+        Args:
+            boxes_to_draw (BoxStore): box updates to draw
+            frame_w (int): frame width in pixels
+            frame_h (int): frame height in pixels
+            start_time (datetime): utc time of frame 0
+            end_time (datetime): utc time after the last frame
+            fps (float): frames per second of the frames fed to annotate
+            interpolate (bool): track boxes in between box updates
+            flip_bbox_xy (bool): boxes have x / y swapped
+            tracking_scale (float): frame scale trackers run at. boxes are scaled back before drawing.
+                0 picks it from the frame size (see get_tracking_scale)
+        """
+        self.boxes_to_draw = boxes_to_draw
+        self.schedule = self.DrawSchedule(boxes_to_draw, start_time, end_time, fps)
+        self.frame_w = frame_w
+        self.frame_h = frame_h
+        self.interpolate = interpolate
+        self.flip_bbox_xy = flip_bbox_xy
+        self.tracked_boxes = {}
+
+        # trackers run on a smaller copy of each frame so their cost doesn't grow with resolution
+        self.tracking_scale = self.get_tracking_scale(frame_w, frame_h, tracking_scale)
+        self.tracking_size = (max(int(round(frame_w * self.tracking_scale)), 1),
+                              max(int(round(frame_h * self.tracking_scale)), 1))
+        self.tracking_buffer = None  # resized frame reused between frames
+        if interpolate:
+            self.logger.debug(f'tracking at {self.tracking_size[0]} x {self.tracking_size[1]}')
+
+    @classmethod
+    def get_tracking_scale(cls, frame_w, frame_h, tracking_scale=0.0) -> float:
+        """frame scale trackers run at. tracking_scale if > 0 else scaled down to tracking_max_side"""
+        if tracking_scale > 0:
+            return min(tracking_scale, 1.0)
+        return min(1.0, cls.tracking_max_side / max(frame_w, frame_h, 1))
+
+    def get_tracking_frame(self, frame):
+        """downscaled copy of frame for the trackers. frame itself at full scale"""
+        if self.tracking_scale >= 1.0:
+            return frame
+        self.tracking_buffer = cv2.resize(frame, self.tracking_size, dst=self.tracking_buffer,
+                                          interpolation=cv2.INTER_AREA)
+        return self.tracking_buffer
+
+    def get_box_pixels(self, box):
+        """gets (top, left, bottom, right) pixels of (top, left, bottom, right) box in fractions of the frame size"""
+        frame_w, frame_h = self.frame_w, self.frame_h
+        box_top, box_left, box_bottom, box_right = box
+        if self.flip_bbox_xy:
+            left = int(box_top * frame_w)
+            right = int(box_bottom * frame_w)
+            top = int(box_left * frame_h)
+            bottom = int(box_right * frame_h)
+            # shift down by height
+            bbox_h = bottom - top
+            top += bbox_h
+            bottom += bbox_h
+        else:
+            top, bottom = int(box_top * frame_h), int(box_bottom * frame_h)
+            left, right = int(box_left * frame_w), int(box_right * frame_w)
+        return top, left, bottom, right
+
+    def annotate(self, frame, k) -> bool:
+        """draws boxes on frame in place
+
+        Args:
+            frame (np.ndarray): hxwxn frame
+            k (int): frame index. frame 0 is at start_time
+
+        Returns:
+            drew_new_box (bool): True if protobuf boxes (not interpolated ones) were drawn on this frame
+        """
+        updates = self.schedule.get_updates(k)
+
+        #### draw protobuf boxes of the updates landing on this frame ####
+        drew_new_box = False
+        tracking_frame = None
+        if self.interpolate and (len(updates) > 0 or len(self.tracked_boxes) > 0):
+            tracking_frame = self.get_tracking_frame(frame)
+        scale = self.tracking_scale
+
+        if len(updates) > 0:
+            # more updates than frames: the last one landing on the frame is drawn and re-inits the trackers
+            global_ids, tlbr = self.boxes_to_draw.get_update(updates[-1])
+            for global_id, box in zip(global_ids.tolist(), tlbr.tolist()):
+                top, left, bottom, right = self.get_box_pixels(box)
+                self.logger.debug(f'rectangles frame: {k}')
+                self.logger.debug(f'drawing rectangle(tlbr pixels): {top}, {left}, {bottom}, {right} on frame...')
+                cv2.rectangle(frame, (left, top), (right, bottom), self.primary_object_color, self.thickness)
+                self.logger.debug('rectangle draw success!')
+                drew_new_box = True
+
+                # init tracker on bbox if interpolating
+                if self.interpolate:
+                    # init tracker with bbox pixels of the tracking frame
+                    x, y = int(left * scale), int(top * scale)
+                    w, h = max(int((right - left) * scale), 1), max(int((bottom - top) * scale), 1)
+                    self.tracked_boxes[global_id] = self.create_tracker(self.tracker_type)
+                    init_bbox = [x, y, w, h]
+                    self.logger.debug(f'init-ing tracker with bbox(x,y,w,h): {init_bbox}')
+                    self.tracked_boxes[global_id].init(tracking_frame, init_bbox)
+
+        #### otherwise use template matching to interpolate bboxes ####
+        elif self.interpolate:
+            for global_id in self.tracked_boxes:
+                with Metrics.timer('snpm_tracker_update_seconds', buckets=Metrics.fast_seconds_buckets):
+                    success, bbox = self.tracked_boxes[global_id].update(tracking_frame)
+                if success:
+                    # back to full resolution pixels
+                    (x, y, w, h) = [int(v / scale) for v in bbox]
+                    cv2.rectangle(frame, (x, y), (x + w, y + h), self.primary_object_color, self.thickness)
+                else:
+                    printmsg = f'error in tracker'
+                    self.logger.error(printmsg)
+                    self.error_logger.error(printmsg)
+
+        return drew_new_box
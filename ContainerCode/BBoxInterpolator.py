@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import logging
+
+import numpy as np
+import cv2
+
+from BBoxAnnotator import BBoxAnnotator
+
+
+class BBoxInterpolator:
+    """draws protobuf bboxes on a stream of frames, moving them between box updates without trackers
+
+    the box of every object is precomputed for every frame of the snippet up front, with numpy,
+    by linear or spline (catmull-rom) interpolation between the object's box updates. drawing a
+    frame is then an array lookup per object. same annotate interface as BBoxAnnotator.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    methods = ('linear', 'spline', 'tracker')  # tracker runs an opencv tracker per object (BBoxAnnotator)
+    hold_ns = 1 * 10**9  # boxes stay drawn this long after an object's last update
+    max_gap_ns = 10 * 10**9  # updates of an object further apart than this are not interpolated between
+
+    # rectangle settings
+    primary_object_color = BBoxAnnotator.primary_object_color
+    thickness = BBoxAnnotator.thickness
+
+    @classmethod
+    def create_annotator(cls, method, boxes_to_draw, frame_w, frame_h, start_time, end_time, fps,
+                         interpolate=True, flip_bbox_xy=False, tracking_scale=0.0):
+        """creates the annotator for interpolation method (one of methods)
+
+        Args:
+            start_time (datetime): utc time of the first frame
+            end_time (datetime): utc time after the last frame
+            fps (float): frames per second of the frames fed to annotate
+            tracking_scale (float): tracker method only. see BBoxAnnotator
+        """
+        if method not in cls.methods:
+            printmsg = f'unknown interpolation method {method}. choices are {cls.methods}'
+            cls.error_logger.error(printmsg)
+            raise Exception(printmsg)
+        if method == 'tracker':
+            return BBoxAnnotator(boxes_to_draw, frame_w, frame_h, start_time, end_time, fps, interpolate=interpolate,
+                                 flip_bbox_xy=flip_bbox_xy, tracking_scale=tracking_scale)
+        return cls(boxes_to_draw, frame_w, frame_h, start_time, end_time, fps, method=method,
+                   interpolate=interpolate, flip_bbox_xy=flip_bbox_xy)
+
+    def __init__(self, boxes_to_draw, frame_w, frame_h, start_time, end_time, fps, method='linear',
+                 interpolate=True, flip_bbox_xy=False) -> None:
+        """
+        Args:
+            boxes_to_draw (BoxStore): box updates to draw
+            frame_w (int): frame width in pixels
+            frame_h (int): frame height in pixels
+            start_time (datetime): utc time of the first frame
+            end_time (datetime): utc time after the last frame
+            fps (float): frames per second of the frames fed to annotate
+            method (str): 'linear' or 'spline'
+            interpolate (bool): draw boxes in between box updates
+            flip_bbox_xy (bool): boxes have x / y swapped
+        """
+        self.frame_w = frame_w
+        self.frame_h = frame_h
+        self.method = method
+        self.interpolate = interpolate
+        self.flip_bbox_xy = flip_bbox_xy
+
+        # frame grid the boxes are precomputed on and the protobuf updates landing on each frame
+        self.schedule = BBoxAnnotator.DrawSchedule(boxes_to_draw, start_time, end_time, fps)
+        self.offsets = boxes_to_draw.offsets
+        tlbr = boxes_to_draw.tlbr.astype(np.float64)
+        self.pixels = self.to_pixels(tlbr)  # protobuf boxes as is. rows of update i are offsets[i] to offsets[i + 1]
+
+        # box update times / positions per object. the store is time ordered so each object's keys are too
+        self.tracks = []  # (first frame, pixels (n, 4) int32 tlbr, visible (n,) bool)
+        if interpolate:
+            box_t = boxes_to_draw.box_ts - self.schedule.start_ns
+            global_ids = boxes_to_draw.global_ids
+            for global_id in np.unique(global_ids):
+                mask = global_ids == global_id
+                track = self.create_track(self.schedule.frame_ns, box_t[mask], tlbr[mask])
+                if track is not None:
+                    self.tracks.append(track)
+        self.logger.debug(f'precomputed {method} boxes of {len(self.tracks)} objects on '
+                          f'{self.schedule.frame_count} frames')
+
+    @classmethod
+    def interpolate_keys(cls, key_t, key_p, t, method='linear'):
+        """interpolates box positions at times t from key positions
+
+        Args:
+            key_t (np.ndarray): (n,) increasing int64 key times (ns)
+            key_p (np.ndarray): (n, 4) key positions
+            t (np.ndarray): (m,) int64 times (ns) in key_t[0] to key_t[-1]
+            method (str): 'linear' or 'spline'
+
+        Returns:
+            p (np.ndarray): (m, 4) positions
+        """
+        if len(key_t) == 1:
+            return np.repeat(key_p, len(t), axis=0)
+        seg = np.clip(np.searchsorted(key_t, t, side='right') - 1, 0, len(key_t) - 2)
+        t0 = key_t[seg]
+        h = (key_t[seg + 1] - t0).astype(np.float64)[:, None]
+        s = (t - t0).astype(np.float64)[:, None] / h
+        p0, p1 = key_p[seg], key_p[seg + 1]
+        if method == 'linear':
+            return p0 + (p1 - p0) * s
+
+        # cubic hermite with catmull-rom tangents for uneven key spacing
+        m = np.empty_like(key_p)
+        m[1:-1] = (key_p[2:] - key_p[:-2]) / (key_t[2:] - key_t[:-2]).astype(np.float64)[:, None]
+        m[0] = (key_p[1] - key_p[0]) / (key_t[1] - key_t[0])
+        m[-1] = (key_p[-1] - key_p[-2]) / (key_t[-1] - key_t[-2])
+        s2 = s * s
+        s3 = s2 * s
+        return ((2 * s3 - 3 * s2 + 1) * p0 + (s3 - 2 * s2 + s) * h * m[seg]
+                + (-2 * s3 + 3 * s2) * p1 + (s3 - s2) * h * m[seg + 1])
+
+    def create_track(self, frame_t, key_t, key_p):
+        """precomputes pixel boxes of one object on the frames from its first update to hold_ns after its last
+
+        Args:
+            frame_t (np.ndarray): int64 frame times (ns)
+            key_t (np.ndarray): int64 update times (ns) of the object
+            key_p (np.ndarray): (n, 4) tlbr of the object per update
+
+        Returns:
+            (first_frame, pixels, visible) or None if the object has no frames in the snippet
+        """
+        # one key per time. later updates at the same time win
+        keep = np.append(key_t[1:] != key_t[:-1], True)
+        key_t, key_p = key_t[keep], key_p[keep]
+
+        first_frame = int(np.searchsorted(frame_t, key_t[0], side='left'))
+        last_frame = int(np.searchsorted(frame_t, key_t[-1] + self.hold_ns, side='right'))
+        if first_frame >= last_frame:
+            return None
+        t = frame_t[first_frame:last_frame]
+
+        inside = t <= key_t[-1]
+        p = np.repeat(key_p[-1:], len(t), axis=0)  # hold after the last update
+        p[inside] = self.interpolate_keys(key_t, key_p, t[inside], self.method)
+
+        # objects gone for longer than max_gap_ns are held for hold_ns, then hidden until their next update
+        seg = np.clip(np.searchsorted(key_t, t, side='right') - 1, 0, len(key_t) - 1)
+        gap = np.diff(key_t, append=np.iinfo(np.int64).max)[seg]
+        long_gap = inside & (gap > self.max_gap_ns)
+        p[long_gap] = key_p[seg[long_gap]]
+        visible = ~long_gap | (t - key_t[seg] <= self.hold_ns)
+        return first_frame, self.to_pixels(p), visible
+
+    def to_pixels(self, p):
+        """vectorized BBoxAnnotator.get_box_pixels. (n, 4) tlbr floats to (n, 4) int32 tlbr pixels"""
+        frame_w, frame_h = self.frame_w, self.frame_h
+        top, left, bottom, right = p[:, 0], p[:, 1], p[:, 2], p[:, 3]
+        if self.flip_bbox_xy:
+            px_left = (top * frame_w).astype(np.int32)
+            px_right = (bottom * frame_w).astype(np.int32)
+            px_top = (left * frame_h).astype(np.int32)
+            px_bottom = (right * frame_h).astype(np.int32)
+            # shift down by height
+            bbox_h = px_bottom - px_top
+            px_top, px_bottom = px_top + bbox_h, px_bottom + bbox_h
+        else:
+            px_top, px_bottom = (top * frame_h).astype(np.int32), (bottom * frame_h).astype(np.int32)
+            px_left, px_right = (left * frame_w).astype(np.int32), (right * frame_w).astype(np.int32)
+        return np.stack([px_top, px_left, px_bottom, px_right], axis=1)
+
+    def draw(self, frame, pixels) -> None:
+        for top, left, bottom, right in pixels.tolist():
+            cv2.rectangle(frame, (left, top), (right, bottom), self.primary_object_color, self.thickness)
+
+    def annotate(self, frame, k) -> bool:
+        """draws boxes on frame in place
+
+        Args:
+            frame (np.ndarray): hxwxn frame
+            k (int): frame index. frame 0 is at start_time
+
+        Returns:
+            drew_new_box (bool): True if protobuf boxes (not interpolated ones) were drawn on this frame
+        """
+        updates = self.schedule.get_updates(k)
+        update = updates[-1] if len(updates) > 0 else None  # the last update landing on the frame wins
+        update_box_count = 0 if update is None else self.offsets[update + 1] - self.offsets[update]
+
+        if not self.interpolate:
+            if update is None:
+                return False
+            self.draw(frame, self.pixels[self.offsets[update]:self.offsets[update + 1]])
+            return update_box_count > 0
+
+        for first_frame, pixels, visible in self.tracks:
+            i = k - first_frame
+            if 0 <= i < len(pixels) and visible[i]:
+                self.draw(frame, pixels[i:i + 1])
+        return update_box_count > 0
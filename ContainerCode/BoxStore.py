@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from SegmentIndex import SegmentIndex
+
+
+class BoxStore:
+    """columnar store of the box updates (protobuf tr_boxes) of one camera time range
+
+    built once from the protobuf message, then handed to the worker processes and the drawing code.
+    numpy arrays pickle as flat buffers and are read without going through protobuf attributes.
+    boxes of update i are rows offsets[i] to offsets[i + 1] of global_ids / tlbr.
+    """
+
+    def __init__(self, ts, offsets, global_ids, tlbr) -> None:
+        """
+        Args:
+            ts (np.ndarray): (n,) int64 sorted update times. ns since SegmentIndex.epoch in utc
+            offsets (np.ndarray): (n + 1,) int64 first box row of each update, then the total box count
+            global_ids (np.ndarray): (m,) int32 global id per box
+            tlbr (np.ndarray): (m, 4) float32 top, left, bottom, right per box. fractions of the frame size
+        """
+        self.ts = ts
+        self.offsets = offsets
+        self.global_ids = global_ids
+        self.tlbr = tlbr
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                   np.zeros((0, 4), dtype=np.float32))
+
+    @classmethod
+    def from_tr_boxes(cls, tr_boxes, convert_ts):
+        """
+        Args:
+            tr_boxes: protobuf TimeRangeBBoxes repeated field (timestamp, bboxes of GlobalBBox)
+            convert_ts (callable): protobuf timestamp to utc datetime.
+                see SnippetGenerator.convert_protobuf_ts_to_utc_datetime
+        """
+        ts, counts, global_ids, tlbr = [], [], [], []
+        for tr_box in tr_boxes:
+            ts.append(SegmentIndex.datetime_to_ns(convert_ts(tr_box.timestamp)))
+            counts.append(len(tr_box.bboxes))
+            for box in tr_box.bboxes:
+                global_ids.append(box.global_id)
+                tlbr.append((box.top, box.left, box.bottom, box.right))
+        if len(ts) == 0:
+            return cls.empty()
+
+        offsets = np.zeros(len(ts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        store = cls(np.array(ts, dtype=np.int64), offsets, np.array(global_ids, dtype=np.int32),
+                    np.array(tlbr, dtype=np.float32).reshape(-1, 4))
+        return store.sorted()
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def box_ts(self):
+        """(m,) int64 update time of each box"""
+        return np.repeat(self.ts, np.diff(self.offsets))
+
+    def sorted(self):
+        """store with updates in time order (stable). self if already sorted"""
+        if len(self.ts) < 2 or bool(np.all(self.ts[1:] >= self.ts[:-1])):
+            return self
+        order = np.argsort(self.ts, kind='stable')
+        return self.take(order)
+
+    def take(self, update_indexes):
+        """store with just the given updates, in the given order"""
+        starts, ends = self.offsets[update_indexes], self.offsets[update_indexes + 1]
+        rows = np.concatenate([np.arange(a, b) for a, b in zip(starts.tolist(), ends.tolist())] or
+                              [np.zeros(0, dtype=np.int64)])
+        offsets = np.zeros(len(update_indexes) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        return BoxStore(self.ts[update_indexes], offsets, self.global_ids[rows], self.tlbr[rows])
+
+    def select(self, start_time, end_time):
+        """store with the updates from start_time to end_time (utc datetimes, inclusive)"""
+        i = int(np.searchsorted(self.ts, SegmentIndex.datetime_to_ns(start_time), side='left'))
+        j = max(int(np.searchsorted(self.ts, SegmentIndex.datetime_to_ns(end_time), side='right')), i)
+        if i == 0 and j == len(self.ts):
+            return self
+        offsets = self.offsets[i:j + 1] - self.offsets[i]
+        a, b = self.offsets[i], self.offsets[j]
+        return BoxStore(self.ts[i:j], offsets, self.global_ids[a:b], self.tlbr[a:b])
+
+    def get_update(self, i):
+        """(global_ids, tlbr) of the boxes of update i"""
+        a, b = self.offsets[i], self.offsets[i + 1]
+        return self.global_ids[a:b], self.tlbr[a:b]
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import queue
+import logging
+import threading
+
+
+class FramePipeline:
+    """runs the decode, process and encode stages of a frame loop on separate threads
+
+    opencv releases the gil while decoding, drawing and encoding, so the stages overlap on
+    multi-core hosts. stages are connected by bounded queues and decoded frames are read into
+    buffers handed back by the encoder once written, so no frame buffers are allocated after
+    the first few frames.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    queue_size = 4  # frames waiting between two stages
+    poll_sec = 0.1  # how often blocked stages recheck for a stop
+
+    def __init__(self, read_frame, write_frame, first_frame=None, queue_size=None, read_fail_limit=4) -> None:
+        """
+        Args:
+            read_frame (callable): read_frame(buffer) -> (success, frame). decoder thread.
+                buffer is a frame to read into or None. e.g. cv2.VideoCapture.read
+            write_frame (callable): write_frame(frame). encoder thread. e.g. cv2.VideoWriter.write
+            first_frame (np.ndarray): frame already read (e.g. to get the frame size) fed before read_frame
+            queue_size (int): frames waiting between two stages. class default if None
+            read_fail_limit (int): sequential read fails that end the stream
+        """
+        self.read_frame = read_frame
+        self.write_frame = write_frame
+        self.first_frame = first_frame
+        self.read_fail_limit = read_fail_limit
+        queue_size = queue_size or self.queue_size
+        self.decoded_q = queue.Queue(maxsize=queue_size)  # frames to process. None ends the stream
+        self.encode_q = queue.Queue(maxsize=queue_size)  # frames to write or None to skip. None ends the stream
+        self.free_q = queue.Queue()  # written frame buffers to read into
+        for _ in range(2 * queue_size + 2):
+            self.free_q.put(None)  # None lets the decoder allocate
+        self.stop_event = threading.Event()
+        self.stopped = object()  # returned by get when the pipeline is stopped
+        self.errors = []
+
+    def get(self, q):
+        """blocking get that gives up with self.stopped once the pipeline is stopped"""
+        while True:
+            try:
+                return q.get(timeout=self.poll_sec)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    return self.stopped
+
+    def put(self, q, item) -> bool:
+        """blocking put that gives up once the pipeline is stopped. False if the item wasn't queued"""
+        while True:
+            try:
+                q.put(item, timeout=self.poll_sec)
+                return True
+            except queue.Full:
+                if self.stop_event.is_set():
+                    return False
+
+    def decode(self) -> None:
+        try:
+            if self.first_frame is not None and not self.put(self.decoded_q, self.first_frame):
+                return
+            read_fail_count = 0
+            while read_fail_count < self.read_fail_limit:
+                buffer = self.get(self.free_q)
+                if buffer is self.stopped:
+                    return
+                read_success, frame = self.read_frame(buffer)
+                if not read_success:
+                    read_fail_count += 1
+                    self.logger.error(f'mp4 read fail. count={read_fail_count}')
+                    self.free_q.put(buffer)
+                    continue
+                read_fail_count = 0
+                if not self.put(self.decoded_q, frame):
+                    return
+        except Exception as e:
+            self.errors.append(e)
+        self.put(self.decoded_q, None)
+
+    def encode(self) -> None:
+        try:
+            while True:
+                item = self.get(self.encode_q)
+                if item is None or item is self.stopped:
+                    return
+                frame, write_frame = item
+                if write_frame is not None:
+                    self.write_frame(write_frame)
+                self.free_q.put(frame)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop_event.set()
+
+    def run(self, process_frame) -> int:
+        """runs the pipeline until the input ends, processing frames in order on the calling thread
+
+        Args:
+            process_frame (callable): process_frame(frame, k) -> frame to write or None to skip it.
+                k is the frame index. may draw on frame in place and return it
+
+        Returns:
+            frame_count (int): frames processed
+
+        Raises:
+            Exception: first exception raised in a stage
+        """
+        decoder = threading.Thread(name='frame_pipeline_decode', target=self.decode, daemon=True)
+        encoder = threading.Thread(name='frame_pipeline_encode', target=self.encode, daemon=True)
+        decoder.start()
+        encoder.start()
+
+        frame_count = 0
+        try:
+            while True:
+                frame = self.get(self.decoded_q)
+                if frame is None or frame is self.stopped:
+                    break
+                write_frame = process_frame(frame, frame_count)
+                frame_count += 1
+                if not self.put(self.encode_q, (frame, write_frame)):
+                    break
+            # encoder writes out what is queued before it stops
+            self.put(self.encode_q, None)
+            encoder.join()
+        finally:
+            self.stop_event.set()
+            decoder.join()
+            encoder.join()
+
+        if len(self.errors) > 0:
+            printmsg = f'frame pipeline failed: {self.errors[0]!r}'
+            self.logger.error(printmsg)
+            self.error_logger.error(printmsg)
+            raise self.errors[0]
+        return frame_count
+
+    @classmethod
+    def prefetch(cls, frames, queue_size=None):
+        """iterates frames on a background thread, keeping up to queue_size items decoded ahead
+
+        Args:
+            frames (iterable): e.g. SnippetGenerator.iter_segment_frames generator
+
+        Yields:
+            the items of frames, in order
+        """
+        q = queue.Queue(maxsize=queue_size or cls.queue_size)
+        stop_event = threading.Event()
+        end = object()
+        errors = []
+
+        def produce():
+            try:
+                for item in frames:
+                    while not stop_event.is_set():
+                        try:
+                            q.put(item, timeout=cls.poll_sec)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop_event.is_set():
+                        return
+            except Exception as e:
+                errors.append(e)
+            q.put(end)
+
+        producer = threading.Thread(name='frame_pipeline_prefetch', target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = q.get()
+                if item is end:
+                    break
+                yield item
+        finally:
+            stop_event.set()
+            # unblock a producer waiting on a full queue
+            while producer.is_alive():
+                try:
+                    q.get(timeout=cls.poll_sec)
+                except queue.Empty:
+                    pass
+            producer.join()
+        if len(errors) > 0:
+            raise errors[0]
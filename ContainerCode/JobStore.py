@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import time
+import pickle
+import logging
+import sqlite3
+
+
+class JobStore:
+    """crash safe record of received SkaiEvent messages and the state of their snippet tasks
+
+    sqlite in wal mode on the host mounted log folder, so queued events survive a crash or a
+    container restart. writes go into an open transaction and are made durable by commit(),
+    which the handler calls once per loop iteration, so a burst of messages costs one fsync.
+    events are stored before they are turned into tasks. on restart, events that never got
+    their tasks are planned again and pending / interrupted tasks are resumed. done tasks are skipped.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    states = ('pending', 'running', 'done', 'failed', 'dropped')  # dropped: shed by AdmissionControl
+    max_attempts = 3  # tasks interrupted this many times (e.g. crashing the container) are marked failed
+    keep_sec = 7 * 24 * 3600  # finished events and tasks older than this are pruned on open
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            received_at REAL NOT NULL,
+            planned INTEGER NOT NULL DEFAULT 0,
+            data BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            event_id INTEGER NOT NULL,
+            output_file TEXT NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL,
+            error TEXT,
+            task BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state);
+        CREATE INDEX IF NOT EXISTS tasks_event ON tasks (event_id);
+        CREATE INDEX IF NOT EXISTS events_planned ON events (planned);
+    '''
+
+    def __init__(self, path) -> None:
+        """
+        Args:
+            path (str): sqlite database file. e.g. /skailogs/snpm_jobs.db
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # a commit in wal mode with synchronous normal survives a process crash without an fsync per write
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.schema)
+        self.conn.commit()
+        self.prune()
+
+    def add_event(self, data) -> int:
+        """records a received message before it is turned into tasks
+
+        Args:
+            data (bytes): message as received. see SnippetManager.parse_msg
+
+        Returns:
+            event_id (int): pass to add_tasks
+        """
+        cur = self.conn.execute('INSERT INTO events (received_at, data) VALUES (?, ?)', (time.time(), bytes(data)))
+        return cur.lastrowid
+
+    def add_tasks(self, event_id, tasks) -> None:
+        """records the tasks of an event as pending and sets their job_id"""
+        now = time.time()
+        for task in tasks:
+            cur = self.conn.execute(
+                'INSERT INTO tasks (event_id, output_file, state, updated_at, task) VALUES (?, ?, ?, ?, ?)',
+                (event_id, str(task), 'pending', now, pickle.dumps(task, protocol=pickle.HIGHEST_PROTOCOL)))
+            task.job_id = cur.lastrowid
+        self.conn.execute('UPDATE events SET planned = 1 WHERE id = ?', (event_id, ))
+
+    def set_state(self, tasks, state, error=None, from_state=None) -> None:
+        """sets the state of recorded tasks. tasks without a job_id are ignored
+
+        Args:
+            tasks (list): SnippetGenerator.Task list
+            state (str): one of states
+            error (Exception): failure reason stored with failed tasks
+            from_state (str): only change tasks currently in this state (e.g. keep dropped ones dropped)
+        """
+        if state not in self.states:
+            printmsg = f'unknown task state {state}. choices are {self.states}'
+            self.error_logger.error(printmsg)
+            raise Exception(printmsg)
+        job_ids = [(task.job_id, ) for task in tasks if task.job_id is not None]
+        if len(job_ids) == 0:
+            return
+        now = time.time()
+        error = repr(error) if error is not None else None
+        where = 'id = ?' if from_state is None else 'id = ? AND state = ?'
+        where_args = () if from_state is None else (from_state, )
+        if state == 'running':
+            self.conn.executemany(f'UPDATE tasks SET state = ?, attempts = attempts + 1, updated_at = ? WHERE {where}',
+                                  [('running', now, job_id, *where_args) for (job_id, ) in job_ids])
+        else:
+            self.conn.executemany(f'UPDATE tasks SET state = ?, updated_at = ?, error = ? WHERE {where}',
+                                  [(state, now, error, job_id, *where_args) for (job_id, ) in job_ids])
+
+    def commit(self) -> None:
+        """makes the writes since the last commit durable"""
+        self.conn.commit()
+
+    def load_unfinished(self) -> tuple:
+        """reads back what was left over from the previous run
+
+        tasks that were running when the previous run stopped go back to pending unless they
+        were already interrupted max_attempts times, in which case they are marked failed.
+
+        Returns:
+            (events, tasks): events is a list of (event_id, data) received but not turned into tasks,
+                tasks is the list of SnippetGenerator.Task to run, with job_id set
+        """
+        cur = self.conn.execute("UPDATE tasks SET state = 'failed', error = 'interrupted too many times', "
+                                "updated_at = ? WHERE state = 'running' AND attempts >= ?",
+                                (time.time(), self.max_attempts))
+        if cur.rowcount > 0:
+            printmsg = f'giving up on {cur.rowcount} tasks interrupted {self.max_attempts} times'
+            self.logger.error(printmsg)
+            self.error_logger.error(printmsg)
+        self.conn.execute("UPDATE tasks SET state = 'pending' WHERE state = 'running'")
+        self.conn.commit()
+
+        events = []
+        for event_id, data in self.conn.execute('SELECT id, data FROM events WHERE planned = 0 ORDER BY id'):
+            events.append((event_id, data))
+        tasks = []
+        for job_id, task in self.conn.execute("SELECT id, task FROM tasks WHERE state = 'pending' ORDER BY id"):
+            try:
+                task = pickle.loads(task)
+            except Exception as e:
+                printmsg = f'could not load task {job_id}: {e!r}'
+                self.logger.error(printmsg)
+                self.error_logger.error(printmsg)
+                continue
+            task.job_id = job_id
+            tasks.append(task)
+        if len(events) > 0 or len(tasks) > 0:
+            self.logger.info(f'resuming {len(events)} unplanned events and {len(tasks)} unfinished tasks from {self.path}')
+        return events, tasks
+
+    def prune(self, keep_sec=None) -> None:
+        """deletes finished tasks and their events older than keep_sec (class default if None)"""
+        keep_sec = self.keep_sec if keep_sec is None else keep_sec
+        cutoff = time.time() - keep_sec
+        self.conn.execute("DELETE FROM tasks WHERE state IN ('done', 'failed', 'dropped') AND updated_at < ?",
+                          (cutoff, ))
+        self.conn.execute('DELETE FROM events WHERE planned = 1 AND received_at < ? AND id NOT IN '
+                          '(SELECT event_id FROM tasks)', (cutoff, ))
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+import subprocess
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import cv2
+
+
+class MediaProbe:
+    """cached container metadata of video files
+
+    metadata is read with ffprobe from the container headers only, nothing is decoded.
+    results are cached per (path, size, mtime) so an unchanged file is probed once
+    and a file still being written is probed again once it grows.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    ffprobe_bin = 'ffprobe'
+    ffprobe_missing = False  # set once ffprobe wasn't found. probes go straight to opencv after that
+    max_cache_entries = 4096
+    cache = OrderedDict()  # (path, size, mtime_ns) -> ProbeInfo or None if probe failed
+
+    @dataclass
+    class ProbeInfo:
+        """Class for storing video file metadata"""
+        duration: float  # seconds
+        fps: float  # frames per second
+        width: int  # pixels
+        height: int  # pixels
+        codec: str  # video codec name
+        frame_count: int  # frames in video stream. 0 if not in container header
+
+    @classmethod
+    def probe(cls, filepath, quiet=False):
+        """gets metadata of video file, probing it only if not cached
+
+        Args:
+            quiet (bool): don't log probe failures (e.g. polling a file still being written)
+
+        Returns:
+            info (ProbeInfo): video metadata or None if the file couldn't be probed
+
+        Raises:
+            FileNotFoundError: if filepath doesn't exist on local path
+        """
+        st = os.stat(filepath)
+        key = (os.path.abspath(filepath), st.st_size, st.st_mtime_ns)
+        if key in cls.cache:
+            cls.cache.move_to_end(key)
+            return cls.cache[key]
+
+        info = cls.probe_ffprobe(filepath, quiet=quiet)
+        cls.cache[key] = info
+        while len(cls.cache) > cls.max_cache_entries:
+            cls.cache.popitem(last=False)
+        return info
+
+    @staticmethod
+    def parse_rate(rate_str):
+        """parses ffprobe frame rate string like '30000/1001' to float"""
+        num, _, den = (rate_str or '0').partition('/')
+        try:
+            num, den = float(num), float(den or 1)
+        except ValueError:
+            return 0.0
+        return num / den if den else 0.0
+
+    @classmethod
+    def probe_ffprobe(cls, filepath, quiet=False):
+        cmd = [cls.ffprobe_bin, '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'stream=codec_name,width,height,avg_frame_rate,r_frame_rate,nb_frames,duration'
+               ':format=duration', '-of', 'json', filepath]
+        if cls.ffprobe_missing:
+            return cls.probe_opencv(filepath, quiet=quiet)
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            # warned once per process, not once per probed segment
+            cls.ffprobe_missing = True
+            cls.logger.warning(f'{cls.ffprobe_bin} not found. falling back to opencv for probing')
+            return cls.probe_opencv(filepath, quiet=quiet)
+
+        if proc.returncode != 0:
+            if not quiet:
+                printmsg = f'probe failed for {filepath}: {proc.stderr.decode("utf-8", errors="replace").strip()}'
+                cls.logger.warning(printmsg)
+                cls.error_logger.warning(printmsg)
+            return None
+
+        result = json.loads(proc.stdout)
+        streams = result.get('streams', [])
+        if len(streams) == 0:
+            cls.logger.warning(f'no video stream found in {filepath}')
+            return None
+        stream = streams[0]
+        duration = stream.get('duration') or result.get('format', {}).get('duration') or 0
+        fps = cls.parse_rate(stream.get('avg_frame_rate')) or cls.parse_rate(stream.get('r_frame_rate'))
+        return cls.ProbeInfo(duration=float(duration),
+                             fps=fps,
+                             width=int(stream.get('width', 0)),
+                             height=int(stream.get('height', 0)),
+                             codec=stream.get('codec_name', ''),
+                             frame_count=int(stream.get('nb_frames', 0) or 0))
+
+    @classmethod
+    def probe_opencv(cls, filepath, quiet=False):
+        cap = cv2.VideoCapture(filepath)
+        if not cap.isOpened():
+            if not quiet:
+                cls.logger.warning(f'probe failed for {filepath}: opencv couldn\'t open it')
+            return None
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        info = cls.ProbeInfo(duration=frame_count / fps if fps else 0.0,
+                             fps=fps,
+                             width=int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                             height=int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                             codec=''.join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip(),
+                             frame_count=frame_count)
+        cap.release()
+        return info
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics:
+    """process local counters, gauges and histograms rendered in prometheus text format
+
+    worker processes record into their own copy and hand it to the handler process with
+    take_snapshot / merge, so the handler serves the totals of all processes on its http port.
+    when disabled every call returns right away and timers are a shared no-op context manager.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    http_host = '127.0.0.1'
+    enabled = True
+
+    # histogram buckets (upper bounds)
+    seconds_buckets = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    fast_seconds_buckets = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25)
+    fps_buckets = (1, 5, 10, 15, 20, 30, 60, 120, 240, 480, 960)
+
+    descriptions = {
+        'snpm_msg_queue_depth': 'messages waiting in the snippet manager msg_q',
+        'snpm_tasks_pending': 'tasks waiting for a worker',
+        'snpm_tasks_running': 'tasks running on workers',
+        'snpm_tasks_parked': 'tasks parked until their footage is recorded',
+        'snpm_msgs_total': 'SkaiEvent messages handled',
+        'snpm_msg_failures_total': 'SkaiEvent messages that failed to turn into tasks, by reason',
+        'snpm_tasks_total': 'finished snippet tasks',
+        'snpm_task_failures_total': 'failed snippet tasks, by reason',
+        'snpm_stage_seconds': 'time spent per snippet generation stage',
+        'snpm_handler_seconds': 'time spent per handler loop phase',
+        'snpm_draw_fps': 'frames per second of bbox drawing passes',
+        'snpm_draw_frames_total': 'frames read by bbox drawing passes',
+        'snpm_tracker_update_seconds': 'time per tracker update of one object',
+        'snpm_dropped_total': 'tasks / messages shed by admission control, by reason',
+        'snpm_forwarded_total': 'SkaiEvent messages forwarded to the shard owning their cameras, by result',
+        'snpm_cache_total': 'snippet cache lookups, by result',
+        'snpm_cache_evictions_total': 'snippet cache entries evicted for space',
+        'snpm_retention_evicted_total': 'snippet files deleted by retention, by quota',
+        'snpm_retention_bytes': 'total size of the cataloged snippet files',
+    }
+
+    lock = threading.Lock()
+    counters = {}  # (name, labels) -> value
+    gauges = {}  # (name, labels) -> value
+    histograms = {}  # (name, labels) -> [buckets, bucket counts, sum, count]
+
+    class Timer:
+        """context manager observing its elapsed seconds into a histogram"""
+        __slots__ = ('name', 'labels', 'buckets', 't0')
+
+        def __init__(self, name, labels, buckets) -> None:
+            self.name = name
+            self.labels = labels
+            self.buckets = buckets
+
+        def __enter__(self):
+            self.t0 = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc):
+            Metrics.observe_key(self.name, self.labels, time.perf_counter() - self.t0, self.buckets)
+            return False
+
+    class NullTimer:
+        __slots__ = ()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    null_timer = NullTimer()
+
+    @staticmethod
+    def get_labels(labels) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    @classmethod
+    def init_worker(cls, enabled) -> None:
+        """resets state copied from the parent process. used as worker pool initializer"""
+        cls.enabled = enabled
+        cls.lock = threading.Lock()  # a lock held by a parent thread at fork time would never be released
+        cls.counters = {}
+        cls.gauges = {}
+        cls.histograms = {}
+
+    @classmethod
+    def inc(cls, name, value=1, **labels) -> None:
+        if not cls.enabled:
+            return
+        key = (name, cls.get_labels(labels))
+        with cls.lock:
+            cls.counters[key] = cls.counters.get(key, 0) + value
+
+    @classmethod
+    def set_gauge(cls, name, value, **labels) -> None:
+        if not cls.enabled:
+            return
+        with cls.lock:
+            cls.gauges[(name, cls.get_labels(labels))] = value
+
+    @classmethod
+    def observe(cls, name, value, buckets=None, **labels) -> None:
+        if not cls.enabled:
+            return
+        cls.observe_key(name, cls.get_labels(labels), value, buckets)
+
+    @classmethod
+    def observe_key(cls, name, labels, value, buckets=None) -> None:
+        key = (name, labels)
+        with cls.lock:
+            hist = cls.histograms.get(key)
+            if hist is None:
+                buckets = tuple(buckets or cls.seconds_buckets)
+                hist = cls.histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for k, upper in enumerate(hist[0]):
+                if value <= upper:
+                    hist[1][k] += 1
+                    break
+            hist[2] += value
+            hist[3] += 1
+
+    @classmethod
+    def timer(cls, name, buckets=None, **labels):
+        """times a with block into histogram name
+
+        Example:
+            with Metrics.timer('snpm_stage_seconds', stage='assemble_video_snippet'):
+                ...
+        """
+        if not cls.enabled:
+            return cls.null_timer
+        return cls.Timer(name, cls.get_labels(labels), buckets)
+
+    @classmethod
+    def take_snapshot(cls) -> dict:
+        """returns the counters and histograms recorded since the last snapshot and clears them
+
+        gauges are process local and not part of snapshots
+        """
+        with cls.lock:
+            snapshot = {'counters': cls.counters, 'histograms': cls.histograms}
+            cls.counters = {}
+            cls.histograms = {}
+        return snapshot
+
+    @classmethod
+    def merge(cls, snapshot) -> None:
+        """adds a snapshot taken in another process"""
+        if not cls.enabled or not snapshot:
+            return
+        with cls.lock:
+            for key, value in snapshot['counters'].items():
+                cls.counters[key] = cls.counters.get(key, 0) + value
+            for key, (buckets, counts, total, count) in snapshot['histograms'].items():
+                hist = cls.histograms.get(key)
+                if hist is None:
+                    cls.histograms[key] = [buckets, list(counts), total, count]
+                elif hist[0] == buckets:
+                    hist[1] = [a + b for a, b in zip(hist[1], counts)]
+                    hist[2] += total
+                    hist[3] += count
+
+    @staticmethod
+    def format_labels(labels, extra=()) -> str:
+        labels = [*labels, *extra]
+        if len(labels) == 0:
+            return ''
+        return '{' + ','.join(f'{k}="{str(v)}"' for k, v in labels) + '}'
+
+    @classmethod
+    def render(cls) -> str:
+        """prometheus text exposition format of everything recorded"""
+        with cls.lock:
+            counters = sorted(cls.counters.items())
+            gauges = sorted(cls.gauges.items())
+            histograms = sorted((key, (h[0], list(h[1]), h[2], h[3])) for key, h in cls.histograms.items())
+
+        lines = []
+        last_name = None
+
+        def header(name, kind):
+            if name != last_name:
+                if name in cls.descriptions:
+                    lines.append(f'# HELP {name} {cls.descriptions[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+            return name
+
+        for (name, labels), value in counters:
+            last_name = header(name, 'counter')
+            lines.append(f'{name}{cls.format_labels(labels)} {value}')
+        for (name, labels), value in gauges:
+            last_name = header(name, 'gauge')
+            lines.append(f'{name}{cls.format_labels(labels)} {value}')
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            last_name = header(name, 'histogram')
+            cumulative = 0
+            for upper, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{cls.format_labels(labels, (("le", upper), ))} {cumulative}')
+            lines.append(f'{name}_bucket{cls.format_labels(labels, (("le", "+Inf"), ))} {count}')
+            lines.append(f'{name}_sum{cls.format_labels(labels)} {total}')
+            lines.append(f'{name}_count{cls.format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def start_http_server(cls, port):
+        """serves render() at http://{http_host}:{port}/metrics from a daemon thread
+
+        Returns:
+            server (ThreadingHTTPServer): call server.shutdown() to stop it
+        """
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = cls.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                cls.logger.debug(f'metrics request from {self.address_string()}: {format % args}')
+
+        server = ThreadingHTTPServer((cls.http_host, port), MetricsRequestHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(name='snip_mgr_metrics_http', target=server.serve_forever, daemon=True)
+        thread.start()
+        cls.logger.info(f'serving metrics on http://{cls.http_host}:{port}/metrics')
+        return server
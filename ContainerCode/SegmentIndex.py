@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import datetime
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+
+class SegmentIndex:
+    """sorted index of the mp4 segment start times in a single camera folder
+
+    kept alive for the lifetime of the process that owns it (see for_cam_folder) and
+    updated incrementally. the folder is only listed again when its mtime changes, and only
+    file names not seen before are parsed.
+
+    segments overlapping a time range are looked up by bisection on the start / end arrays,
+    so a lookup is O(log n) in the number of segments in the folder.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    epoch = datetime.datetime(1970, 1, 1)
+    one_us = datetime.timedelta(microseconds=1)
+    racy_mtime_ns = 2 * 10**9  # dir mtimes this close to now may still change within the same tick
+    max_indexes = 256  # camera folders kept per process (one per camera per day)
+    indexes = OrderedDict()  # cam_folder -> SegmentIndex
+
+    @classmethod
+    def for_cam_folder(cls, cam_folder, mp4_dateformat):
+        """gets the long lived index for cam_folder, creating it if needed, refreshed to the folder contents
+
+        Raises:
+            FileNotFoundError: if cam_folder doesn't exist on local path
+        """
+        cam_folder = os.path.normpath(cam_folder)
+        index = cls.indexes.get(cam_folder)
+        if index is None:
+            index = cls(cam_folder, mp4_dateformat)
+            cls.indexes[cam_folder] = index
+            while len(cls.indexes) > cls.max_indexes:
+                old_folder, _old_index = cls.indexes.popitem(last=False)
+                cls.logger.debug(f'dropped segment index for {old_folder}')
+        else:
+            cls.indexes.move_to_end(cam_folder)
+        index.refresh()
+        return index
+
+    @classmethod
+    def datetime_to_ns(cls, dt):
+        return (dt - cls.epoch) // cls.one_us * 1000
+
+    @classmethod
+    def ns_to_datetime(cls, ns):
+        return cls.epoch + datetime.timedelta(microseconds=ns // 1000)
+
+    def __init__(self, cam_folder, mp4_dateformat) -> None:
+        self.cam_folder = cam_folder
+        self.mp4_dateformat = mp4_dateformat
+        self.dir_mtime_ns = None  # folder mtime at last listing. None forces a listing
+        self.names = {}  # mp4 file name -> start time ns
+        self.ignored_names = set()  # mp4 file names that don't match mp4_dateformat
+        self.starts = array('q')  # sorted segment start times (ns)
+        self.durations = array('q')  # time until next segment start (ns). last segment see set_last_segment_end
+        self.ends = array('q')  # segment end times (ns). starts + durations
+
+    def __len__(self):
+        return len(self.starts)
+
+    def refresh(self) -> bool:
+        """updates index if the camera folder changed since last refresh
+
+        Returns:
+            changed (bool): True if segments were added or removed
+        """
+        dir_mtime_ns = os.stat(self.cam_folder).st_mtime_ns
+        if dir_mtime_ns == self.dir_mtime_ns:
+            return False
+
+        # don't trust an mtime in the current tick. a file added later in the same tick won't bump it
+        if time.time_ns() - dir_mtime_ns < self.racy_mtime_ns:
+            self.dir_mtime_ns = None
+        else:
+            self.dir_mtime_ns = dir_mtime_ns
+
+        mp4_files = {f for f in os.listdir(self.cam_folder) if f.endswith('.mp4')}
+        removed = [f for f in self.names if f not in mp4_files]
+        added = [f for f in mp4_files if f not in self.names and f not in self.ignored_names]
+        if len(removed) == 0 and len(added) == 0:
+            return False
+
+        for f in removed:
+            ns = self.names.pop(f)
+            i = bisect_left(self.starts, ns)
+            del self.starts[i]
+        for f in added:
+            try:
+                ns = self.datetime_to_ns(datetime.datetime.strptime(f, self.mp4_dateformat))
+            except ValueError:
+                printmsg = f'ignoring mp4 file {f} in {self.cam_folder} not matching format {self.mp4_dateformat}'
+                self.logger.error(printmsg)
+                self.error_logger.error(printmsg)
+                self.ignored_names.add(f)
+                continue
+            self.names[f] = ns
+            self.starts.insert(bisect_left(self.starts, ns), ns)
+
+        # durations are the gaps between start times. last segment ends where it starts until told otherwise
+        self.durations = array('q', (b - a for a, b in zip(self.starts, self.starts[1:])))
+        self.ends = self.starts[1:]
+        if len(self.starts) > 0:
+            self.durations.append(0)
+            self.ends.append(self.starts[-1])
+
+        self.logger.debug(f'segment index {self.cam_folder}: +{len(added)} -{len(removed)} = {len(self.starts)} segments')
+        return True
+
+    def set_last_segment_end(self, last_segment_end) -> None:
+        """sets end time of the last (still recording) segment
+
+        Args:
+            last_segment_end (datetime): end time of the last segment
+        """
+        if len(self.starts) == 0:
+            return
+        # a segment started less than the recording lag ago ends where it starts, keeping ends sorted for bisection
+        end_ns = max(self.datetime_to_ns(last_segment_end), self.starts[-1])
+        self.ends[-1] = end_ns
+        self.durations[-1] = end_ns - self.starts[-1]
+
+    def find_range(self, start_ns, end_ns, lo=0):
+        """finds the segments overlapping start_ns to end_ns
+
+        Args:
+            start_ns (int): range start time (ns)
+            end_ns (int): range end time (ns)
+            lo (int): first segment to consider
+
+        Returns:
+            (i, j): slice of segment indices. the first segment ending after start_ns
+                up to and including the first segment ending after end_ns
+        """
+        i = bisect_right(self.ends, start_ns, lo)
+        j = min(bisect_right(self.ends, end_ns, i) + 1, len(self.ends))
+        return i, max(i, j)
+
+    def find_ranges(self, ranges) -> list:
+        """finds the overlapping segments for several (start_time, end_time) datetime ranges in one call
+
+        Returns:
+            slices (list): (i, j) segment slice for each range, in the order of ranges
+        """
+        ns_ranges = [(self.datetime_to_ns(s), self.datetime_to_ns(e)) for s, e in ranges]
+        slices = [None] * len(ns_ranges)
+        lo = 0
+        # in start time order each search can begin where the previous one started
+        for k in sorted(range(len(ns_ranges)), key=lambda k: ns_ranges[k][0]):
+            slices[k] = self.find_range(*ns_ranges[k], lo=lo)
+            lo = slices[k][0]
+        return slices
+
+    def get_start_times_and_durations(self, i=0, j=None) -> list:
+        """gets list of (start_time, duration) tuples of (datetime.datetime, datetime.timedelta)
+
+        Args:
+            i (int): first segment
+            j (int): segment to stop before. defaults to the end of the index
+        """
+        if j is None:
+            j = len(self.starts)
+        return [(self.ns_to_datetime(t), datetime.timedelta(microseconds=d // 1000))
+                for t, d in zip(self.starts[i:j], self.durations[i:j])]
+
+    def lookup(self, start_time, end_time) -> list:
+        """gets (start_time, duration) tuples of the segments overlapping start_time to end_time"""
+        return self.lookup_ranges([(start_time, end_time)])[0]
+
+    def lookup_ranges(self, ranges) -> list:
+        """gets (start_time, duration) tuples of the overlapping segments for each (start_time, end_time) range"""
+        return [self.get_start_times_and_durations(i, j) for i, j in self.find_ranges(ranges)]
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import bisect
+import hashlib
+
+
+class ShardRing:
+    """consistent hash ring mapping camera macs to snippet manager shards
+
+    every shard puts replicas points on the ring and a camera belongs to the shard owning the
+    first point at or after the camera's hash. every instance builds the same ring from the
+    shard count, so they agree on owners without talking to each other, and going from n to
+    n + 1 shards only moves about 1 / (n + 1) of the cameras.
+    """
+
+    replicas = 160  # ring points per shard. more evens out the cameras per shard
+
+    def __init__(self, shard_count, replicas=None) -> None:
+        """
+        Args:
+            shard_count (int): number of shards. shard indexes are 0 to shard_count - 1
+            replicas (int): ring points per shard. class default if None
+        """
+        self.shard_count = shard_count
+        replicas = replicas or self.replicas
+        points = sorted((self.hash(f'shard{shard}-{k}'), shard)
+                        for shard in range(shard_count) for k in range(replicas))
+        self.keys = [key for key, _shard in points]
+        self.shards = [shard for _key, shard in points]
+
+    @staticmethod
+    def hash(key) -> int:
+        # stable across processes and python versions, unlike hash()
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def get_shard(self, mac) -> int:
+        """shard index owning camera mac (as from SkaiMsg.convert_camera_id_to_mac_addr_string)"""
+        i = bisect.bisect_left(self.keys, self.hash(mac.upper()))
+        return self.shards[i % len(self.keys)]
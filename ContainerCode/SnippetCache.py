@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+from Metrics import Metrics
+
+
+class SnippetCache:
+    """content addressed cache of produced snippets
+
+    entries are keyed on what a snippet is made from: camera, time range, snippet mode and
+    overlay settings, and the boxes drawn. a task whose key is cached gets its output files as
+    hardlinks (or reflinks / copies across filesystems) of the cached ones instead of decoding.
+    each entry keeps a fingerprint (name, size, mtime) of the source segments it was made from
+    and is dropped when they change. the index is a json file shared by all worker processes
+    (and shards) under a file lock, and entries are evicted least recently used past max_bytes.
+    the cache is process configuration, not task state: worker processes set it up once (see init_worker).
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    key_version = 1  # bump when snippet output changes for the same inputs
+    FICLONE = 0x40049409  # linux ioctl cloning a file's extents (reflink) on btrfs / xfs
+    instance = None  # cache of this process. None doesn't cache
+
+    def __init__(self, cache_dir, max_bytes=10 * 2**30) -> None:
+        """
+        Args:
+            cache_dir (str): cache folder. on the snippets filesystem so outputs can be hardlinked
+            max_bytes (int): max total size of the cached files
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def init_worker(cls, cache_dir, max_bytes) -> None:
+        """sets up the cache of this process. '' cache_dir turns caching off. used in the worker pool initializer"""
+        cls.instance = cls(cache_dir, max_bytes) if cache_dir else None
+
+    @property
+    def index_file(self) -> Path:
+        return Path(self.cache_dir) / 'index.json'
+
+    @classmethod
+    def get_key(cls, task, boxes_to_draw) -> str:
+        """cache key of task
+
+        Args:
+            task (SnippetGenerator.Task): task to make snippets for
+            boxes_to_draw (BoxStore): boxes of the task time range
+        """
+        h = hashlib.sha256()
+        params = [cls.key_version, Path(task.cam_folder).name, task.start_time.isoformat(), task.end_time.isoformat(),
+                  task.mode, task.reencode_head, task.write_plain, task.interpolation, task.tracking_scale]
+        h.update(json.dumps(params).encode('utf-8'))
+        for array in (boxes_to_draw.ts, boxes_to_draw.offsets, boxes_to_draw.global_ids, boxes_to_draw.tlbr):
+            h.update(array.tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def get_fingerprint(segment_files) -> list:
+        """(name, size, mtime ns) of each source segment file"""
+        fingerprint = []
+        for filepath in segment_files:
+            stat = os.stat(filepath)
+            fingerprint.append([Path(filepath).name, stat.st_size, stat.st_mtime_ns])
+        return fingerprint
+
+    @classmethod
+    def link(cls, src, dst) -> None:
+        """makes dst a hardlink of src, else a reflink, else a copy. replaces dst without writing into it"""
+        tmp = f'{dst}.{os.getpid()}.tmp'
+        try:
+            os.link(src, tmp)
+        except OSError:
+            try:
+                with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), cls.FICLONE, fsrc.fileno())
+            except OSError:
+                shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+    @staticmethod
+    def detach(paths) -> None:
+        """unlinks output files shared with the cache so writing new snippets doesn't change the cached copy"""
+        for path in paths:
+            try:
+                if os.stat(path).st_nlink > 1:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def is_usable(path) -> bool:
+        """cached file still exists and isn't empty"""
+        try:
+            return os.stat(path).st_size > 0
+        except FileNotFoundError:
+            return False
+
+    def locked_index(self):
+        """opens the index lock. use as a context manager around load_index / save_index"""
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        lock = open(Path(self.cache_dir) / 'index.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def load_index(self) -> dict:
+        """key -> entry dict(files={kind: file name}, size, last_used, fingerprint)"""
+        try:
+            return json.loads(self.index_file.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            printmsg = f'snippet cache index {self.index_file} unreadable, starting over: {e}'
+            self.logger.error(printmsg)
+            self.error_logger.error(printmsg)
+            return {}
+
+    def save_index(self, index) -> None:
+        tmp = self.index_file.with_suffix('.tmp')
+        tmp.write_text(json.dumps(index))
+        os.replace(tmp, self.index_file)
+
+    def remove_entry(self, index, key) -> None:
+        entry = index.pop(key)
+        for name in entry['files'].values():
+            try:
+                os.unlink(Path(self.cache_dir) / name)
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, key, fingerprint, outputs) -> bool:
+        """links the cached files of key to their output paths
+
+        Args:
+            key (str): see get_key
+            fingerprint (list): current source segments fingerprint. see get_fingerprint
+            outputs (dict): kind ('plain' / 'boxes') -> output path
+
+        Returns:
+            hit (bool): False if key isn't cached (or was invalidated) and outputs weren't written
+        """
+        with self.locked_index():
+            index = self.load_index()
+            entry = index.get(key)
+            if entry is None:
+                Metrics.inc('snpm_cache_total', result='miss')
+                return False
+            cached = {kind: Path(self.cache_dir) / name for kind, name in entry['files'].items()}
+            if entry['fingerprint'] != fingerprint or not all(self.is_usable(p) for p in cached.values()):
+                self.logger.info(f'snippet cache entry {key} invalidated. source segments or cached files changed')
+                self.remove_entry(index, key)
+                self.save_index(index)
+                Metrics.inc('snpm_cache_total', result='invalidated')
+                return False
+            for kind, output in outputs.items():
+                if kind in cached:
+                    self.link(cached[kind], output)
+                    # a served snippet is new output. its mtime is what latency checks and retention go by
+                    os.utime(output)
+            entry['last_used'] = time.time()
+            self.save_index(index)
+        Metrics.inc('snpm_cache_total', result='hit')
+        return True
+
+    def store(self, key, fingerprint, outputs) -> None:
+        """adds produced output files (kind -> path, missing ones are skipped) under key"""
+        outputs = {kind: path for kind, path in outputs.items() if os.path.exists(path)}
+        if len(outputs) == 0:
+            return
+        with self.locked_index():
+            index = self.load_index()
+            if key in index:
+                self.remove_entry(index, key)
+            files = {}
+            size = 0
+            for kind, path in outputs.items():
+                name = f'{key}_{kind}.mp4'
+                self.link(path, Path(self.cache_dir) / name)
+                files[kind] = name
+                size += os.path.getsize(path)
+            index[key] = {'files': files, 'size': size, 'last_used': time.time(), 'fingerprint': fingerprint}
+
+            # least recently used entries go first
+            total = sum(entry['size'] for entry in index.values())
+            for old_key in sorted(index, key=lambda k: index[k]['last_used']):
+                if total <= self.max_bytes:
+                    break
+                total -= index[old_key]['size']
+                self.remove_entry(index, old_key)
+                Metrics.inc('snpm_cache_evictions_total')
+            self.save_index(index)
@@ -7,14 +7,24 @@ import os
 
 from moviepy.editor import VideoFileClip, concatenate_videoclips
 
+import time
 import datetime
 import logging
+from bisect import bisect_right
 from dataclasses import dataclass
 
-from pathlib import Path
-
 import cv2
 
+from StreamCopy import StreamCopy
+from SegmentIndex import SegmentIndex
+from MediaProbe import MediaProbe
+from BBoxAnnotator import BBoxAnnotator
+from BBoxInterpolator import BBoxInterpolator
+from BoxStore import BoxStore
+from FramePipeline import FramePipeline
+from SnippetCache import SnippetCache
+from Metrics import Metrics
+
 
 class SnippetGenerator:
 
@@ -25,6 +35,14 @@ class SnippetGenerator:
     video_file_duration_sec = 10 * 60  # duration of the video files in the cam_folder
     video_file_duration = datetime.timedelta(seconds=video_file_duration_sec)
     convert2utc = datetime.timedelta(hours=5)
+    snippet_duration_tolerance_sec = 1.0  # allowed difference between requested and written snippet duration
+    # reencode: exact frame re-encode with moviepy. copy: fast packet copy with ffmpeg.
+    # fused: decode segments once with opencv and write plain + bbox snippets from the same frames
+    snippet_modes = ('reencode', 'copy', 'fused')
+    sequential_read_fail_limit = 4
+    pipeline_queue_size = 4  # frames buffered between the decode, draw and encode threads
+    live_tail_poll_sec = 0.25  # how often the segment still being recorded is probed in live tail mode
+    live_tail_timeout_sec = 15  # max wait for the frames at end_time to land in live tail mode
 
     @dataclass
     class Task:
@@ -33,58 +51,83 @@ class SnippetGenerator:
         start_time: datetime.datetime  # start time
         end_time: datetime.datetime  # end time
         output_file: str  # name of output file
-        bboxes: list  # list of TimeRangeBBoxes to draw/interpolate
+        bboxes: BoxStore  # box updates to draw/interpolate. see create_box_store
+        mode: str = 'reencode'  # one of snippet_modes
+        reencode_head: bool = False  # copy mode only. re-encode partial GOP at start for exact start time
+        write_plain: bool = True  # fused mode only. False writes just the bbox snippet (if there are boxes)
+        live_tail: bool = False  # read the segment still being recorded as soon as end_time frames land in it
+        interpolation: str = 'linear'  # one of BBoxInterpolator.methods. how boxes move between box updates
+        tracking_scale: float = 0.0  # tracker interpolation only. frame scale trackers run at. 0 picks from resolution
+        job_id: int = None  # JobStore task id. None if the task isn't recorded
+        event_type: int = None  # SkaiEvent msg.event the task was made for
+        priority: int = 0  # higher priority tasks are started first. see SnippetManager.Config.event_priorities
 
         def __str__(self):
             return self.output_file
 
+        @property
+        def bbox_output_file(self):
+            return f"{self.output_file.strip('.mp4')}_boxes.mp4"
+
+        @property
+        def outputs(self) -> dict:
+            """output kind -> path of the files the task may write"""
+            return {'plain': self.output_file, 'boxes': self.bbox_output_file}
+
     @classmethod
     def process_task(cls, task):
         """processes task data to make snippet, draw bboxes, etc
         Args:
             task: a SnippetGenerator.Task for storing task data
         """
+        # single decode writing both snippets
+        if task.mode == 'fused':
+            cls.generate_fused_snippet_for_cam(task)
+            return
+
         snippet = cls.generate_snippet_for_cam(cam_folder=task.cam_folder,
                                                start_time=task.start_time,
                                                end_time=task.end_time,
-                                               output_file=task.output_file)
+                                               output_file=task.output_file,
+                                               mode=task.mode,
+                                               reencode_head=task.reencode_head,
+                                               live_tail=task.live_tail)
+
+        # copy mode snippets start on a keyframe so the video start time comes back from the cut
+        video_start_time = snippet if task.mode == 'copy' else task.start_time
 
         # draw bboxes on it final clip before writing out if list is not empty
-        bbox_output_file = f"{task.output_file.strip('.mp4')}_boxes.mp4"
         generate_bbox_video = True
         if generate_bbox_video:
-            cls.draw_bboxes(task.output_file, task, bbox_output_file)
+            cls.draw_bboxes(task.output_file, task, task.bbox_output_file, video_start_time=video_start_time)
 
     @classmethod
     def create_tracker(cls, tracker_type=None):
-        tracker_types = ['BOOSTING', 'MIL', 'KCF', 'TLD', 'MEDIANFLOW', 'GOTURN', 'MOSSE', 'CSRT']
-        if tracker_type is None:
-            tracker_type = 'BOOSTING'  # 'KCF'
-        elif tracker_type not in tracker_types:
-            printmsg = f'{tracker_type} not in tracker types {tracker_types}'
-            cls.logger.error(printmsg)
-            cls.error_logger.error(printmsg)
+        return BBoxAnnotator.create_tracker(tracker_type)
 
-        if tracker_type == 'BOOSTING':
-            return cv2.legacy.TrackerBoosting_create()
-        elif tracker_type == 'MIL':
-            return cv2.TrackerMIL_create()
-        elif tracker_type == 'KCF':
-            return cv2.TrackerKCF_create()
-        elif tracker_type == 'TLD':
-            return cv2.legacy.TrackerTLD_create()
-        elif tracker_type == 'MEDIANFLOW':
-            return cv2.legacy.TrackerMedianFlow_create()
-        elif tracker_type == 'GOTURN':
-            return cv2.TrackerGOTURN_create()
-        elif tracker_type == 'MOSSE':
-            return cv2.legacy.TrackerMOSSE_create()
-        elif tracker_type == "CSRT":
-            return cv2.TrackerCSRT_create()
+    @classmethod
+    def create_box_store(cls, tr_boxes) -> BoxStore:
+        """converts protobuf tr_boxes (TimeRangeBBoxes) to the columnar BoxStore tasks carry"""
+        return BoxStore.from_tr_boxes(tr_boxes, cls.convert_protobuf_ts_to_utc_datetime)
 
     @classmethod
-    def draw_bboxes(cls, input_file, task, output_file, interpolate=True, flip_bbox_xy=False) -> None:
-        """
+    def get_boxes_to_draw(cls, task) -> BoxStore:
+        """gets the task box updates inside the task start / end time"""
+        boxes_to_draw = task.bboxes.select(task.start_time, task.end_time)
+
+        # report bbox timestamps outside start / end time range for the clip
+        skipped = len(task.bboxes) - len(boxes_to_draw)
+        if skipped > 0:
+            printmsg = f'{skipped} bbox updates outside {task.start_time} to {task.end_time}. not drawing those...'
+            cls.logger.warning(printmsg)
+        return boxes_to_draw
+
+    @classmethod
+    def draw_bboxes(cls, input_file, task, output_file, interpolate=True, flip_bbox_xy=False,
+                    video_start_time=None) -> None:
+        """draws task bboxes on input_file and writes to output_file
+        Args:
+            video_start_time (datetime): utc time of first frame in input_file. task start time if None
         """
         test_draw = False
 
@@ -93,24 +136,8 @@ class SnippetGenerator:
             cls.logger.warning('bboxes len is 0. not drawing')
             return
 
-        # verify bboxes  within start / end time
-        boxes_to_draw = []
-        for bbox in task.bboxes:
-            # report bbox timestamps outside start / end time range for the clip
-            ts = cls.convert_protobuf_ts_to_utc_datetime(bbox.timestamp)
-            if ts < task.start_time:
-                printmsg = f'bbox ts {ts} < start time {task.start_time} not drawing...'
-                cls.logger.warning(printmsg)
-                continue
-            if ts > task.end_time:
-                printmsg = f'bbox ts {ts} > end time {task.end_time}. (start time is {task.start_time}) not drawing...'
-                cls.logger.warning(printmsg)
-                continue
-
-            # otherwise save box as box to be drawn
-            boxes_to_draw.append((ts, bbox.bboxes))
-
         # if no boxes to draw, then report and return original snippet
+        boxes_to_draw = cls.get_boxes_to_draw(task)
         if len(boxes_to_draw) == 0:
             printmsg = f'no boxes in time range to draw. returning original snippet'
             cls.logger.warning(printmsg)
@@ -128,51 +155,23 @@ class SnippetGenerator:
             cls.logger.error(f'couldn\'t read frame for input file {input_file}')
             return
         frame_h, frame_w, frame_channels = frame.shape
-        fps = cap.get(cv2.CAP_PROP_FPS)
+        info = MediaProbe.probe(input_file)
+        fps = info.fps if info is not None and info.fps > 0 else cap.get(cv2.CAP_PROP_FPS)
 
         # verify can open output file for writing
-        fourcc = cv2.VideoWriter_fourcc(*'avc1')  # avc1 is for h264
-        out = cv2.VideoWriter(output_file, fourcc, fps, (frame_w, frame_h))
+        out = cls.open_video_writer(output_file, fps, frame_w, frame_h)
         cls.logger.info(f'opened video for bbox drawing: fps: {fps}, resolution: {frame_w} x {frame_h}')
 
-        #### drawing process ####
+        vid_start_time = video_start_time if video_start_time is not None else task.start_time
 
-        # rectangle settings
-        primary_object_color = (0, 255, 0)  # bgr. draw in green
-        associated_objects_colors = {}  # bgr
-        thickness = 2
-
-        tracked_boxes = {}
-        mp4_name_spl = Path(input_file).name.split('_')
-        date_str = '_'.join(mp4_name_spl[1:3])  # join date + start time to string with underscore inbetween
-        vid_start_time = datetime.datetime.strptime(date_str, '%Y-%m-%d_T%H-%M-%S')  # get datetime from string
-
-        read_fail_count = 0
-        sequential_read_fail_limit = 4
-        drew_new_box = False
-        while cap.isOpened():
-            # check previous read success, and read next frame
-            if not read_success:
-                read_fail_count += 1
-                cls.logger.error(f'mp4 read fail. count={read_fail_count}')
-
-                # if sequential fail limit exceeded then break
-                if read_fail_count >= sequential_read_fail_limit:
-                    break
-                # otherwise read another frame and see if read_success at top of loop
-                else:
-                    read_success, frame = cap.read()
-                    continue
-            else:
-                # on read success reset fail counter
-                read_fail_count = 0
-
-            #### alternative check. not needed
-            # if cap.get(cv2.CV_CAP_PROP_POS_FRAMES) == cap.get(cv2.CV_CAP_PROP_FRAME_COUNT):
-            # If the number of captured frames is equal to the total number of frames,
-            # we stop
-            # break
+        #### drawing process ####
+        # boxes are mapped to frame indexes once here so the frame loop only does array lookups
+        annotator = BBoxInterpolator.create_annotator(task.interpolation, boxes_to_draw, frame_w, frame_h,
+                                                      vid_start_time, task.end_time, fps, interpolate=interpolate,
+                                                      flip_bbox_xy=flip_bbox_xy, tracking_scale=task.tracking_scale)
+        draw_t0 = time.perf_counter()
 
+        def draw_frame(frame, k):
             if test_draw:
                 #### drawing test fixed bbox and frame flip ####
                 # flip frame as test and draw static bbox
@@ -181,90 +180,350 @@ class SnippetGenerator:
                 bottom = 400
                 left = 500
                 right = 600
-                cv2.rectangle(frame, (left, top), (right, bottom), primary_object_color, thickness)
+                cv2.rectangle(frame, (left, top), (right, bottom), annotator.primary_object_color,
+                              annotator.thickness)
+                drew_new_box = True
             else:
-                # get time stamp based on milliseconds past start of video from opencv
-                ms_elapsed = cap.get(cv2.CAP_PROP_POS_MSEC)
-                frame_ts = vid_start_time + datetime.timedelta(milliseconds=ms_elapsed)
-                # cls.logger.debug(f'got ms_elapsed: {ms_elapsed} and frame ts: {frame_ts}')
-
-                # frame is hxwxn numpy array
-
-                # get first boxes list to draw
-                #   ts is datetime timestamp in utc
-                #   bboxes is list of skaiproto.interaction.GlobalBBox
-                ts, bboxes = boxes_to_draw[0]
-
-                #### check if first bboxes ts  <= frame_ts to draw protobuf boxes ####
-                if ts <= frame_ts:
-
-                    # delete that first entry now
-                    del boxes_to_draw[0]
-
-                    # draw bboxes for this timestamp
-                    for box in bboxes:
-                        # draw bbox on frame
-                        if flip_bbox_xy:
-                            left = int(box.top * frame_w)
-                            right = int(box.bottom * frame_w)
-                            top = int(box.left * frame_h)
-                            bottom = int(box.right * frame_h)
-                            # shift down by height
-                            bbox_h = bottom - top
-                            top += bbox_h
-                            bottom += bbox_h
-                            
-                        else:
-                            top, bottom = int(box.top * frame_h), int(box.bottom * frame_h)
-                            left, right = int(box.left * frame_w), int(box.right * frame_w)
-
-                        cls.logger.debug(f'rectangles ms_elapsed: {ms_elapsed} and frame ts: {frame_ts}')
-                        cls.logger.debug(
-                            f'drawing rectangle(tlbr pixels): {top}, {left}, {bottom}, {right} on frame...')
-                        cv2.rectangle(frame, (left, top), (right, bottom), primary_object_color, thickness)
-                        cls.logger.debug('rectangle draw success!')
-                        drew_new_box = True
-
-                        # init tracker on bbox if interpolating
-                        if interpolate:
-                            # init tracker with bbox pixels
-                            x, y = left, top
-                            w, h = right - left, bottom - top
-                            tracked_boxes[box.global_id] = cls.create_tracker()
-                            init_bbox = [x, y, w, h]
-                            cls.logger.debug(f'init-ing tracker with bbox(x,y,w,h): {init_bbox}')
-                            tracked_boxes[box.global_id].init(frame, init_bbox)
-
-                #### otherwise use template matching to interpolate bboxes ####
-                elif interpolate:
-                    for global_id in tracked_boxes:
-                        success, bbox = tracked_boxes[global_id].update(frame)
-                        if success:
-                            (x, y, w, h) = [int(v) for v in bbox]
-                            tracker_bbox = [x, y, w, h]
-                            # cls.logger.debug(f'drawing interpolated tracker bbox(x,y,w,h): {tracker_bbox}')
-                            cv2.rectangle(frame, (x, y), (x + w, y + h), primary_object_color, thickness)
-                        else:
-                            printmsg = f'error in tracker'
-                            cls.logger.error(printmsg)
-                            cls.error_logger.error(printmsg)
+                drew_new_box = annotator.annotate(frame, k)
 
             # save frame to output (only write bbox frames if not interpolating)
-            if not interpolate:
-                if drew_new_box:
-                    drew_new_box = False
-                    out.write(frame)
-            else:
-                out.write(frame)
+            return frame if interpolate or drew_new_box else None
+
+        # decode / draw / encode overlap on their own threads. frames are read into buffers already written out
+        pipeline = FramePipeline(cap.read, out.write, first_frame=frame, queue_size=cls.pipeline_queue_size,
+                                 read_fail_limit=cls.sequential_read_fail_limit)
+        try:
+            frame_count = pipeline.run(draw_frame)
+        finally:
+            # close out readers/writers
+            cap.release()
+            out.release()
+        cls.observe_draw_fps(frame_count, time.perf_counter() - draw_t0, 'draw_bboxes')
 
-            # read next frame
-            read_success, frame = cap.read()
+        cls.logger.info('==== bbox writing done ====')
 
-        # close out readers/writers
-        cap.release()
-        out.release()
+    @staticmethod
+    def observe_draw_fps(frame_count, elapsed_sec, path) -> None:
+        """records frames per second of a drawing pass (path is the drawing function)"""
+        Metrics.inc('snpm_draw_frames_total', frame_count, path=path)
+        Metrics.observe('snpm_stage_seconds', elapsed_sec, stage=path)
+        if elapsed_sec > 0:
+            Metrics.observe('snpm_draw_fps', frame_count / elapsed_sec, buckets=Metrics.fps_buckets, path=path)
 
-        cls.logger.info('==== bbox writing done ====')
+    @staticmethod
+    def open_video_writer(output_file, fps, frame_w, frame_h):
+        fourcc = cv2.VideoWriter_fourcc(*'avc1')  # avc1 is for h264
+        return cv2.VideoWriter(output_file, fourcc, fps, (frame_w, frame_h))
+
+    @classmethod
+    def iter_segment_frames(cls, cam_folder, relevant_tds, start_time, end_time):
+        """decodes frames from start_time to end_time straight from the camera segments
+
+        Args:
+            cam_folder (str): camera folder path
+            relevant_tds (list): (start_time, duration) tuples of the segments overlapping the range
+            start_time (datetime): first frame time
+            end_time (datetime): frames at or after end_time are not returned
+
+        Yields:
+            (frame_ts, frame, fps): utc datetime of frame, hxwxn frame, fps of the segment it came from
+        """
+        for t, d in relevant_tds:
+            filepath = f'{cam_folder}/{t.strftime(cls.dateformat)}.mp4'
+            cap = cv2.VideoCapture(filepath)
+            if not cap.isOpened():
+                printmsg = f'segment {filepath} didn\'t open. skipping it'
+                cls.logger.error(printmsg)
+                cls.error_logger.error(printmsg)
+                continue
+            info = MediaProbe.probe(filepath)
+            fps = info.fps if info is not None and info.fps > 0 else cap.get(cv2.CAP_PROP_FPS)
+
+            # seek to start and stop at end of range or where the next segment takes over
+            start_ms = (start_time - t).total_seconds() * 1000
+            end_ms = min((end_time - t).total_seconds(), d.total_seconds()) * 1000
+            if start_ms > 0:
+                cap.set(cv2.CAP_PROP_POS_MSEC, start_ms)
+
+            read_fail_count = 0
+            while read_fail_count < cls.sequential_read_fail_limit:
+                read_success, frame = cap.read()
+                if not read_success:
+                    read_fail_count += 1
+                    continue
+                read_fail_count = 0
+                ms_elapsed = cap.get(cv2.CAP_PROP_POS_MSEC)
+                if ms_elapsed < start_ms:
+                    continue
+                if ms_elapsed >= end_ms:
+                    break
+                yield t + datetime.timedelta(milliseconds=ms_elapsed), frame, fps
+            cap.release()
+
+    class FusedOutput:
+        """plain and / or bbox snippet writers for one snippet fed from a shared decode (see write_fused_snippets)"""
+
+        def __init__(self, start_time, end_time, output_file=None, bbox_output_file=None, boxes_to_draw=None,
+                     interpolate=True, flip_bbox_xy=False, interpolation='linear', tracking_scale=0.0) -> None:
+            """
+            Args:
+                start_time (datetime): first frame time of this snippet
+                end_time (datetime): frames at or after end_time are not written
+                output_file (str): plain snippet output file. not written if None
+                bbox_output_file (str): bbox snippet output file. not written if None or no boxes_to_draw
+                boxes_to_draw (BoxStore): box updates to draw. see get_boxes_to_draw
+                interpolation (str): one of BBoxInterpolator.methods
+                tracking_scale (float): tracker interpolation only. see BBoxAnnotator
+            """
+            self.start_time = start_time
+            self.end_time = end_time
+            self.output_file = output_file
+            boxes_to_draw = boxes_to_draw if boxes_to_draw is not None else BoxStore.empty()
+            self.bbox_output_file = bbox_output_file if len(boxes_to_draw) > 0 else None
+            self.boxes_to_draw = boxes_to_draw
+            self.interpolate = interpolate
+            self.flip_bbox_xy = flip_bbox_xy
+            self.interpolation = interpolation
+            self.tracking_scale = tracking_scale
+            self.out, self.bbox_out, self.annotator = None, None, None
+            self.actual_start_time = None  # time of the first frame written
+            self.frame_count = 0
+
+        def __str__(self):
+            return str(self.output_file or self.bbox_output_file)
+
+        def has_outputs(self) -> bool:
+            return self.output_file is not None or self.bbox_output_file is not None
+
+        def wants(self, frame_ts) -> bool:
+            return self.start_time <= frame_ts < self.end_time
+
+        def open(self, frame, frame_ts, fps) -> None:
+            """opens writers using first frame"""
+            self.actual_start_time = frame_ts
+            frame_h, frame_w = frame.shape[:2]
+            if self.output_file is not None:
+                self.out = SnippetGenerator.open_video_writer(self.output_file, fps, frame_w, frame_h)
+            if self.bbox_output_file is not None:
+                self.bbox_out = SnippetGenerator.open_video_writer(self.bbox_output_file, fps, frame_w, frame_h)
+                self.annotator = BBoxInterpolator.create_annotator(self.interpolation, self.boxes_to_draw,
+                                                                   frame_w, frame_h, frame_ts, self.end_time, fps,
+                                                                   interpolate=self.interpolate,
+                                                                   flip_bbox_xy=self.flip_bbox_xy,
+                                                                   tracking_scale=self.tracking_scale)
+
+        def write_plain(self, frame, frame_ts, fps) -> None:
+            if self.actual_start_time is None:
+                self.open(frame, frame_ts, fps)
+            if self.out is not None:
+                self.out.write(frame)
+            self.frame_count += 1
+
+        def write_boxes(self, frame) -> None:
+            """draws boxes on frame in place and writes it. call after write_plain of the same frame"""
+            if self.bbox_out is None:
+                return
+            drew_new_box = self.annotator.annotate(frame, self.frame_count - 1)
+            # only write bbox frames if not interpolating
+            if self.interpolate or drew_new_box:
+                self.bbox_out.write(frame)
+
+        def release(self) -> None:
+            for writer in (self.out, self.bbox_out):
+                if writer is not None:
+                    writer.release()
+
+    @classmethod
+    def write_fused_snippets(cls, cam_folder, relevant_tds, start_time, end_time, outputs) -> None:
+        """decodes the segments once from start_time to end_time and writes every FusedOutput from the same frames
+
+        Args:
+            relevant_tds (list): (start_time, duration) tuples of the segments overlapping start_time to end_time
+            outputs (list): SnippetGenerator.FusedOutput list with ranges inside start_time to end_time
+        """
+        outputs = [o for o in outputs if o.has_outputs()]
+        if len(outputs) == 0:
+            cls.logger.warning('fused snippet has nothing to write')
+            return
+
+        draw_t0 = time.perf_counter()
+        frame_count = 0
+        # segments are decoded ahead on a background thread while frames are written
+        frames = FramePipeline.prefetch(cls.iter_segment_frames(cam_folder, relevant_tds, start_time, end_time),
+                                        queue_size=cls.pipeline_queue_size)
+        for frame_ts, frame, fps in frames:
+            if frame_count == 0:
+                frame_h, frame_w = frame.shape[:2]
+                cls.logger.info(f'opened segments for fused snippet: fps: {fps}, resolution: {frame_w} x {frame_h}')
+            frame_count += 1
+            active = [o for o in outputs if o.wants(frame_ts)]
+
+            # plain frames go out before boxes are drawn on them in place
+            for o in active:
+                o.write_plain(frame, frame_ts, fps)
+
+            # boxes of one output must not show up in another so all but the last draw on a copy
+            bbox_active = [o for o in active if o.bbox_out is not None]
+            for k, o in enumerate(bbox_active):
+                o.write_boxes(frame if k == len(bbox_active) - 1 else frame.copy())
+
+        for o in outputs:
+            o.release()
+            if o.actual_start_time is None:
+                printmsg = f'no frames read from {cam_folder} for {o.start_time} to {o.end_time}!'
+                cls.logger.error(printmsg)
+                cls.error_logger.error(printmsg)
+        cls.observe_draw_fps(frame_count, time.perf_counter() - draw_t0, 'write_fused_snippets')
+        cls.logger.info(f'==== fused snippet writing done ({frame_count} frames, {len(outputs)} outputs) ====')
+
+    @classmethod
+    def write_fused_snippet(cls, cam_folder, relevant_tds, start_time, end_time, output_file=None,
+                            bbox_output_file=None, boxes_to_draw=None, interpolate=True, flip_bbox_xy=False):
+        """decodes the segments once and writes the plain and / or bbox snippet from the same frames
+
+        Args:
+            output_file (str): plain snippet output file. not written if None
+            bbox_output_file (str): bbox snippet output file. not written if None or no boxes_to_draw
+            boxes_to_draw (BoxStore): box updates to draw. see get_boxes_to_draw
+
+        Returns:
+            actual_start_time (datetime): time of the first frame written. None if no frames were read
+        """
+        output = cls.FusedOutput(start_time, end_time, output_file=output_file, bbox_output_file=bbox_output_file,
+                                 boxes_to_draw=boxes_to_draw, interpolate=interpolate, flip_bbox_xy=flip_bbox_xy)
+        cls.write_fused_snippets(cam_folder, relevant_tds, start_time, end_time, [output])
+        return output.actual_start_time
+
+    @classmethod
+    def get_fused_output(cls, task, interpolate=True, flip_bbox_xy=False):
+        """gets FusedOutput for task. plain snippet is written anyway if there are no boxes to draw"""
+        boxes_to_draw = cls.get_boxes_to_draw(task)
+        if len(boxes_to_draw) == 0:
+            cls.logger.warning(f'no boxes in time range to draw for {task}. writing plain snippet only')
+        write_plain = task.write_plain or len(boxes_to_draw) == 0
+        return cls.FusedOutput(task.start_time, task.end_time,
+                               output_file=task.output_file if write_plain else None,
+                               bbox_output_file=task.bbox_output_file,
+                               boxes_to_draw=boxes_to_draw,
+                               interpolate=interpolate,
+                               flip_bbox_xy=flip_bbox_xy,
+                               interpolation=task.interpolation,
+                               tracking_scale=task.tracking_scale)
+
+    @classmethod
+    def validate_fused_output(cls, output) -> None:
+        """raises if the written plain snippet of output is unreadable or the wrong duration"""
+        if output.actual_start_time is not None and output.output_file is not None:
+            cls.validate_snippet(output.output_file, output.end_time - output.actual_start_time, raise_error=True)
+
+    @classmethod
+    def generate_fused_snippet_for_cam(cls, task, interpolate=True, flip_bbox_xy=False):
+        """single decode version of generate_snippet_for_cam + draw_bboxes for task
+
+        Returns:
+            actual_start_time (datetime): time of the first frame written
+        """
+        relevant_tds = cls.get_snippet_relevant_tds(task.cam_folder, task.start_time, task.end_time,
+                                                    live_tail=task.live_tail)
+        output = cls.get_fused_output(task, interpolate=interpolate, flip_bbox_xy=flip_bbox_xy)
+        cls.write_fused_snippets(task.cam_folder, relevant_tds, task.start_time, task.end_time, [output])
+        cls.validate_fused_output(output)
+        return output.actual_start_time
+
+    @classmethod
+    def get_cache_entries(cls, tasks) -> dict:
+        """id(task) -> (key, fingerprint) in the process snippet cache of tasks of one camera folder
+
+        the segments of all the task ranges are looked up in one segment index query. tasks are left out
+        if not caching or their segments can't be listed
+        """
+        if SnippetCache.instance is None:
+            return {}
+        try:
+            relevant_tds_list = cls.get_relevant_times_and_durations_for_ranges(
+                tasks[0].cam_folder, [(t.start_time, t.end_time) for t in tasks])
+        except Exception as e:
+            cls.logger.warning(f'not caching {len(tasks)} tasks of {tasks[0].cam_folder}: {e!r}')
+            return {}
+        entries = {}
+        for task, relevant_tds in zip(tasks, relevant_tds_list):
+            try:
+                segment_files = [f'{task.cam_folder}/{t.strftime(cls.dateformat)}.mp4' for t, _d in relevant_tds]
+                key = SnippetCache.get_key(task, task.bboxes.select(task.start_time, task.end_time))
+                entries[id(task)] = key, SnippetCache.get_fingerprint(segment_files)
+            except Exception as e:
+                cls.logger.warning(f'not caching {task}: {e!r}')
+        return entries
+
+    @classmethod
+    def process_task_group(cls, tasks):
+        """processes tasks, serving the ones with identical snippets already made from the snippet cache
+
+        Args:
+            tasks (list): SnippetGenerator.Task list with the same cam_folder. see generate_task_group
+
+        Returns:
+            failures (dict): output file name -> exception of the tasks whose snippets failed validation
+        """
+        cache = SnippetCache.instance
+        cache_entries = cls.get_cache_entries(tasks)
+        misses = []
+        for task in tasks:
+            entry = cache_entries.get(id(task))
+            if entry is not None and cache.fetch(*entry, task.outputs):
+                cls.logger.info(f'served {task} from snippet cache')
+                continue
+            if entry is not None:
+                cache.detach(task.outputs.values())
+            misses.append(task)
+        if len(misses) == 0:
+            return {}
+
+        failures = cls.generate_task_group(misses)
+        for task in misses:
+            entry = cache_entries.get(id(task))
+            # a bad encode in the cache would be served to every identical task after it
+            if entry is not None and str(task) not in failures and cls.validate_outputs(task):
+                cache.store(*entry, task.outputs)
+        return failures
+
+    @classmethod
+    def validate_outputs(cls, task) -> bool:
+        """checks every output file task wrote exists and has frames"""
+        written = [path for path in task.outputs.values() if os.path.exists(path)]
+        return len(written) > 0 and all(cls.validate_snippet(path) for path in written)
+
+    @classmethod
+    def generate_task_group(cls, tasks):
+        """processes fused mode tasks of one camera folder with overlapping time ranges
+
+        the union of the task time ranges is decoded once and every task's snippets are written from it
+        Args:
+            tasks (list): SnippetGenerator.Task list with the same cam_folder
+
+        Returns:
+            failures (dict): output file name -> exception of the tasks whose snippets failed validation.
+                errors failing the whole group (e.g. the range isn't recorded) are raised
+        """
+        if len(tasks) == 1:
+            cls.process_task(tasks[0])
+            return {}
+        cam_folder = tasks[0].cam_folder
+        start_time = min(t.start_time for t in tasks)
+        end_time = max(t.end_time for t in tasks)
+        cls.logger.info(f'coalesced {len(tasks)} tasks into one decode: {[str(t) for t in tasks]}')
+
+        relevant_tds = cls.get_snippet_relevant_tds(cam_folder, start_time, end_time,
+                                                    live_tail=any(t.live_tail for t in tasks))
+        outputs = [cls.get_fused_output(t) for t in tasks]
+        cls.write_fused_snippets(cam_folder, relevant_tds, start_time, end_time, outputs)
+        failures = {}
+        for task, output in zip(tasks, outputs):
+            try:
+                cls.validate_fused_output(output)
+            except Exception as e:
+                failures[str(task)] = e
+        return failures
 
     @classmethod
     def draw_on_frame(frame, t):
@@ -296,11 +555,76 @@ class SnippetGenerator:
 
     @classmethod
     def get_video_file_duration(cls, cam_folder, start_time):
-        """ get video file duration from cam folder and start time
+        """ get video file duration from cam folder and start time. None if the file can't be probed
         """
         filename = f'{start_time.strftime(cls.dateformat)}.mp4'
         filepath = f'{cam_folder}/{filename}'
-        return datetime.timedelta(seconds=VideoFileClip(filepath).duration)
+        info = MediaProbe.probe(filepath)
+        if info is None:
+            return None
+        return datetime.timedelta(seconds=info.duration)
+
+    @classmethod
+    def get_clip_end_sec(cls, filepath, duration):
+        """gets subclip end time (sec) for a whole file. expected duration capped at the probed file duration"""
+        end_sec = duration.total_seconds()
+        info = MediaProbe.probe(filepath)
+        if info is not None and 0 < info.duration < end_sec:
+            cls.logger.debug(f'{filepath} is {info.duration} sec, shorter than expected {end_sec} sec')
+            end_sec = info.duration
+        return end_sec
+
+    @classmethod
+    def validate_snippet(cls, output_file, expected_duration=None, raise_error=False) -> bool:
+        """checks written snippet duration against the expected duration (datetime.timedelta)
+
+        None expected_duration only checks the snippet exists and has frames
+        Args:
+            raise_error (bool): raise instead of returning False, so the task is marked failed with the reason
+        """
+        info = MediaProbe.probe(output_file) if os.path.isfile(output_file) else None
+        if info is None:
+            printmsg = f'written snippet {output_file} could not be probed!'
+            reason = 'snippet_unreadable'
+        elif expected_duration is None:
+            if info.frame_count > 0 or info.duration > 0:
+                return True
+            printmsg = f'written snippet {output_file} has no frames!'
+            reason = 'snippet_empty'
+        else:
+            expected_sec = expected_duration.total_seconds()
+            if abs(info.duration - expected_sec) <= cls.snippet_duration_tolerance_sec:
+                cls.logger.debug(f'snippet {output_file}: {info}')
+                return True
+            printmsg = f'written snippet {output_file} is {info.duration:.2f} sec, expected {expected_sec:.2f} sec'
+            reason = 'snippet_duration'
+        cls.logger.error(printmsg)
+        cls.error_logger.error(printmsg)
+        Metrics.inc('snpm_task_failures_total', reason=reason)
+        if raise_error:
+            raise Exception(printmsg)
+        return False
+
+    @classmethod
+    def get_segment_index(cls, cam_folder) -> SegmentIndex:
+        """gets the long lived segment index for cam_folder with the last segment end set to now
+
+        Raises:
+            FileNotFoundError: if cam_folder doesn't exist on local path
+            Exception: if cam_folder contains no valid mp4 files
+        """
+        # query the long lived per camera index. only re-lists the folder when it changed
+        with Metrics.timer('snpm_stage_seconds', stage='segment_index'):
+            index = SegmentIndex.for_cam_folder(cam_folder, cls.mp4_dateformat)
+        if len(index) == 0:
+            exception_msg = f'there are no mp4 files in directory: {cam_folder}'
+            cls.error_logger.exception(exception_msg)
+            raise Exception(exception_msg)
+
+        # last file is still being recorded so its duration is based on current time
+        current_dt_utc = datetime.datetime.now() + cls.convert2utc
+        index.set_last_segment_end(current_dt_utc - datetime.timedelta(seconds=3))
+        return index
 
     @classmethod
     def get_mp4_start_times_and_durations(cls, cam_folder) -> list:
@@ -319,41 +643,7 @@ class SnippetGenerator:
             FileNotFoundError: if cam_folder doesn't exist on local path
             Exception: if cam_folder contains no valid mp4 files
         """
-        # verify mp4 files in directory and spaced apart by video_file_duration_sec
-        all_files = os.listdir(cam_folder)
-        mp4_files = [f for f in all_files if f.endswith('.mp4')]
-        if len(mp4_files) == 0:
-            exception_msg = f'there are no mp4 files in directory: {cam_folder}'
-            cls.error_logger.exception(exception_msg)
-            raise Exception(exception_msg)
-
-        # get 10 min video start times from mp4 file names
-        cls.logger.debug(f'loading mp4 start times from folder {cam_folder}...')
-        mp4_start_times = []
-        for f in mp4_files:
-            dt_object = cls.get_mp4_start_time(f)
-            mp4_start_times.append(dt_object)
-
-        # sort in chronological order
-        mp4_start_times = sorted(mp4_start_times)
-
-        # calc durations using time between start times
-        mp4_start_times_and_durations = []
-        if len(mp4_start_times) == 1:
-            t = mp4_start_times[0]
-        else:
-            last_t = mp4_start_times[0]
-            for t in mp4_start_times[1:]:
-                duration = t - last_t
-                mp4_start_times_and_durations.append((last_t, duration))
-                last_t = t
-
-        # last file duration based on min expected file duration vs reported
-        vidfile_duration = cls.get_video_file_duration(cam_folder, t)
-        current_dt_utc = datetime.datetime.now() + cls.convert2utc
-        # duration = min(current_dt_utc - t, vidfile_duration)
-        duration = current_dt_utc - t - datetime.timedelta(seconds=3)  #, vidfile_duration)
-        mp4_start_times_and_durations.append((t, duration))
+        mp4_start_times_and_durations = cls.get_segment_index(cam_folder).get_start_times_and_durations()
 
         # debug print and return
         cls.logger.debug('got these sorted mp4 start times & durations: ')
@@ -365,39 +655,28 @@ class SnippetGenerator:
     def get_relevant_times_and_durations(cls, mp4_start_times_and_durations, start_time, end_time) -> list:
         """assemble list of mp4 file time/durations that overlap the start/end time range
         Args:
+            mp4_start_times_and_durations (list): sorted (start_time, duration) tuples. see get_mp4_start_times_and_durations
+            start_time (datetime): range start time
+            end_time (datetime): range end time
         Return:
-        Raises:
+            relevant_tds (list): the (start_time, duration) tuples overlapping the range
         """
+        # bisect the list itself on segment end times like SegmentIndex.find_range. no index is built per call
+        i = bisect_right(mp4_start_times_and_durations, start_time, key=lambda td: td[0] + td[1])
+        j = min(bisect_right(mp4_start_times_and_durations, end_time, i, key=lambda td: td[0] + td[1]) + 1,
+                len(mp4_start_times_and_durations))
+        return mp4_start_times_and_durations[i:max(i, j)]
 
-        # init vars
-        relevant_tds = []
-        found_start = False
-        found_end = False
-        cls.logger.debug(f'looking for start time {start_time}...')
-        for t, d in mp4_start_times_and_durations:
-            file_end_time = t + d
-            t_range_info = f'{t} - {file_end_time} ({d})'
-            if not found_start:
-                if (start_time - t) < d:
-                    found_start = True
-                    cls.logger.debug(f'  found mp4 start time in: {t_range_info}')
-                    cls.logger.debug(f'looking for end time {end_time}...')
-                else:
-                    cls.logger.debug(f'  start_time not found in: {t_range_info}')
-                    continue
-
-            if found_start and (not found_end):
-                relevant_tds.append((t, d))
-                if (end_time - t) < d:
-                    cls.logger.debug(f'  found mp4 end time in: {t_range_info}')
-                    found_end = True
-                    break
-                else:
-                    cls.logger.debug(f'  end_time not found in: {t_range_info}')
-            else:
-                break
-
-        return relevant_tds
+    @classmethod
+    def get_relevant_times_and_durations_for_ranges(cls, cam_folder, time_ranges) -> list:
+        """looks up the mp4 file time/durations overlapping each (start_time, end_time) range in one index query
+        Args:
+            cam_folder (str): camera folder path
+            time_ranges (list): list of (start_time, end_time) datetime tuples
+        Return:
+            relevant_tds_list (list): list of relevant_tds (see get_relevant_times_and_durations) per time range
+        """
+        return cls.get_segment_index(cam_folder).lookup_ranges(time_ranges)
 
     @classmethod
     def assemble_video_snippet(cls, cam_folder, relevant_tds, start_time, end_time):
@@ -448,7 +727,7 @@ class SnippetGenerator:
             # make first video to clip from start_time until end
             first_video = VideoFileClip(f'{cam_folder}/{first_file}')
             clip_start_t_sec = (start_time - first_file_time).total_seconds()
-            clip_end_t_sec = first_duration.total_seconds()
+            clip_end_t_sec = cls.get_clip_end_sec(f'{cam_folder}/{first_file}', first_duration)
             first_clip = first_video.subclip(clip_start_t_sec, clip_end_t_sec)
 
             # make last clip from beginning to end_time
@@ -464,7 +743,7 @@ class SnippetGenerator:
                 filename = f'{t.strftime(cls.dateformat)}.mp4'
                 filepath = f'{cam_folder}/{filename}'
                 clip_start_t_sec = 0
-                clip_end_t_sec = d.total_seconds()
+                clip_end_t_sec = cls.get_clip_end_sec(filepath, d)
                 middle_videos.append(VideoFileClip(filepath).subclip(clip_start_t_sec, clip_end_t_sec))
 
             clip_list = [first_clip, *middle_videos, last_clip]
@@ -473,7 +752,54 @@ class SnippetGenerator:
             return concatenate_videoclips(clip_list)
 
     @classmethod
-    def generate_snippet_for_cam(cls, cam_folder, start_time, end_time, output_file=None) -> str:
+    def wait_for_live_tail(cls, cam_folder, end_time, timeout_sec=None):
+        """waits for the segment still being recorded to hold frames up to end_time
+
+        the growing segment is probed until its duration covers end_time. this needs a recording
+        that is readable while it is written (e.g. fragmented mp4). the probe cache is keyed on
+        file size so every poll sees the file as it grows.
+        Args:
+            cam_folder (str): camera folder path
+            end_time (datetime): time the last frame needed
+            timeout_sec (float): max wait. defaults to live_tail_timeout_sec
+        Return:
+            index (SegmentIndex): segment index with the last segment end set to the recorded end.
+                None if end_time wasn't recorded before the timeout
+        """
+        timeout_sec = cls.live_tail_timeout_sec if timeout_sec is None else timeout_sec
+        deadline = time.monotonic() + timeout_sec
+        probe_failed = False
+        while True:
+            # a new segment may start while waiting so the index is refreshed every poll
+            index = cls.get_segment_index(cam_folder)
+            last_t = SegmentIndex.ns_to_datetime(index.starts[-1])
+            filepath = f'{cam_folder}/{last_t.strftime(cls.dateformat)}.mp4'
+            info = MediaProbe.probe(filepath, quiet=True)
+            if info is not None:
+                recorded_end = last_t + datetime.timedelta(seconds=info.duration)
+                if recorded_end >= end_time:
+                    index.set_last_segment_end(recorded_end)
+                    cls.logger.debug(f'live tail: {filepath} recorded up to {recorded_end}')
+                    return index
+            elif not probe_failed:
+                probe_failed = True
+                cls.logger.warning(f'live tail: {filepath} can\'t be read while recording. '
+                                   f'is the recorder writing fragmented mp4?')
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(cls.live_tail_poll_sec)
+
+    @classmethod
+    def get_snippet_relevant_tds(cls, cam_folder, start_time, end_time, live_tail=False) -> list:
+        """verifies start_time to end_time is recorded in cam folder and gets the overlapping segments
+        Args:
+            live_tail (bool): wait for end_time frames to land in the segment still being recorded
+                instead of failing if end_time is past the estimated recording end
+        Return:
+            relevant_tds (list): (start_time, duration) tuples of the segments overlapping the range
+        Raises:
+            Exception: if the range is invalid or not (yet) recorded in cam folder
+        """
         # take in datetime objects
         t1_str = start_time.strftime(cls.dateformat)
         t2_str = end_time.strftime(cls.dateformat)
@@ -487,18 +813,23 @@ class SnippetGenerator:
             cls.error_logger.exception(printmsg)
             raise Exception(printmsg)
 
-        # get start times list in datetime format from cam folder
-        mp4_start_times_and_durations = cls.get_mp4_start_times_and_durations(cam_folder)
+        # get segment index for cam folder
+        index = cls.get_segment_index(cam_folder)
 
         # verify start_time is not before first start time
-        mp4_list_first_time = mp4_start_times_and_durations[0][0]
+        mp4_list_first_time = SegmentIndex.ns_to_datetime(index.starts[0])
         if start_time < mp4_list_first_time:
             printmsg = f'start time {start_time} is less than mp4 list first time {mp4_list_first_time}'
             cls.error_logger.exception(printmsg)
             raise Exception(printmsg)
 
-        last_start_t, last_dur = mp4_start_times_and_durations[-1]
-        mp4_list_last_time = last_start_t + last_dur
+        mp4_list_last_time = SegmentIndex.ns_to_datetime(index.ends[-1])
+        if end_time > mp4_list_last_time and live_tail:
+            cls.logger.info(f'live tail: waiting for {end_time} to be recorded')
+            live_index = cls.wait_for_live_tail(cam_folder, end_time)
+            if live_index is not None:
+                index = live_index
+                mp4_list_last_time = SegmentIndex.ns_to_datetime(index.ends[-1])
         if end_time > mp4_list_last_time:
             printmsg = f'end time {end_time} is greater than mp4 list last time {mp4_list_last_time}'
             cls.error_logger.exception(printmsg)
@@ -506,7 +837,7 @@ class SnippetGenerator:
 
         # assemble list of mp4 file (start_time, duration) tuples that
         # overlap the start_time to end_time range
-        relevant_tds = cls.get_relevant_times_and_durations(mp4_start_times_and_durations, start_time, end_time)
+        relevant_tds = index.lookup(start_time, end_time)
         cls.logger.info(f'relevant start times for {t1_str} to {t2_str}:')
         [cls.logger.info(f'  {t} ({d})') for (t, d) in relevant_tds]
         if len(relevant_tds) == 0:
@@ -514,8 +845,56 @@ class SnippetGenerator:
             cls.logger.error(printmsg)
             raise Exception(printmsg)
 
+        return relevant_tds
+
+    @classmethod
+    def generate_snippet_for_cam(cls, cam_folder, start_time, end_time, output_file=None, mode='reencode',
+                                 reencode_head=False, live_tail=False):
+        """generates snippet for cam folder from start_time to end_time
+        Args:
+            mode (str): one of snippet_modes. 'reencode' decodes and re-encodes every frame with moviepy.
+                'copy' cuts / joins segments at packet level with ffmpeg (requires output_file).
+                'fused' decodes with opencv and writes frames straight out (requires output_file)
+            reencode_head (bool): copy mode only. re-encode the partial GOP before the first keyframe
+            live_tail (bool): read the segment still being recorded once end_time frames land in it
+        Return:
+            final_snippet (VideoFileClip): moviepy snippet if mode is 'reencode'
+            actual_start_time (datetime): time of the first frame written to output_file if mode is 'copy' or 'fused'
+        """
+        if mode not in cls.snippet_modes:
+            printmsg = f'unknown snippet mode {mode}. choices are {cls.snippet_modes}'
+            cls.error_logger.error(printmsg)
+            raise Exception(printmsg)
+        if mode != 'reencode' and not output_file:
+            printmsg = f'{mode} mode needs an output file to write to!'
+            cls.error_logger.error(printmsg)
+            raise Exception(printmsg)
+
+        relevant_tds = cls.get_snippet_relevant_tds(cam_folder, start_time, end_time, live_tail=live_tail)
+
+        # single decode path with no boxes to draw
+        if mode == 'fused':
+            cls.logger.info(f'now writing decoded snippet out to: {output_file}')
+            actual_start_time = cls.write_fused_snippet(cam_folder, relevant_tds, start_time, end_time,
+                                                        output_file=output_file)
+            if actual_start_time is not None:
+                cls.validate_snippet(output_file, end_time - actual_start_time, raise_error=True)
+            return actual_start_time
+
+        # fast path. cut at packet level with no decode / re-encode
+        if mode == 'copy':
+            cls.logger.info(f'now stream copying final snippet out to: {output_file}')
+            with Metrics.timer('snpm_stage_seconds', stage='stream_copy'):
+                actual_start_time = StreamCopy.cut_snippet_from_tds(cam_folder, relevant_tds, start_time, end_time,
+                                                                    output_file, cls.dateformat,
+                                                                    reencode_head=reencode_head)
+            cls.logger.info(f'==== finished video snippet copy (starts at {actual_start_time}) ====')
+            cls.validate_snippet(output_file, end_time - actual_start_time, raise_error=True)
+            return actual_start_time
+
         # now assemble video snippet
-        final_snippet = cls.assemble_video_snippet(cam_folder, relevant_tds, start_time, end_time)
+        with Metrics.timer('snpm_stage_seconds', stage='assemble_video_snippet'):
+            final_snippet = cls.assemble_video_snippet(cam_folder, relevant_tds, start_time, end_time)
         if final_snippet is None:
             printmsg = f'video snippet could not be assembled!'
             cls.logger.error(printmsg)
@@ -526,8 +905,10 @@ class SnippetGenerator:
         # write final video snippet to file if desired
         if output_file:
             cls.logger.info(f'now writing final snippet out to: {output_file}')
-            final_snippet.write_videofile(output_file)
+            with Metrics.timer('snpm_stage_seconds', stage='write_videofile'):
+                final_snippet.write_videofile(output_file)
             cls.logger.info('==== finished video snippet writing ====')
+            cls.validate_snippet(output_file, end_time - start_time, raise_error=True)
 
         # return final snippet
         return final_snippet
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+from Metrics import Metrics
+
+
+class SnippetRetention:
+    """catalog of produced snippet files and quota driven eviction of the oldest ones
+
+    finished tasks are added to a sqlite catalog (path, size, time, event type) so eviction
+    queries the catalog instead of walking the /snippets tree. the tree is walked once, to
+    catalog files written before the catalog existed. a background thread deletes files past
+    the age quotas (overall and per event type) and the oldest files past the size quotas
+    (total and per event type), a batch at a time, and removes the folders it empties.
+    outputs hardlinked with the snippet cache free no disk when deleted, so they don't count
+    towards the bytes a size quota needs freed.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    flush_sec = 5  # how often added files are written to the catalog
+    evict_sec = 60  # how often quotas are checked
+    evict_batch = 200  # max files deleted per query per pass, so a pass never blocks for long
+    skip_names = ('.cache', )  # folders under root that aren't snippet output (see SnippetCache)
+    event_folder_re = re.compile(r'^E(-?\d+)$')
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            event_type INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS files_created ON files (created_at);
+        CREATE INDEX IF NOT EXISTS files_event_created ON files (event_type, created_at);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+
+    def __init__(self, root, catalog_file, max_bytes=0, max_age_sec=0, event_max_bytes=None,
+                 event_max_age_sec=None) -> None:
+        """
+        Args:
+            root (str): snippet output folder. e.g. /snippets
+            catalog_file (str): sqlite catalog. shards writing to the same root share it
+            max_bytes (int): max total size of the cataloged files. <= 0 unbounded
+            max_age_sec (float): files older than this are deleted. <= 0 kept forever
+            event_max_bytes (dict): event type -> max total size of that type's files
+            event_max_age_sec (dict): event type -> max age of that type's files. overrides max_age_sec
+        """
+        self.root = root
+        self.catalog_file = catalog_file
+        self.max_bytes = max_bytes
+        self.max_age_sec = max_age_sec
+        self.event_max_bytes = event_max_bytes or {}
+        self.event_max_age_sec = event_max_age_sec or {}
+        self.added = queue.Queue()  # (path, size, created_at, event_type) waiting for the catalog
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self) -> None:
+        """starts the background catalog / eviction thread"""
+        self.thread = threading.Thread(name='snip_mgr_retention', target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def add(self, task) -> None:
+        """catalogs the output files of a finished task. called from the handler thread"""
+        now = time.time()
+        for path in task.outputs.values():
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue  # output kind the task didn't write
+            self.added.put((path, size, now, task.event_type))
+
+    def connect(self):
+        conn = sqlite3.connect(self.catalog_file, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(self.schema)
+        conn.commit()
+        return conn
+
+    def run(self) -> None:
+        try:
+            conn = self.connect()
+            if conn.execute("SELECT value FROM meta WHERE key = 'bootstrapped'").fetchone() is None:
+                self.bootstrap(conn)
+        except Exception as e:
+            printmsg = f'snippet retention could not open catalog {self.catalog_file}: {e!r}. not evicting'
+            self.logger.error(printmsg)
+            self.error_logger.error(printmsg)
+            return
+
+        next_evict = 0
+        while True:
+            try:
+                self.flush(conn)
+                if time.monotonic() >= next_evict:
+                    self.evict(conn)
+                    next_evict = time.monotonic() + self.evict_sec
+            except Exception as e:
+                self.logger.exception(e)
+                self.error_logger.exception(e)
+            if self.stop_event.wait(self.flush_sec):
+                break
+        self.flush(conn)
+        conn.close()
+
+    def bootstrap(self, conn) -> None:
+        """catalogs the files already in root. the only walk of the tree"""
+        self.logger.info(f'cataloging existing snippets in {self.root}')
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d not in self.skip_names]
+            event_type = None
+            for part in Path(dirpath).relative_to(self.root).parts:
+                match = self.event_folder_re.match(part)
+                if match:
+                    event_type = int(match.group(1))
+            rows = []
+            for filename in filenames:
+                if not filename.endswith('.mp4'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                rows.append((os.path.join(dirpath, filename), stat.st_size, stat.st_mtime, event_type))
+            conn.executemany('INSERT OR IGNORE INTO files (path, size, created_at, event_type) VALUES (?, ?, ?, ?)',
+                             rows)
+            count += len(rows)
+            if self.stop_event.is_set():
+                conn.commit()
+                return  # walk again next start
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('bootstrapped', ?)", (str(time.time()), ))
+        conn.commit()
+        self.logger.info(f'cataloged {count} existing snippet files')
+
+    def flush(self, conn) -> None:
+        rows = []
+        try:
+            while True:
+                rows.append(self.added.get_nowait())
+        except queue.Empty:
+            pass
+        if len(rows) > 0:
+            conn.executemany('INSERT OR REPLACE INTO files (path, size, created_at, event_type) VALUES (?, ?, ?, ?)',
+                             rows)
+            conn.commit()
+
+    def evict(self, conn) -> None:
+        """one pass over the quotas, deleting at most evict_batch files per quota"""
+        now = time.time()
+        # age: per event type quotas first, then the default for the other types
+        for event_type, max_age_sec in self.event_max_age_sec.items():
+            if max_age_sec > 0:
+                rows = conn.execute('SELECT path, size FROM files WHERE event_type = ? AND created_at < ? '
+                                    'ORDER BY created_at LIMIT ?', (event_type, now - max_age_sec, self.evict_batch))
+                self.delete(conn, rows.fetchall(), 'age')
+        if self.max_age_sec > 0:
+            types = list(self.event_max_age_sec)
+            rows = conn.execute(f'SELECT path, size FROM files WHERE created_at < ? AND (event_type IS NULL OR '
+                                f'event_type NOT IN ({",".join("?" * len(types))})) ORDER BY created_at LIMIT ?',
+                                (now - self.max_age_sec, *types, self.evict_batch))
+            self.delete(conn, rows.fetchall(), 'age')
+
+        # size: oldest files of an event type / overall until under quota
+        for event_type, max_bytes in self.event_max_bytes.items():
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM files WHERE event_type = ?',
+                                 (event_type, )).fetchone()[0]
+            if max_bytes > 0 and total > max_bytes:
+                rows = conn.execute('SELECT path, size FROM files WHERE event_type = ? ORDER BY created_at LIMIT ?',
+                                    (event_type, self.evict_batch))
+                self.delete(conn, self.take_until(rows.fetchall(), total - max_bytes), 'event_size')
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+        if self.max_bytes > 0 and total > self.max_bytes:
+            rows = conn.execute('SELECT path, size FROM files ORDER BY created_at LIMIT ?', (self.evict_batch, ))
+            total -= self.delete(conn, self.take_until(rows.fetchall(), total - self.max_bytes), 'size')
+        Metrics.set_gauge('snpm_retention_bytes', total)
+
+    @staticmethod
+    def get_freeable(path, size) -> int:
+        """disk bytes deleting a cataloged file frees. 0 for files still linked elsewhere (see SnippetCache)"""
+        try:
+            return size if os.stat(path).st_nlink <= 1 else 0
+        except OSError:
+            return 0
+
+    @classmethod
+    def take_until(cls, rows, excess) -> list:
+        """first rows whose deletion frees excess bytes"""
+        taken = []
+        for path, size in rows:
+            if excess <= 0:
+                break
+            taken.append((path, size))
+            excess -= cls.get_freeable(path, size)
+        return taken
+
+    def delete(self, conn, rows, reason) -> int:
+        """deletes cataloged files and the folders they leave empty
+
+        Returns:
+            removed (int): bytes of the deleted catalog rows
+        """
+        removed = 0
+        freed = 0  # disk bytes. less than removed when files were linked with the snippet cache
+        deleted = []
+        root = Path(self.root)
+        for path, size in rows:
+            freeable = self.get_freeable(path, size)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                printmsg = f'could not delete snippet {path}: {e}'
+                self.logger.error(printmsg)
+                self.error_logger.error(printmsg)
+                continue
+            removed += size
+            freed += freeable
+            deleted.append((path, ))
+            # remove emptied folders up to root. rmdir fails on the first one that isn't empty
+            parent = Path(path).parent
+            while parent != root and root in parent.parents:
+                try:
+                    parent.rmdir()
+                except OSError:
+                    break
+                parent = parent.parent
+        if len(deleted) > 0:
+            conn.executemany('DELETE FROM files WHERE path = ?', deleted)
+            conn.commit()
+            self.logger.info(f'retention deleted {len(deleted)} snippet files ({freed / 2**20:.1f} MiB) for {reason}')
+            Metrics.inc('snpm_retention_evicted_total', len(deleted), reason=reason)
+        return removed
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import json
+import datetime
+import logging
+import subprocess
+import tempfile
+from pathlib import Path
+
+
+class StreamCopy:
+    """packet level (no re-encode) cutting and joining of the camera mp4 segments using ffmpeg
+
+    the snippet is cut with the ffmpeg concat demuxer using inpoint/outpoint directives
+    and stream copy, so the output starts on the keyframe at or before the requested start time.
+    optionally the partial GOP at the head is re-encoded so the output starts exactly on start time.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+    ffmpeg_bin = 'ffmpeg'
+    ffprobe_bin = 'ffprobe'
+    keyframe_search_window_sec = 30  # how far past the cut point to look for the next keyframe
+    # ffprobe h264 profile name -> libx264 -profile:v
+    h264_profiles = {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high',
+                     'High 10': 'high10', 'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444'}
+
+    @classmethod
+    def run_cmd(cls, cmd):
+        """runs ffmpeg / ffprobe command and returns stdout. raises Exception on failure"""
+        cls.logger.debug(f'running: {" ".join(cmd)}')
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            printmsg = f'{cmd[0]} failed ({proc.returncode}): {proc.stderr.decode("utf-8", errors="replace").strip()}'
+            cls.logger.error(printmsg)
+            cls.error_logger.error(printmsg)
+            raise Exception(printmsg)
+        return proc.stdout.decode('utf-8', errors='replace')
+
+    @classmethod
+    def get_keyframes_around(cls, filepath, offset_sec):
+        """gets keyframe times (sec) surrounding offset_sec in the video file
+
+        Args:
+            filepath (str): mp4 file to read packets from (packets only, nothing is decoded)
+            offset_sec (float): offset in seconds from the start of the file
+
+        Returns:
+            (prev_key, next_key): keyframe at or before offset_sec (0.0 if none found)
+                and first keyframe after offset_sec (None if not found in the search window)
+        """
+        read_interval = f'{max(offset_sec, 0):.3f}%+{cls.keyframe_search_window_sec}'
+        out = cls.run_cmd([cls.ffprobe_bin, '-v', 'error', '-select_streams', 'v:0',
+                           '-read_intervals', read_interval,
+                           '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', filepath])
+        prev_key, next_key = 0.0, None
+        for line in out.splitlines():
+            spl = line.strip().split(',')
+            if len(spl) < 2 or spl[0] in ('', 'N/A') or 'K' not in spl[1]:
+                continue
+            pts = float(spl[0])
+            if pts <= offset_sec:
+                prev_key = max(prev_key, pts)
+            elif next_key is None or pts < next_key:
+                next_key = pts
+        return prev_key, next_key
+
+    @classmethod
+    def get_codec_params(cls, filepath) -> dict:
+        """video stream parameters of filepath the re-encoded head has to match (see encode_head)"""
+        out = cls.run_cmd([cls.ffprobe_bin, '-v', 'error', '-select_streams', 'v:0',
+                           '-show_entries', 'stream=codec_name,profile,level,width,height,pix_fmt,time_base,'
+                           'r_frame_rate,has_b_frames,refs', '-of', 'json', filepath])
+        streams = json.loads(out).get('streams', [])
+        return streams[0] if len(streams) > 0 else {}
+
+    @classmethod
+    def get_head_encode_args(cls, params) -> list:
+        """ffmpeg encoder args making the head a stream the camera packets can be joined to with -c copy
+
+        the concat demuxer keeps the head's parameter sets in the output header (the camera's
+        follow in-band), so the head is encoded with the camera's profile, level, frame size,
+        pixel format, frame rate, time base and frame reordering.
+
+        Returns:
+            args (list): None if the codec can't be matched
+        """
+        if params.get('codec_name') != 'h264':
+            return None
+        args = ['-c:v', 'libx264', '-preset', 'veryfast',
+                '-s', f'{params["width"]}x{params["height"]}', '-pix_fmt', params.get('pix_fmt', 'yuv420p')]
+        profile = cls.h264_profiles.get(params.get('profile'))
+        if profile is not None:
+            args += ['-profile:v', profile]
+        if int(params.get('level', 0)) > 0:
+            args += ['-level:v', f'{int(params["level"]) / 10:.1f}']
+        if params.get('r_frame_rate', '0/0') != '0/0':
+            args += ['-r', params['r_frame_rate']]
+        if int(params.get('has_b_frames', 0)) == 0:
+            args += ['-bf', '0']
+        if int(params.get('refs', 0)) > 0:
+            args += ['-refs', str(params['refs'])]
+        timescale = params.get('time_base', '').partition('/')[2]
+        if timescale:
+            args += ['-video_track_timescale', timescale]
+        return args
+
+    @classmethod
+    def encode_head(cls, filepath, start_sec, end_sec, output_file, encode_args):
+        """re-encodes the partial GOP from start_sec up to the next keyframe (end_sec) of filepath
+
+        Args:
+            encode_args (list): encoder args. see get_head_encode_args
+        """
+        cls.run_cmd([cls.ffmpeg_bin, '-v', 'error', '-y',
+                     '-ss', f'{start_sec:.3f}', '-i', filepath, '-t', f'{end_sec - start_sec:.3f}',
+                     '-map', '0:v:0', *encode_args, output_file])
+
+    @staticmethod
+    def format_concat_entry(filepath, inpoint=None, outpoint=None):
+        escaped_path = str(filepath).replace("'", "'\\''")
+        lines = [f"file '{escaped_path}'"]
+        if inpoint:
+            lines.append(f'inpoint {inpoint:.3f}')
+        if outpoint is not None:
+            lines.append(f'outpoint {outpoint:.3f}')
+        return lines
+
+    @classmethod
+    def cut_snippet(cls, file_list, start_offset_sec, end_offset_sec, output_file, reencode_head=False):
+        """cuts and joins the segment files into output_file without re-encoding
+
+        Args:
+            file_list (list): ordered list of segment mp4 paths overlapping the snippet
+            start_offset_sec (float): snippet start in seconds from start of first file
+            end_offset_sec (float): snippet end in seconds from start of last file
+            output_file (str): name of output file
+            reencode_head (bool): re-encode frames between start and the next keyframe
+                so the output starts exactly at start_offset_sec
+
+        Returns:
+            actual_start_offset_sec (float): offset in the first file where the output actually starts
+        """
+        if len(file_list) == 0:
+            printmsg = 'no files given to cut snippet from!'
+            cls.error_logger.error(printmsg)
+            raise Exception(printmsg)
+
+        first_file = file_list[0]
+        prev_key, next_key = cls.get_keyframes_around(first_file, start_offset_sec)
+        single_file = len(file_list) == 1
+
+        with tempfile.TemporaryDirectory(prefix='snpm_copy_') as tmpdir:
+            concat_lines = ['ffconcat version 1.0']
+            actual_start_offset_sec = prev_key
+
+            # start already on a keyframe or head re-encode not wanted. concat demuxer starts on prev keyframe
+            head_needed = reencode_head and prev_key < start_offset_sec
+            encode_args = None
+            if head_needed:
+                encode_args = cls.get_head_encode_args(cls.get_codec_params(first_file))
+                if encode_args is None:
+                    cls.logger.warning(f'can\'t encode a head matching the codec of {first_file}. '
+                                       f'starting on previous keyframe')
+                    head_needed = False
+            if head_needed and single_file and (next_key is None or next_key >= end_offset_sec):
+                # no keyframe inside the snippet. nothing to copy so the whole snippet is the head
+                cls.encode_head(first_file, start_offset_sec, end_offset_sec, output_file, encode_args)
+                return start_offset_sec
+            if head_needed and next_key is not None:
+                head_file = f'{tmpdir}/head.mp4'
+                cls.encode_head(first_file, start_offset_sec, next_key, head_file, encode_args)
+                concat_lines += cls.format_concat_entry(head_file)
+                first_inpoint = next_key
+                actual_start_offset_sec = start_offset_sec
+            else:
+                if head_needed:
+                    cls.logger.warning(f'no keyframe found within {cls.keyframe_search_window_sec}s of '
+                                       f'{start_offset_sec:.3f}s in {first_file}. starting on previous keyframe')
+                first_inpoint = start_offset_sec
+
+            # first file from start (or next keyframe), middle files whole, last file up to end
+            concat_lines += cls.format_concat_entry(first_file, inpoint=first_inpoint,
+                                                    outpoint=end_offset_sec if single_file else None)
+            for filepath in file_list[1:-1]:
+                concat_lines += cls.format_concat_entry(filepath)
+            if not single_file:
+                concat_lines += cls.format_concat_entry(file_list[-1], outpoint=end_offset_sec)
+
+            concat_file = Path(tmpdir) / 'concat.txt'
+            concat_file.write_text('\n'.join(concat_lines) + '\n')
+            cls.logger.debug(f'concat list:\n{concat_file.read_text()}')
+
+            cls.run_cmd([cls.ffmpeg_bin, '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', str(concat_file),
+                         '-c', 'copy', '-avoid_negative_ts', 'make_zero', '-movflags', '+faststart', output_file])
+
+        return actual_start_offset_sec
+
+    @classmethod
+    def cut_snippet_from_tds(cls, cam_folder, relevant_tds, start_time, end_time, output_file,
+                             dateformat, reencode_head=False):
+        """stream copy version of SnippetGenerator.assemble_video_snippet + write_videofile
+
+        Returns:
+            actual_start_time (datetime): time of the first frame in the output file
+        """
+        file_list = [f'{cam_folder}/{t.strftime(dateformat)}.mp4' for t, _d in relevant_tds]
+        first_file_time = relevant_tds[0][0]
+        last_file_time = relevant_tds[-1][0]
+        start_offset_sec = (start_time - first_file_time).total_seconds()
+        end_offset_sec = (end_time - last_file_time).total_seconds()
+        actual_start_offset_sec = cls.cut_snippet(file_list, start_offset_sec, end_offset_sec, output_file,
+                                                  reencode_head=reencode_head)
+        return first_file_time + datetime.timedelta(seconds=actual_start_offset_sec)
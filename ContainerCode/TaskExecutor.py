@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, CancelledError, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from SnippetGenerator import SnippetGenerator as snpg
+from TaskScheduler import TaskCoalescer, FairTaskScheduler
+from SnippetCache import SnippetCache
+from Metrics import Metrics
+
+
+def init_worker(metrics_enabled, cache_dir, cache_max_bytes):
+    """worker process initializer. sets up the per process state tasks use"""
+    Metrics.init_worker(metrics_enabled)
+    SnippetCache.init_worker(cache_dir, cache_max_bytes)
+
+
+def run_tasks(tasks):
+    """worker process entry point. processes a group of SnippetGenerator.Task sharing one decode
+
+    Returns:
+        (failures, metrics): output file name -> exception of the tasks whose snippets failed validation
+            and the Metrics snapshot recorded while processing. a raised exception carries the snapshot
+            as its metrics_snapshot attribute, so metrics of failed tasks aren't lost
+    """
+    try:
+        with Metrics.timer('snpm_stage_seconds', stage='task', mode=tasks[0].mode):
+            failures = snpg.process_task_group(tasks)
+    except Exception as e:
+        e.metrics_snapshot = Metrics.take_snapshot()
+        raise
+    return failures, Metrics.take_snapshot()
+
+
+class TaskExecutor:
+    """runs SnippetGenerator tasks on a pool of worker processes
+
+    encoding and tracking are cpu bound so tasks run in processes, not threads.
+    tasks wait here until a worker is free and their camera is under its concurrency limit,
+    so two workers never read the same camera segments at once and the pool queue stays empty.
+    waiting tasks are picked by priority, deadline and camera turn (see FairTaskScheduler).
+    when a task starts, waiting tasks it can share a decode with are coalesced into the same job.
+    """
+
+    logger = logging.getLogger(__name__)
+    error_logger = logging.getLogger(f'{__name__}_errors')
+
+    @staticmethod
+    def get_host_worker_count():
+        """number of cpus this process may run on"""
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+
+    def __init__(self, max_workers=0, per_camera_limit=1, on_done=None, coalesce_grace_sec=-1, on_start=None,
+                 long_snippet_sec=120, long_lane_workers=0, long_lane_reserved=1, cache_dir='',
+                 cache_max_bytes=0) -> None:
+        """
+        Args:
+            max_workers (int): worker processes. 0 sizes the pool to the host cpu count
+            per_camera_limit (int): max tasks running at once for the same camera
+            on_done (callable): called with no args from the pool thread when a task finishes.
+                lets the owner block on its own queue instead of polling the executor
+            coalesce_grace_sec (float): max gap between task time ranges merged into one decode.
+                negative disables coalescing. only tasks of the same lane and priority are merged and
+                the merged range is capped at long_snippet_sec, so coalescing can't bypass the lanes
+            on_start (callable): called with the list of tasks of a job when it is handed to a worker
+            long_snippet_sec (float): tasks at least this long wait in the long lane
+            long_lane_workers (int): max long lane jobs running at once. 0 is half the workers (at least 1)
+            long_lane_reserved (int): workers long lane jobs get before short ones when both are waiting,
+                so a steady stream of short tasks can't starve the long lane. capped at long_lane_workers
+            cache_dir (str): snippet cache folder of the workers (see SnippetCache). '' doesn't cache
+            cache_max_bytes (int): max size of the snippet cache
+        """
+        self.on_done = on_done
+        self.on_start = on_start
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.coalescer = TaskCoalescer(coalesce_grace_sec, max_span_sec=long_snippet_sec)
+        self.max_workers = max_workers if max_workers > 0 else self.get_host_worker_count()
+        self.per_camera_limit = max(per_camera_limit, 1)
+        self.long_lane_workers = long_lane_workers if long_lane_workers > 0 else max(self.max_workers // 2, 1)
+        self.long_lane_reserved = min(max(long_lane_reserved, 0), self.long_lane_workers)
+        self.pending = FairTaskScheduler(long_snippet_sec)  # tasks waiting for a worker
+        self.running = {}  # future -> list of tasks run as one job
+        self.running_per_camera = {}  # camera -> running task count
+        self.pool = self.create_pool()
+        self.logger.info(f'task executor started with {self.max_workers} workers, '
+                         f'{self.per_camera_limit} per camera, {self.long_lane_workers} for long snippets '
+                         f'({self.long_lane_reserved} reserved)')
+
+    def create_pool(self):
+        return ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker,
+                                   initargs=(Metrics.enabled, self.cache_dir, self.cache_max_bytes))
+
+    @staticmethod
+    def get_camera(task):
+        """camera key of task. the camera folder name is the camera mac"""
+        return Path(task.cam_folder).name
+
+    def __len__(self):
+        return len(self.pending) + sum(len(group) for group in self.running.values())
+
+    def get_tasks(self) -> list:
+        """waiting and running tasks"""
+        return self.pending.get_tasks() + [task for group in self.running.values() for task in group]
+
+    def submit(self, task, dispatch=True) -> None:
+        """queues task and starts it if a worker and its camera are free
+
+        Args:
+            dispatch (bool): False only queues task. submit tasks arriving together this way and call
+                dispatch() once after, so overlapping ones are coalesced instead of the first starting alone
+        """
+        self.pending.push(task, self.get_camera(task))
+        if dispatch:
+            self.dispatch()
+
+    def camera_ready(self, camera) -> bool:
+        return self.running_per_camera.get(camera, 0) < self.per_camera_limit
+
+    def dispatch(self) -> int:
+        """starts pending tasks in scheduler order, skipping tasks whose camera is at its limit
+
+        Returns:
+            started (int): number of tasks started
+        """
+        started = 0
+        while len(self.pending) > 0 and len(self.running) < self.max_workers:
+            long_running = sum(1 for group in self.running.values() if self.pending.get_lane(group[0]) == 'long')
+            if long_running < self.long_lane_reserved:
+                # long lane under its reserved share goes first. short tasks get the worker if no long one can run
+                task = self.pending.pop(self.camera_ready, lanes=('long', 'short'))
+            elif long_running < self.long_lane_workers:
+                task = self.pending.pop(self.camera_ready, lanes=('short', 'long'))
+            else:
+                task = self.pending.pop(self.camera_ready, lanes=('short', ))
+            if task is None:
+                break
+            self.start(task, self.get_camera(task))
+            started += 1
+        return started
+
+    def start(self, task, camera) -> None:
+        candidates = self.pending.get_camera_tasks(camera, lane=self.pending.get_lane(task), priority=task.priority)
+        group, _remaining = self.coalescer.take_group(task, candidates)
+        for other in group:
+            if other is not task:
+                self.pending.remove(other, camera)
+        self.logger.info(f'generating snippet for {", ".join(str(t) for t in group)}')
+        future = self.pool.submit(run_tasks, group)
+        if self.on_start is not None:
+            self.on_start(group)
+        if self.on_done is not None:
+            future.add_done_callback(lambda _future: self.on_done())
+        self.running[future] = group
+        self.running_per_camera[camera] = self.running_per_camera.get(camera, 0) + 1
+
+    def poll(self, timeout=0) -> list:
+        """collects finished tasks and starts pending ones in their place
+
+        Args:
+            timeout (float): seconds to wait for a task to finish. 0 doesn't wait
+
+        Returns:
+            finished (list): (task, exception) tuples. exception is None on success
+        """
+        finished = []
+        if len(self.running) > 0:
+            # futures cancelled by restart_pool are done but wait() doesn't return them until notified
+            cancelled = {future for future in self.running if future.cancelled()}
+            done, _not_done = wait(list(self.running), timeout=0 if len(cancelled) > 0 else timeout,
+                                   return_when=FIRST_COMPLETED)
+            done = done | cancelled
+            broken = False
+            for future in done:
+                group = self.running.pop(future)
+                camera = self.get_camera(group[0])
+                self.running_per_camera[camera] -= 1
+                if self.running_per_camera[camera] == 0:
+                    del self.running_per_camera[camera]
+                # cancelled by restart_pool. exception() would raise CancelledError
+                if future.cancelled():
+                    exception = CancelledError('cancelled before it started, worker pool restarted')
+                else:
+                    exception = future.exception()
+                failures = {}
+                if exception is None:
+                    failures, snapshot = future.result()
+                    Metrics.merge(snapshot)
+                elif getattr(exception, 'metrics_snapshot', None) is not None:
+                    Metrics.merge(exception.metrics_snapshot)
+                for task in group:
+                    task_exception = exception if exception is not None else failures.get(str(task))
+                    if task_exception is None:
+                        self.logger.info(f'done: {task}')
+                        Metrics.inc('snpm_tasks_total', result='done')
+                    else:
+                        printmsg = f'task {task} failed: {task_exception!r}'
+                        self.logger.error(printmsg, exc_info=task_exception)
+                        self.error_logger.error(printmsg, exc_info=task_exception)
+                        Metrics.inc('snpm_tasks_total', result='failed')
+                        Metrics.inc('snpm_task_failures_total', reason=type(task_exception).__name__)
+                    finished.append((task, task_exception))
+                broken = broken or isinstance(exception, BrokenProcessPool)
+            if broken:
+                self.restart_pool()
+        self.dispatch()
+        return finished
+
+    def restart_pool(self) -> None:
+        """replaces a pool broken by a worker dying (e.g. killed for memory)"""
+        printmsg = 'worker process died. restarting task executor pool'
+        self.logger.error(printmsg)
+        self.error_logger.error(printmsg)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = self.create_pool()
+
+    def shutdown(self, wait=True) -> None:
+        self.pool.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import copy
+import datetime
+import heapq
+import itertools
+import logging
+from collections import OrderedDict
+
+
+class DeferredTaskQueue:
+    """min-heap of tasks parked until a deadline
+
+    used for tasks whose footage is not recorded yet. each task is parked until its
+    ready time has passed, while ready tasks keep being processed.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self) -> None:
+        self.heap = []  # (ready_at, seq, task)
+        self.seq = itertools.count()  # keeps insertion order for equal ready times (tasks aren't comparable)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def park(self, task, ready_at) -> None:
+        """parks task until ready_at (datetime)"""
+        heapq.heappush(self.heap, (ready_at, next(self.seq), task))
+        self.logger.info(f'parked {task} until {ready_at}. parked tasks: {len(self.heap)}')
+
+    def get_tasks(self) -> list:
+        return [item[2] for item in self.heap]
+
+    def next_ready_at(self):
+        """ready time (datetime) of the next task to come due. None if nothing is parked"""
+        return self.heap[0][0] if len(self.heap) > 0 else None
+
+    def pop_ready(self, now) -> list:
+        """removes and returns tasks whose ready time is at or before now (datetime), earliest first"""
+        ready = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            ready.append(heapq.heappop(self.heap)[2])
+        if len(ready) > 0:
+            self.logger.info(f'released {len(ready)} parked tasks. parked tasks: {len(self.heap)}')
+        return ready
+
+
+class TaskCoalescer:
+    """merges fused mode tasks of one camera whose time ranges overlap into a single decode
+
+    ranges separated by less than the grace period count as overlapping, so back to back
+    events (e.g. a greeting followed by an interaction) share one decode of their union.
+    the union is capped at max_span_sec (or the span of the task being started, if longer),
+    so chained ranges can't grow into a job longer than any of the tasks it was made from.
+    """
+
+    logger = logging.getLogger(__name__)
+    coalesce_modes = ('fused', )  # modes that decode frames and can write several snippets from one decode
+
+    def __init__(self, grace_sec=0, max_span_sec=0) -> None:
+        """
+        Args:
+            grace_sec (float): max gap between time ranges still merged. negative disables coalescing
+            max_span_sec (float): max length of the merged time range. <= 0 unbounded
+        """
+        self.grace = datetime.timedelta(seconds=grace_sec)
+        self.enabled = grace_sec >= 0
+        self.max_span = datetime.timedelta(seconds=max_span_sec) if max_span_sec > 0 else None
+
+    def can_merge(self, task, other, max_span=None) -> bool:
+        return (other.cam_folder == task.cam_folder and other.mode in self.coalesce_modes
+                and other.start_time <= task.end_time + self.grace
+                and task.start_time <= other.end_time + self.grace
+                and (max_span is None
+                     or max(task.end_time, other.end_time) - min(task.start_time, other.start_time) <= max_span))
+
+    def take_group(self, task, candidates) -> tuple:
+        """pulls the tasks overlapping task (directly or through each other) out of candidates
+
+        Args:
+            task: SnippetGenerator.Task about to run
+            candidates (iterable): other waiting tasks it may share a decode with (e.g. same lane and priority)
+
+        Returns:
+            (group, remaining): group is task plus the merged tasks in start time order,
+                remaining is the rest of the candidates in their original order
+        """
+        remaining = list(candidates)
+        if not self.enabled or task.mode not in self.coalesce_modes:
+            return [task], remaining
+
+        group = [task]
+        union = copy.copy(task)  # only start / end time of the union are changed
+        max_span = None
+        if self.max_span is not None:
+            max_span = max(self.max_span, task.end_time - task.start_time)
+        merged = True
+        while merged:
+            merged = False
+            for other in list(remaining):
+                if self.can_merge(union, other, max_span):
+                    group.append(other)
+                    remaining = [r for r in remaining if r is not other]
+                    union.start_time = min(union.start_time, other.start_time)
+                    union.end_time = max(union.end_time, other.end_time)
+                    merged = True
+        if len(group) > 1:
+            self.logger.info(f'coalescing {len(group)} tasks for {task.cam_folder} '
+                             f'from {union.start_time} to {union.end_time}')
+        return sorted(group, key=lambda t: t.start_time), remaining
+
+
+class FairTaskScheduler:
+    """tasks waiting for a worker, ordered by priority and deadline and shared fairly between cameras
+
+    tasks go into a short or a long lane by snippet length. the caller picks the lanes served per
+    pop (see TaskExecutor.dispatch), so long snippets can be both capped, not holding every worker
+    while short ones wait, and given a reserved share, not starved by a steady stream of short ones.
+    in a lane, higher priority tasks (by event type) run first. cameras
+    with tasks of the same priority take turns, and each camera runs its tasks in deadline order
+    (earliest end time first, the oldest footage).
+    """
+
+    logger = logging.getLogger(__name__)
+    lanes = ('short', 'long')
+
+    def __init__(self, long_snippet_sec=120) -> None:
+        """
+        Args:
+            long_snippet_sec (float): tasks at least this long go into the long lane
+        """
+        self.long_snippet = datetime.timedelta(seconds=long_snippet_sec)
+        self.queues = {lane: {} for lane in self.lanes}  # lane -> priority -> OrderedDict camera -> heap
+        self.seq = itertools.count()  # keeps insertion order for equal deadlines (tasks aren't comparable)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def get_lane(self, task) -> str:
+        return 'long' if task.end_time - task.start_time >= self.long_snippet else 'short'
+
+    def push(self, task, camera) -> None:
+        """queues task of camera (key the caller limits concurrency by)"""
+        cameras = self.queues[self.get_lane(task)].setdefault(task.priority, OrderedDict())
+        heapq.heappush(cameras.setdefault(camera, []), (task.end_time, next(self.seq), task))
+        self.count += 1
+
+    def pop(self, camera_ready, lanes=None):
+        """removes and returns the next task to run. None if no task can run
+
+        Args:
+            camera_ready (callable): camera_ready(camera) -> False if the camera can't start a task now
+            lanes (tuple): lanes to take a task from, first one first. None is all lanes, short first
+        """
+        for lane in lanes or self.lanes:
+            priorities = self.queues[lane]
+            for priority in sorted(priorities, reverse=True):
+                cameras = priorities[priority]
+                for camera, heap in cameras.items():
+                    if not camera_ready(camera):
+                        continue
+                    task = heapq.heappop(heap)[2]
+                    # camera goes to the back of the turn order of its priority
+                    if len(heap) > 0:
+                        cameras.move_to_end(camera)
+                    else:
+                        del cameras[camera]
+                        if len(cameras) == 0:
+                            del priorities[priority]
+                    self.count -= 1
+                    return task
+        return None
+
+    def get_tasks(self) -> list:
+        """all waiting tasks"""
+        return [item[2] for priorities in self.queues.values() for cameras in priorities.values()
+                for heap in cameras.values() for item in heap]
+
+    def get_camera_tasks(self, camera, lane=None, priority=None) -> list:
+        """waiting tasks of camera, in lane and of priority (any if None)"""
+        return [item[2] for lane_name, priorities in self.queues.items() if lane in (None, lane_name)
+                for task_priority, cameras in priorities.items() if priority in (None, task_priority)
+                for item in cameras.get(camera, ())]
+
+    def remove(self, task, camera) -> None:
+        """takes a waiting task out of the queue (e.g. coalesced into a running job)"""
+        priorities = self.queues[self.get_lane(task)]
+        cameras = priorities[task.priority]
+        heap = [item for item in cameras[camera] if item[2] is not task]
+        heapq.heapify(heap)
+        if len(heap) > 0:
+            cameras[camera] = heap
+        else:
+            del cameras[camera]
+            if len(cameras) == 0:
+                del priorities[task.priority]
+        self.count -= 1
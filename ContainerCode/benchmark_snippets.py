@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""benchmarks snippet generation, bbox drawing and segment index lookup on synthetic camera folders
+
+synthetic segment folders are written offline with opencv, so no /skaivideos footage is needed.
+results are written as json. every run's output files are validated (written, with frames) and
+a benchmark whose run didn't produce them is recorded as failed instead of timed. the script exits
+with 1 if any benchmark failed or, with --compare, got slower than the allowed threshold against a
+stored baseline.
+
+examples:
+    python3 benchmark_snippets.py --output bench.json
+    python3 benchmark_snippets.py --output bench_new.json --compare bench.json --threshold 0.15
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import datetime
+import statistics
+import tempfile
+from types import SimpleNamespace
+from argparse import ArgumentParser
+
+import numpy as np
+import cv2
+
+from SnippetGenerator import SnippetGenerator as snpg
+from SegmentIndex import SegmentIndex
+from BBoxInterpolator import BBoxInterpolator
+
+
+class SyntheticCamera:
+    """camera folder of synthetic mp4 segments named like the recorder names them"""
+
+    first_segment_time = datetime.datetime(2023, 1, 19, 12, 0, 0)
+
+    def __init__(self, folder, num_segments, segment_sec, width, height, fps, fourcc='avc1',
+                 first_video_segment=0) -> None:
+        """
+        Args:
+            first_video_segment (int): segments before this one only get their file name, so folders
+                with many segments are cheap to write. snippets are taken from the ones after
+        """
+        self.folder = folder
+        self.num_segments = num_segments
+        self.first_video_segment = first_video_segment
+        self.segment_sec = segment_sec
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.fourcc = fourcc
+
+    def segment_time(self, k):
+        return self.first_segment_time + datetime.timedelta(seconds=k * self.segment_sec)
+
+    def write(self, empty=False):
+        """writes the segments. empty only creates the file names (enough for index benchmarks)"""
+        os.makedirs(self.folder, exist_ok=True)
+        for k in range(self.num_segments):
+            filepath = f'{self.folder}/{self.segment_time(k).strftime(snpg.mp4_dateformat)}'
+            if empty or k < self.first_video_segment:
+                open(filepath, 'w').close()
+            else:
+                self.write_segment(filepath, k)
+        return self
+
+    def write_segment(self, filepath, k):
+        out = cv2.VideoWriter(filepath, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (self.width, self.height))
+        if not out.isOpened():
+            raise Exception(f'could not open video writer with fourcc {self.fourcc}. try --fourcc mp4v')
+        rng = np.random.default_rng(k)
+        background = rng.integers(0, 255, (self.height, self.width, 3), dtype=np.uint8)
+        box_w, box_h = self.width // 8, self.height // 4
+        for i in range(int(self.segment_sec * self.fps)):
+            frame = background.copy()
+            # moving block so encoders and trackers have real motion to work on
+            x = (i * 4) % (self.width - box_w)
+            y = (i * 2) % (self.height - box_h)
+            frame[y:y + box_h, x:x + box_w] = (255, 255, 255)
+            out.write(frame)
+        out.release()
+
+
+def make_boxes(start_time, end_time, updates_per_sec, num_objects):
+    """synthetic box store built from a list shaped like the protobuf tr_boxes repeated field"""
+    boxes = []
+    if updates_per_sec <= 0:
+        return snpg.create_box_store(boxes)
+    step = datetime.timedelta(seconds=1 / updates_per_sec)
+    t = start_time
+    k = 0
+    while t < end_time:
+        # convert_protobuf_ts_to_utc_datetime inverse. naive timestamp() is local time like fromtimestamp
+        timestamp = int((t - snpg.convert2utc).timestamp() * 1e9)
+        bboxes = []
+        for obj in range(num_objects):
+            offset = (k * 0.01 + obj * 0.2) % 0.6
+            bboxes.append(SimpleNamespace(global_id=obj, camera_id=0, top=0.1 + offset, left=0.1 + offset,
+                                          bottom=0.3 + offset, right=0.25 + offset))
+        boxes.append(SimpleNamespace(timestamp=timestamp, bboxes=bboxes))
+        t += step
+        k += 1
+    return snpg.create_box_store(boxes)
+
+
+class RunFailed(Exception):
+    """a benchmarked run didn't produce its outputs"""
+
+
+def time_runs(func, repeat, outputs=()):
+    """runs func repeat times. returns list of run times (sec)
+
+    Args:
+        outputs (iterable): files each run has to write. removed before and validated after every run
+
+    Raises:
+        RunFailed: if a run raised or didn't write one of outputs (or wrote it without frames)
+    """
+    run_times = []
+    for _ in range(repeat):
+        for output_file in outputs:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        t0 = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            raise RunFailed(repr(e))
+        run_times.append(time.perf_counter() - t0)
+        for output_file in outputs:
+            if not snpg.validate_snippet(output_file):
+                raise RunFailed(f'{os.path.basename(output_file)} missing or without frames')
+    return run_times
+
+
+def fail_run(reason):
+    raise RunFailed(reason)
+
+
+class Benchmarks:
+
+    def __init__(self, args, workdir) -> None:
+        self.args = args
+        self.workdir = workdir
+        self.results = {}
+        self.cameras = {}
+
+    def record(self, name, run, **params):
+        """times run (callable returning time_runs run times) under name. failed runs are recorded as failures"""
+        try:
+            run_times = run()
+        except RunFailed as e:
+            self.results[name] = {'failed': str(e), 'params': params}
+            print(f'{name:70s} FAILED: {e}')
+            return
+        self.results[name] = {
+            'median_sec': statistics.median(run_times),
+            'min_sec': min(run_times),
+            'runs': len(run_times),
+            'params': params,
+        }
+        print(f'{name:70s} median {self.results[name]["median_sec"] * 1000:10.2f} ms')
+
+    def get_failures(self) -> list:
+        return [name for name, result in self.results.items() if 'failed' in result]
+
+    def get_camera(self, resolution, segment_count=0):
+        """camera folder of segment_count segments (at least --segments). only the last --segments have video"""
+        segment_count = max(segment_count, self.args.segments)
+        key = (resolution, segment_count)
+        if key not in self.cameras:
+            width, height = (int(v) for v in resolution.split('x'))
+            folder = f'{self.workdir}/video_{resolution}_{segment_count}'
+            print(f'writing {segment_count} synthetic segments ({self.args.segments} x {self.args.segment_sec}s '
+                  f'of video) at {resolution}...')
+            self.cameras[key] = SyntheticCamera(folder, segment_count, self.args.segment_sec, width, height,
+                                                self.args.fps, self.args.fourcc,
+                                                first_video_segment=segment_count - self.args.segments).write()
+        return self.cameras[key]
+
+    def snippet_range(self, camera, snippet_sec):
+        """range starting mid way through the first video segment so snippets cross segment boundaries"""
+        start_time = (camera.segment_time(camera.first_video_segment)
+                      + datetime.timedelta(seconds=camera.segment_sec / 2))
+        end_time = start_time + datetime.timedelta(seconds=snippet_sec)
+        last_full_end = camera.segment_time(camera.num_segments - 1)
+        if end_time > last_full_end:
+            raise Exception(f'snippet of {snippet_sec}s doesn\'t fit in {self.args.segments} segments of '
+                            f'{camera.segment_sec}s. use more --segments')
+        return start_time, end_time
+
+    def bench_index(self):
+        for count in self.args.index_segment_counts:
+            folder = f'{self.workdir}/index_{count}'
+            camera = SyntheticCamera(folder, count, 600, 0, 0, 0).write(empty=True)
+            SegmentIndex.indexes.clear()
+
+            def cold():
+                SegmentIndex.indexes.clear()
+                snpg.get_mp4_start_times_and_durations(folder)
+
+            self.record(f'get_mp4_start_times_and_durations/cold/segments={count}',
+                        lambda: time_runs(cold, self.args.repeat), segments=count)
+            self.record(f'get_mp4_start_times_and_durations/warm/segments={count}',
+                        lambda: time_runs(lambda: snpg.get_mp4_start_times_and_durations(folder), self.args.repeat),
+                        segments=count)
+
+            mid = camera.segment_time(count // 2)
+            start_time, end_time = mid + datetime.timedelta(seconds=30), mid + datetime.timedelta(minutes=25)
+            index = snpg.get_segment_index(folder)
+            self.record(f'segment_index_lookup/segments={count}',
+                        lambda: time_runs(lambda: index.lookup(start_time, end_time), self.args.repeat * 100),
+                        segments=count)
+
+    def bench_snippets(self):
+        for resolution in self.args.resolutions:
+            for segment_count in self.args.snippet_segment_counts:
+                camera = self.get_camera(resolution, segment_count)
+                for snippet_sec in self.args.snippet_lengths:
+                    start_time, end_time = self.snippet_range(camera, snippet_sec)
+                    for mode in self.args.modes:
+                        output_file = f'{self.workdir}/out_{mode}.mp4'
+                        self.record(f'generate_snippet_for_cam/mode={mode}/res={resolution}/sec={snippet_sec}'
+                                    f'/segments={camera.num_segments}',
+                                    lambda: time_runs(lambda: snpg.generate_snippet_for_cam(camera.folder, start_time,
+                                                                                             end_time,
+                                                                                             output_file=output_file,
+                                                                                             mode=mode),
+                                                      self.args.repeat, outputs=[output_file]),
+                                    mode=mode, resolution=resolution, snippet_sec=snippet_sec,
+                                    segments=camera.num_segments)
+
+    def bench_draw(self):
+        for resolution in self.args.resolutions:
+            camera = self.get_camera(resolution)
+            for snippet_sec in self.args.snippet_lengths:
+                start_time, end_time = self.snippet_range(camera, snippet_sec)
+                input_file = f'{self.workdir}/draw_input.mp4'
+                try:
+                    snpg.generate_snippet_for_cam(camera.folder, start_time, end_time, output_file=input_file,
+                                                  mode='fused')
+                    input_ok = True
+                except Exception as e:
+                    print(f'could not write draw input snippet: {e!r}')
+                    input_ok = False
+                for density in self.args.box_densities:
+                    boxes = make_boxes(start_time, end_time, density, self.args.objects)
+                    task = snpg.Task(camera.folder, start_time, end_time, input_file, boxes)
+                    output_file = f'{self.workdir}/draw_output.mp4'
+                    for interpolation in self.args.interpolations:
+                        task.interpolation = interpolation
+                        self.record(f'draw_bboxes/interpolation={interpolation}/res={resolution}/sec={snippet_sec}'
+                                    f'/updates_per_sec={density}',
+                                    lambda: time_runs(lambda: snpg.draw_bboxes(input_file, task, output_file,
+                                                                               video_start_time=start_time),
+                                                      self.args.repeat, outputs=[output_file])
+                                    if input_ok else fail_run('draw input snippet not written'),
+                                    resolution=resolution, snippet_sec=snippet_sec, updates_per_sec=density,
+                                    objects=self.args.objects, interpolation=interpolation)
+
+    def bench_process_task(self):
+        for resolution in self.args.resolutions:
+            camera = self.get_camera(resolution)
+            for snippet_sec in self.args.snippet_lengths:
+                start_time, end_time = self.snippet_range(camera, snippet_sec)
+                for density in self.args.box_densities:
+                    boxes = make_boxes(start_time, end_time, density, self.args.objects)
+                    for mode in self.args.modes:
+                        task = snpg.Task(camera.folder, start_time, end_time,
+                                         f'{self.workdir}/task_{mode}_T.mp4', boxes, mode=mode)
+                        outputs = [task.output_file] + ([task.bbox_output_file] if len(boxes) > 0 else [])
+                        self.record(f'process_task/mode={mode}/res={resolution}/sec={snippet_sec}'
+                                    f'/updates_per_sec={density}',
+                                    lambda: time_runs(lambda: snpg.process_task(task), self.args.repeat,
+                                                      outputs=outputs),
+                                    mode=mode, resolution=resolution, snippet_sec=snippet_sec,
+                                    updates_per_sec=density, objects=self.args.objects)
+
+    def run(self):
+        suites = {
+            'index': self.bench_index,
+            'snippet': self.bench_snippets,
+            'draw': self.bench_draw,
+            'task': self.bench_process_task,
+        }
+        for name in self.args.suites:
+            suites[name]()
+        return self.results
+
+
+def compare(results, baseline, threshold, min_runs):
+    """compares medians with the baseline. returns list of regressed benchmark names
+
+    a benchmark only counts as regressed if both runs have min_runs runs and its fastest run is also
+    slower than the baseline median by more than threshold, so a few noisy runs can't flag it
+    """
+    regressions = []
+    print(f'\n{"benchmark":70s} {"baseline":>10s} {"current":>10s} {"change":>8s}')
+    for name, result in results.items():
+        if 'failed' in result:
+            print(f'{name:70s} {"":>10s} {"":>10s} {"FAILED":>8s}')
+            continue
+        if name not in baseline or 'failed' in baseline[name]:
+            print(f'{name:70s} {"-":>10s} {result["median_sec"] * 1000:10.2f} {"new":>8s}')
+            continue
+        base_sec = baseline[name]['median_sec']
+        change = result['median_sec'] / base_sec - 1 if base_sec > 0 else 0.0
+        min_change = result['min_sec'] / base_sec - 1 if base_sec > 0 else 0.0
+        flag = ''
+        if change > threshold and min_change > threshold:
+            if min(result['runs'], baseline[name]['runs']) >= min_runs:
+                regressions.append(name)
+                flag = '  REGRESSION'
+            else:
+                flag = f'  (under {min_runs} runs, not flagged)'
+        print(f'{name:70s} {base_sec * 1000:10.2f} {result["median_sec"] * 1000:10.2f} {change:+8.1%}{flag}')
+    return regressions
+
+
+def csv_list(cast):
+    return lambda s: [cast(v) for v in s.split(',') if v]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--suites', type=csv_list(str), default=['index', 'snippet', 'draw', 'task'],
+                        help='comma separated suites to run: index,snippet,draw,task (default all)')
+    parser.add_argument('--output', help='json file to write results to (default stdout only)')
+    parser.add_argument('--compare', help='baseline json to compare results against')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='allowed slowdown vs baseline before a benchmark counts as regressed (default 0.15)')
+    parser.add_argument('--repeat', type=int, default=7, help='runs per benchmark (default 7)')
+    parser.add_argument('--min-compare-runs', type=int, default=5,
+                        help='runs a benchmark and its baseline need before a slowdown is flagged (default 5)')
+    parser.add_argument('--modes', type=csv_list(str), default=list(snpg.snippet_modes),
+                        help=f'snippet modes (default {",".join(snpg.snippet_modes)})')
+    parser.add_argument('--resolutions', type=csv_list(str), default=['640x360', '1280x720'],
+                        help='synthetic video resolutions WxH (default 640x360,1280x720)')
+    parser.add_argument('--snippet-lengths', type=csv_list(float), default=[10, 30],
+                        help='snippet lengths in seconds (default 10,30)')
+    parser.add_argument('--box-densities', type=csv_list(float), default=[1, 5],
+                        help='box updates per second (default 1,5)')
+    parser.add_argument('--interpolations', type=csv_list(str), default=list(BBoxInterpolator.methods),
+                        help=f'draw_bboxes interpolation methods (default {",".join(BBoxInterpolator.methods)})')
+    parser.add_argument('--objects', type=int, default=3, help='objects per box update (default 3)')
+    parser.add_argument('--index-segment-counts', type=csv_list(int), default=[100, 1000],
+                        help='segment counts for index benchmarks (default 100,1000)')
+    parser.add_argument('--segments', type=int, default=4,
+                        help='synthetic segments with video per camera (default 4)')
+    parser.add_argument('--snippet-segment-counts', type=csv_list(int), default=[4, 500],
+                        help='segments in the camera folder for snippet benchmarks. segments past --segments '
+                             'have no video (default 4,500)')
+    parser.add_argument('--segment-sec', type=float, default=20,
+                        help='synthetic segment length in seconds (default 20, recorder uses 600)')
+    parser.add_argument('--fps', type=float, default=15, help='synthetic video fps (default 15)')
+    parser.add_argument('--fourcc', default='avc1', help='synthetic video codec fourcc (default avc1)')
+    parser.add_argument('--workdir', help='folder for synthetic videos (default temp folder, removed after)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    # copy mode needs ffmpeg / ffprobe on the path
+    if 'copy' in args.modes and (shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None):
+        print('ffmpeg / ffprobe not found. skipping copy mode')
+        args.modes.remove('copy')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='snpm_bench_')
+    benchmarks = Benchmarks(args, workdir)
+    try:
+        results = benchmarks.run()
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'time': datetime.datetime.now().isoformat(),
+            'host': platform.node(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f'wrote results to {args.output}')
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_compare_runs)
+        if len(regressions) > 0:
+            print(f'\n{len(regressions)} benchmarks regressed more than {args.threshold:.0%}')
+            exit_code = 1
+        else:
+            print(f'\nno regressions over {args.threshold:.0%}')
+    failures = benchmarks.get_failures()
+    if len(failures) > 0:
+        print(f'\n{len(failures)} benchmarks failed to produce their outputs')
+        exit_code = 1
+    sys.exit(exit_code)
@@ -1,13 +1,29 @@
 #!/usr/bin/env python3
 from SnippetGenerator import SnippetGenerator as snpg
 import SnippetGenerator
+import StreamCopy
+import SegmentIndex
+import MediaProbe
+import BBoxAnnotator
+import BBoxInterpolator
+import BoxStore
+import TaskExecutor
+import TaskScheduler
+import Metrics
+import JobStore
+import AdmissionControl
+import ShardRing
+import SnippetCache
+import SnippetRetention
 # import datetime
 from datetime import timedelta, datetime
 import logging
 import argparse
 import multiprocessing as mp
+import queue
+from dataclasses import dataclass, field
 from skaimsginterface.skaimessages import *
-from skaimsginterface.tcp import MultiportTcpListenerMP, TcpSenderMP
+from skaimsginterface.tcp import MultiportTcpListenerMP, TcpSender, TcpSenderMP
 from pathlib import Path
 
 
@@ -16,16 +32,58 @@ class SnippetManager:
     error_logger = logging.getLogger(f'{__name__}_errors')
     camfolder_day_format = '%Y-%m-%d'
 
-    def __init__(self, print_q) -> None:
+    @dataclass
+    class Config:
+        """Class for storing Snippet Manager settings"""
+        snippet_mode: str = 'reencode'  # one of SnippetGenerator.snippet_modes
+        reencode_head: bool = False  # copy mode only. re-encode partial GOP at start for exact start time
+        write_plain: bool = True  # fused mode only. False writes just the bbox snippet
+        workers: int = 0  # task worker processes. 0 sizes to host cpu count
+        per_camera_workers: int = 1  # max tasks running at once for the same camera
+        defer_margin_sec: float = 10  # tasks are parked until this long after their end time
+        msg_batch_size: int = 32  # max messages drained from msg_q per wakeup
+        idle_timeout_sec: float = 1.0  # max time the handler blocks waiting for work before rechecking stop
+        stop_timeout_sec: float = 60  # max time stop() waits for the handler to finish before terminating it
+        coalesce_grace_sec: float = -1  # fused mode only. max gap between a camera's ranges sharing a decode. <0 off
+        live_tail: bool = False  # read the segment still being recorded instead of waiting defer_margin_sec
+        live_tail_margin_sec: float = 1.0  # live tail tasks are parked until this long after their end time
+        interpolation: str = 'linear'  # one of BBoxInterpolator.methods. how boxes move between box updates
+        tracking_scale: float = 0.0  # tracker interpolation only. frame scale trackers run at. 0 picks from resolution
+        metrics: bool = True  # record stage timings / counters. False makes the timers no-ops
+        metrics_port: int = 9201  # local http port serving metrics in prometheus text format. 0 doesn't serve
+        job_store_path: str = '/skailogs/snpm_jobs.db'  # sqlite file recording events / task states. '' off
+        event_priorities: dict = field(default_factory=dict)  # msg.event type -> task priority. higher first, default 0
+        long_snippet_sec: float = 120  # snippets at least this long wait in the long lane
+        long_lane_workers: int = 0  # max long snippet jobs running at once. 0 is half the workers (at least 1)
+        long_lane_reserved: int = 1  # workers long snippet jobs get before short ones when both are waiting
+        msg_queue_size: int = 10000  # max messages waiting in msg_q. the listener drops messages past it
+        max_pending_tasks: int = 1000  # max tasks waiting for a worker. AdmissionControl.policy ones are dropped past it
+        max_task_age_sec: float = 3600  # tasks ending longer ago than this are dropped. <=0 off
+        shed_policy: tuple = ('boxless', 'priority', 'oldest')  # which waiting tasks are dropped first. see AdmissionControl
+        dropped_file: str = '/skailogs/snpm_dropped.jsonl'  # json lines record of dropped tasks / messages for backfill
+        shard_index: int = 0  # this instance's shard. it generates snippets of the cameras the ShardRing gives it
+        shard_count: int = 1  # snippet manager instances sharing the cameras. 1 doesn't shard
+        shard_base_port: int = 7201  # shard i listens on shard_base_port + i
+        shard_host: str = '127.0.0.1'  # host the other shards listen on
+        snippet_cache_dir: str = ''  # cache of produced snippets reused for identical tasks, e.g. /snippets/.cache. '' off
+        snippet_cache_gb: float = 10  # max size of the snippet cache
+        retention_catalog: str = '/snippets/.catalog.db'  # sqlite catalog of produced snippets for retention. '' off
+        retention_max_gb: float = 0  # max total size of the produced snippets. 0 unbounded
+        retention_max_age_days: float = 0  # produced snippets older than this are deleted. 0 kept forever
+        event_retention_gb: dict = field(default_factory=dict)  # msg.event type -> max total size of its snippets
+        event_retention_days: dict = field(default_factory=dict)  # msg.event type -> max age of its snippets
+
+    def __init__(self, print_q, config=None) -> None:
         self.stop_event = mp.Event()
         self.print_q = print_q
-        self.msg_q = mp.Queue()
+        self.config = config if config is not None else SnippetManager.Config()
+        self.msg_q = mp.Queue(maxsize=self.config.msg_queue_size)
 
         # start handler process
         self.start_handler()
 
         # start listener process
-        self.ports = [7201]
+        self.ports = [self.config.shard_base_port + self.config.shard_index]
         self.listener = MultiportTcpListenerMP(portlist=self.ports,
                                                multiport_callback_func=self.multiport_callback,
                                                print_q=self.print_q,
@@ -39,126 +97,581 @@ class SnippetManager:
                                           self.stop_event,
                                           self.print_q,
                                           self.msg_q,
+                                          self.config,
                                       ))
-        self.handle_proc.daemon = True
+        # not a daemon: the handler starts the TaskExecutor worker processes and daemons can't have children
         self.handle_proc.start()
 
     def stop(self):
         self.stop_event.set()
+        SnippetManager.wake(self.msg_q)  # wake up handler blocked on msg_q
         self.listener.stop()
+        self.handle_proc.join(timeout=self.config.stop_timeout_sec)
+        if self.handle_proc.is_alive():
+            printmsg = f'handler didn\'t stop within {self.config.stop_timeout_sec}s. terminating it'
+            self.logger.error(printmsg)
+            self.error_logger.error(printmsg)
+            self.handle_proc.terminate()
+            self.handle_proc.join()
 
     @staticmethod
-    def handle_em_msgs(stop_event, print_q, msg_q):
+    def wake(q) -> None:
+        """puts a wakeup on q. a full q wakes its reader anyway"""
+        try:
+            q.put_nowait(None)
+        except queue.Full:
+            pass
+
+    @staticmethod
+    def get_batch(q, timeout, max_batch) -> list:
+        """blocks up to timeout for the first item on q then drains up to max_batch items without blocking
+
+        None items are wakeups (stop, finished task) and are left out of the returned batch
+        """
+        items = []
+        try:
+            items.append(q.get(timeout=timeout) if timeout > 0 else q.get_nowait())
+            while len(items) < max_batch:
+                items.append(q.get_nowait())
+        except queue.Empty:
+            pass
+        return [item for item in items if item is not None]
+
+    @staticmethod
+    def record_queue_depths(msg_q, executor, deferred) -> None:
+        """sets the queue depth gauges of the handler"""
+        metrics = Metrics.Metrics
+        if not metrics.enabled:
+            return
+        try:
+            metrics.set_gauge('snpm_msg_queue_depth', msg_q.qsize())
+        except NotImplementedError:
+            pass  # qsize isn't available on macos
+        metrics.set_gauge('snpm_tasks_pending', len(executor.pending))
+        metrics.set_gauge('snpm_tasks_running', sum(len(group) for group in executor.running.values()))
+        metrics.set_gauge('snpm_tasks_parked', len(deferred))
+
+    @staticmethod
+    def parse_msg(data):
+        """the single protobuf parse of a message forwarded by the listener
+
+        Returns:
+            msg: SkaiEventMsg. None for other message types
+        """
+        msg_type, msg = SkaiMsg.unpack(data)
+        if msg_type != SkaiMsg.MsgType.SKAI_EVENT:
+            SnippetManager.logger.debug(f'skipping msg type {msg_type}')
+            return None
+        return msg
+
+    @staticmethod
+    def parse_event_pairs(text, value_type=int) -> dict:
+        """parses 'type=value,type=value' command line pairs into an event type dict"""
+        pairs = {}
+        for pair in filter(None, text.split(',')):
+            event_type, value = pair.split('=')
+            pairs[int(event_type)] = value_type(value)
+        return pairs
+
+    @staticmethod
+    def get_shard_path(path, shard_index, shard_count) -> str:
+        """per shard variant of a log / state file path so shards sharing /skailogs don't clobber each other"""
+        if not path or shard_count <= 1:
+            return path
+        path = Path(path)
+        return str(path.with_name(f'{path.stem}_shard{shard_index}{path.suffix}'))
+
+    @staticmethod
+    def split_msg_by_shard(msg, ring, default_shard) -> dict:
+        """splits the camera time ranges of a SkaiEventMsg by the shard owning each camera
+
+        Args:
+            msg: SkaiEventMsg
+            ring (ShardRing): camera mac to shard
+            default_shard (int): shard of ranges without a camera id (and of messages without ranges)
+
+        Returns:
+            msgs (dict): shard -> SkaiEventMsg with just that shard's ranges. msg itself if it's all one shard's
+        """
+        ctrs_per_shard = {}
+        for ctr in msg.camera_time_ranges:
+            shard = default_shard
+            if ctr.camera_id is not None:
+                shard = ring.get_shard(SkaiMsg.convert_camera_id_to_mac_addr_string(ctr.camera_id))
+            ctrs_per_shard.setdefault(shard, []).append(ctr)
+        if len(ctrs_per_shard) <= 1:
+            return {next(iter(ctrs_per_shard), default_shard): msg}
+
+        msgs = {}
+        for shard, ctrs in ctrs_per_shard.items():
+            shard_msg = SkaiEventMsg.new_msg()
+            shard_msg.CopyFrom(msg)
+            del shard_msg.camera_time_ranges[:]
+            for ctr in ctrs:
+                shard_msg.camera_time_ranges.add().CopyFrom(ctr)
+            msgs[shard] = shard_msg
+        return msgs
+
+    @staticmethod
+    def get_msg_record(msg) -> dict:
+        """fields identifying a SkaiEventMsg in the dropped record"""
+        return {
+            'event_type': msg.event,
+            'event_start_time': snpg.convert_protobuf_ts_to_utc_datetime(msg.event_starttime).isoformat(),
+            'primary_global_id': msg.primary_obj.global_id,
+            'cameras': [SkaiMsg.convert_camera_id_to_mac_addr_string(ctr.camera_id).upper()
+                        for ctr in msg.camera_time_ranges],
+        }
+
+    @staticmethod
+    def create_tasks(msg, config) -> list:
+        """converts SkaiEventMsg to a SnippetGenerator.Task per camera time range with a camera folder
+
+        Args:
+            msg: SkaiEventMsg
+            config (SnippetManager.Config): snippet manager settings
+
+        Returns:
+            tasks (list): SnippetGenerator.Task list
+        """
         ten_sec = timedelta(seconds=10)
         five_sec = timedelta(seconds=10)
         logger = SnippetManager.logger
         error_logger = SnippetManager.error_logger
-        while not stop_event.is_set():
+
+        # continue if no camera time ranges in msg
+        if len(msg.camera_time_ranges) == 0:
+            printmsg = f'got msg type {msg.event} with cam time ranges list empty! not processing...'
+            logger.debug(printmsg)
+            error_logger.debug(printmsg)
+            return []
+
+        # output folder naming (event primary_obj.global_id event_starttime event_endtime)
+        event_start_time_dt = snpg.convert_protobuf_ts_to_utc_datetime(msg.event_starttime)
+        event_end_time_dt = snpg.convert_protobuf_ts_to_utc_datetime(msg.event_starttime)
+        date_str = event_start_time_dt.strftime('%Y-%m-%d')
+        event_start_time_str = event_start_time_dt.strftime('%H-%M-%S')
+        event_end_time_str = event_end_time_dt.strftime('%H-%M-%S')
+        output_folder = f"/snippets/{date_str}/E{msg.event}/ID{msg.primary_obj.global_id}/T{event_start_time_str}_T{event_end_time_str}_UTC"
+
+        # create output folder exist ok
+        Path(output_folder).mkdir(parents=True, exist_ok=True)
+
+        # input folder path based on day from event_start_time_dt (UTC time)
+        day_folder = event_start_time_dt.strftime(SnippetManager.camfolder_day_format)
+        cam_folder_path = f'/skaivideos/{day_folder}'
+
+        # each task is SnippetGenerator.Task(cam_folder, start_time, end_time, output_file, TimeRangeBBoxes)
+        tasks = []
+        camera_mac_strings = []
+        for ctr in msg.camera_time_ranges:
+            if ctr.camera_id is None:
+                printmsg = f'got missing camera id!'
+                logger.exception(printmsg)
+                error_logger.exception(printmsg)
+                continue
+            mac_hex_str = SkaiMsg.convert_camera_id_to_mac_addr_string(ctr.camera_id).upper()
+            mac_hex_str_no_colon = mac_hex_str.replace(':', '')
+            camera_mac_strings.append(mac_hex_str)
+
+            # convert ctr times to utc datetime objects
+            start_time_dt = snpg.convert_protobuf_ts_to_utc_datetime(ctr.start_timestamp)
+            end_time_dt = snpg.convert_protobuf_ts_to_utc_datetime(ctr.end_timestamp)
+
+            # TODO: compare bbox timestamps to see if they're in range?
+
+            # check if duration is < 10 sec. if so move the start time back 5 sec
+            duration = (end_time_dt - start_time_dt)
+            if duration < ten_sec:
+                start_time_dt = start_time_dt - five_sec
+
+            # form strings for output file
+            date_str = start_time_dt.strftime('%Y-%m-%d')
+            start_time_str = start_time_dt.strftime('%H-%M-%S')
+            end_time_str = end_time_dt.strftime('%H-%M-%S')
+
+            cam_folder = f"{cam_folder_path}/{mac_hex_str_no_colon}"
+            if Path(cam_folder).is_dir():
+                output_file = f"{output_folder}/{mac_hex_str_no_colon}_{date_str}_T{start_time_str}_T{end_time_str}_UTC.mp4"
+                # boxes are converted from protobuf once here. workers get the compact columnar copy
+                boxes = snpg.create_box_store(ctr.tr_boxes)
+                tasks.append(
+                    snpg.Task(cam_folder, start_time_dt, end_time_dt, output_file, boxes,
+                              mode=config.snippet_mode, reencode_head=config.reencode_head,
+                              write_plain=config.write_plain, live_tail=config.live_tail,
+                              interpolation=config.interpolation, tracking_scale=config.tracking_scale,
+                              event_type=msg.event, priority=config.event_priorities.get(msg.event, 0)))
+            else:
+                error_logger.exception(
+                    f'Not able to find folder {cam_folder}!!! not generating snippet for that cam')
+
+        tasks = SnippetManager.drop_unrecorded_tasks(tasks)
+
+        logger.info(
+            f'got msg event: {msg.event} for cameras {camera_mac_strings} from {event_start_time_dt} to {event_end_time_dt}'
+        )
+        logger.info(f'tasks: {len(tasks)}')
+        return tasks
+
+    @staticmethod
+    def drop_unrecorded_tasks(tasks) -> list:
+        """drops tasks starting before the first recorded segment of their camera (rotated out or never recorded)
+
+        the ranges of each camera are looked up in one query on the camera segment index the handler keeps
+        """
+        tasks_per_folder = {}
+        for task in tasks:
+            tasks_per_folder.setdefault(task.cam_folder, []).append(task)
+        recorded = []
+        for cam_folder, folder_tasks in tasks_per_folder.items():
+            try:
+                relevant_tds_list = snpg.get_relevant_times_and_durations_for_ranges(
+                    cam_folder, [(t.start_time, t.end_time) for t in folder_tasks])
+            except Exception as e:
+                # e.g. no segments yet. the worker decides once the task runs
+                SnippetManager.logger.debug(f'not checking {cam_folder} recordings: {e!r}')
+                recorded.extend(folder_tasks)
+                continue
+            for task, relevant_tds in zip(folder_tasks, relevant_tds_list):
+                if len(relevant_tds) > 0 and task.start_time < relevant_tds[0][0]:
+                    printmsg = f'{task} starts at {task.start_time} before the recordings in {cam_folder} ' \
+                               f'(first at {relevant_tds[0][0]}). not generating snippet for that cam'
+                    SnippetManager.logger.error(printmsg)
+                    SnippetManager.error_logger.error(printmsg)
+                    continue
+                recorded.append(task)
+        return recorded
+
+    @staticmethod
+    def handle_em_msgs(stop_event, print_q, msg_q, config):
+        logger = SnippetManager.logger
+        error_logger = SnippetManager.error_logger
+        metrics = Metrics.Metrics
+        metrics.enabled = config.metrics
+        metrics_server = None
+        if config.metrics and config.metrics_port > 0:
+            try:
+                metrics_server = metrics.start_http_server(config.metrics_port)
+            except OSError as e:
+                printmsg = f'could not serve metrics on port {config.metrics_port}: {e}'
+                logger.error(printmsg)
+                error_logger.error(printmsg)
+
+        # produced snippets are cataloged and the oldest deleted past the retention quotas
+        retention = None
+        if config.retention_catalog:
+            day_sec = 24 * 3600
+            retention = SnippetRetention.SnippetRetention(
+                '/snippets', config.retention_catalog, max_bytes=int(config.retention_max_gb * 2**30),
+                max_age_sec=config.retention_max_age_days * day_sec,
+                event_max_bytes={k: int(v * 2**30) for k, v in config.event_retention_gb.items()},
+                event_max_age_sec={k: v * day_sec for k, v in config.event_retention_days.items()})
+            retention.start()
+
+        # ranges of cameras owned by other shards are forwarded to them
+        ring = ShardRing.ShardRing(config.shard_count) if config.shard_count > 1 else None
+        shard_senders = {}  # shard -> TcpSender. sends from this process, so the handler starts no sender processes
+
+        def forward(shard, msg):
+            # a shard that can't be reached only loses its own ranges. they're recorded for backfill
+            try:
+                sender = shard_senders.get(shard)
+                if sender is None:
+                    sender = shard_senders[shard] = TcpSender(config.shard_host, config.shard_base_port + shard,
+                                                              verbose=False)
+                sender.send(SkaiEventMsg.pack(msg))
+            except Exception as e:
+                shard_senders.pop(shard, None)  # reconnect on the next message
+                printmsg = f'could not forward msg event {msg.event} to shard {shard}: {e!r}'
+                logger.error(printmsg)
+                error_logger.error(printmsg)
+                metrics.inc('snpm_forwarded_total', shard=shard, result='error')
+                AdmissionControl.AdmissionControl.record(config.dropped_file or None, 'forward_error', shard=shard,
+                                                         **SnippetManager.get_msg_record(msg))
+                return
+            metrics.inc('snpm_forwarded_total', shard=shard, result='ok')
+
+        # received events and task states are recorded so a restart picks up where this run stopped
+        job_store = None
+        if config.job_store_path:
+            try:
+                job_store = JobStore.JobStore(config.job_store_path)
+            except Exception as e:
+                printmsg = f'could not open job store {config.job_store_path}: {e!r}. queued events are lost on restart'
+                logger.error(printmsg)
+                error_logger.error(printmsg)
+
+        # finished tasks wake the handler through msg_q
+        executor = TaskExecutor.TaskExecutor(max_workers=config.workers, per_camera_limit=config.per_camera_workers,
+                                             on_done=lambda: SnippetManager.wake(msg_q),
+                                             coalesce_grace_sec=config.coalesce_grace_sec,
+                                             long_snippet_sec=config.long_snippet_sec,
+                                             long_lane_workers=config.long_lane_workers,
+                                             long_lane_reserved=config.long_lane_reserved,
+                                             cache_dir=config.snippet_cache_dir,
+                                             cache_max_bytes=int(config.snippet_cache_gb * 2**30),
+                                             on_start=(lambda group: job_store.set_state(group, 'running'))
+                                             if job_store is not None else None)
+        deferred = TaskScheduler.DeferredTaskQueue()
+        defer_margin = timedelta(seconds=config.live_tail_margin_sec if config.live_tail else config.defer_margin_sec)
+        admission = AdmissionControl.AdmissionControl(max_pending=config.max_pending_tasks,
+                                                      max_age_sec=config.max_task_age_sec, policy=config.shed_policy,
+                                                      dropped_file=config.dropped_file or None)
+
+        def schedule(tasks):
+            # stale and duplicate tasks are dropped before they take a place in the queues
+            current_dt_utc = snpg.get_current_utc_datetime()
+            admitted = admission.admit(tasks, executor.get_tasks() + deferred.get_tasks(), current_dt_utc)
+            if job_store is not None and len(admitted) < len(tasks):
+                admitted_ids = {id(t) for t in admitted}
+                job_store.set_state([t for t in tasks if id(t) not in admitted_ids], 'dropped')
+
+            # tasks ending too recently wait for recording to catch up. the rest run on the worker pool.
+            # they are started by the next executor.poll, together with the rest of the batch, so overlapping
+            # tasks of one camera share a decode
+            for t in admitted:
+                ready_at = t.end_time + defer_margin
+                if ready_at > current_dt_utc:
+                    deferred.park(t, ready_at)
+                else:
+                    executor.submit(t, dispatch=False)
+
+        def fail_unscheduled(tasks, e):
+            # recorded tasks that didn't make it into a queue would otherwise be resumed as pending on restart
+            if job_store is None:
+                return
+            queued = {id(t) for t in executor.get_tasks() + deferred.get_tasks()}
+            job_store.set_state([t for t in tasks if id(t) not in queued], 'failed', error=e, from_state='pending')
+
+        if job_store is not None:
             try:
-                if not msg_q.empty():
-                    msg = msg_q.get_nowait()
-
-                    # continue if no camera time ranges in msg
-                    if len(msg.camera_time_ranges) == 0:
-                        printmsg = f'got msg type {msg.event} with cam time ranges list empty! not processing...'
-                        logger.debug(printmsg)
-                        error_logger.debug(printmsg)
-                        continue
-
-                    # output folder naming (event primary_obj.global_id event_starttime event_endtime)
-                    event_start_time_dt = snpg.convert_protobuf_ts_to_utc_datetime(msg.event_starttime)
-                    event_end_time_dt = snpg.convert_protobuf_ts_to_utc_datetime(msg.event_starttime)
-                    date_str = event_start_time_dt.strftime('%Y-%m-%d')
-                    event_start_time_str = event_start_time_dt.strftime('%H-%M-%S')
-                    event_end_time_str = event_end_time_dt.strftime('%H-%M-%S')
-                    output_folder = f"/snippets/{date_str}/E{msg.event}/ID{msg.primary_obj.global_id}/T{event_start_time_str}_T{event_end_time_str}_UTC"
-
-                    # create output folder exist ok
-                    Path(output_folder).mkdir(parents=True, exist_ok=True)
-
-                    # input folder path based on day from event_start_time_dt (UTC time)
-                    day_folder = event_start_time_dt.strftime(SnippetManager.camfolder_day_format)
-                    cam_folder_path = f'/skaivideos/{day_folder}'
-
-                    # each task is SnippetGenerator.Task(cam_folder, start_time, end_time, output_file, TimeRangeBBoxes)
+                events, resumed_tasks = job_store.load_unfinished()
+                for event_id, data in events:
                     tasks = []
-                    camera_mac_strings = []
-                    for ctr in msg.camera_time_ranges:
-                        if ctr.camera_id is None:
-                            printmsg = f'got missing camera id!'
-                            logger.exception(printmsg)
-                            error_logger.exception(printmsg)
-                            continue
-                        mac_hex_str = SkaiMsg.convert_camera_id_to_mac_addr_string(ctr.camera_id).upper()
-                        mac_hex_str_no_colon = mac_hex_str.replace(':', '')
-                        camera_mac_strings.append(mac_hex_str)
-
-                        # convert ctr times to utc datetime objects
-                        start_time_dt = snpg.convert_protobuf_ts_to_utc_datetime(ctr.start_timestamp)
-                        end_time_dt = snpg.convert_protobuf_ts_to_utc_datetime(ctr.end_timestamp)
-                        
-                        # TODO: compare bbox timestamps to see if they're in range?
-
-                        # check if duration is < 10 sec. if so move the start time back 5 sec
-                        duration = (end_time_dt - start_time_dt)
-                        if duration < ten_sec:
-                            start_time_dt = start_time_dt - five_sec
-
-                        # check if end time N sec of current time. if so delay N sec
-                        N = 15
-                        X = 10
-                        current_dt_utc = snpg.get_current_utc_datetime()
-                        cur_minus_X = current_dt_utc - timedelta(seconds=X)
-                        if end_time_dt > cur_minus_X:
-                            logger.info(f'got msg with end time {end_time_dt} > cur_t - 3 ({cur_minus_X}). delaying {N} seconds')
-                            time.sleep(N)
-
-                        # form strings for output file
-                        date_str = start_time_dt.strftime('%Y-%m-%d')
-                        start_time_str = start_time_dt.strftime('%H-%M-%S')
-                        end_time_str = end_time_dt.strftime('%H-%M-%S')
-
-                        cam_folder = f"{cam_folder_path}/{mac_hex_str_no_colon}"
-                        if Path(cam_folder).is_dir():
-                            output_file = f"{output_folder}/{mac_hex_str_no_colon}_{date_str}_T{start_time_str}_T{end_time_str}_UTC.mp4"
-                            # tasks.append([cam_folder, start_time_dt, end_time_dt, output_file])
-                            tasks.append(
-                                snpg.Task(cam_folder, start_time_dt, end_time_dt, output_file, ctr.tr_boxes))
-                        else:
-                            error_logger.exception(
-                                f'Not able to find folder {cam_folder}!!! not generating snippet for that cam')
-
-                    logger.info(
-                        f'got msg event: {msg.event} for cameras {camera_mac_strings} from {event_start_time_dt} to {event_end_time_dt}'
-                    )
-                    logger.info(f'tasks: {len(tasks)}')
-
-                    # for cam_folder, start_time, end_time, output_file in tasks:
-                    #     logger.info(f'generating snippet for {cam_folder} {start_time} {end_time} {output_file}')
-                    #     snpg.generate_snippet_for_cam(cam_folder, start_time, end_time, output_file)
-                    #     logger.info('done')
-                    for t in tasks:
-                        logger.info(f'generating snippet for {t}')
-                        snpg.process_task(t)
-                        logger.info('done')
+                    try:
+                        tasks = SnippetManager.create_tasks(SnippetManager.parse_msg(data), config)
+                        job_store.add_tasks(event_id, tasks)
+                        schedule(tasks)
+                    except Exception as e:
+                        logger.exception(e)
+                        error_logger.exception(e)
+                        job_store.add_tasks(event_id, [])  # not retried on the next restart
+                        fail_unscheduled(tasks, e)
+                try:
+                    schedule(resumed_tasks)
+                except Exception as e:
+                    logger.exception(e)
+                    error_logger.exception(e)
+                    fail_unscheduled(resumed_tasks, e)
+                job_store.commit()
+            except Exception as e:
+                logger.exception(e)
+                error_logger.exception(e)
+
+        while not stop_event.is_set():
+            try:
+                with metrics.timer('snpm_handler_seconds', buckets=metrics.fast_seconds_buckets, phase='poll'):
+                    # collect finished tasks and start waiting ones
+                    finished = executor.poll()
+                    if job_store is not None:
+                        for task, exception in finished:
+                            job_store.set_state([task], 'done' if exception is None else 'failed', error=exception)
+                    if retention is not None:
+                        for task, exception in finished:
+                            if exception is None:
+                                retention.add(task)
+
+                    # release parked tasks whose footage should be recorded by now
+                    current_dt_utc = snpg.get_current_utc_datetime()
+                    for t in deferred.pop_ready(current_dt_utc):
+                        executor.submit(t, dispatch=False)
+
+                    # bound the backlog of tasks waiting for a worker
+                    dropped = admission.shed(executor.pending, executor.get_camera, current_dt_utc)
+                    if job_store is not None and len(dropped) > 0:
+                        job_store.set_state(dropped, 'dropped')
+
+                    # one pass over everything queued since the last one, so released tasks coalesce too
+                    executor.dispatch()
+
+                # block until a message, a finished task, the next parked task coming due or stop
+                timeout = config.idle_timeout_sec
+                next_ready_at = deferred.next_ready_at()
+                if next_ready_at is not None:
+                    timeout = min(timeout, max((next_ready_at - current_dt_utc).total_seconds(), 0))
+                msgs = SnippetManager.get_batch(msg_q, timeout, config.msg_batch_size)
+                SnippetManager.record_queue_depths(msg_q, executor, deferred)
             except Exception as e:
                 logger.exception(e)
                 error_logger.exception(e)
+                continue
+
+            for data in msgs:
+                event_id = None
+                tasks = []
+                try:
+                    with metrics.timer('snpm_handler_seconds', buckets=metrics.fast_seconds_buckets, phase='msg'):
+                        msg = SnippetManager.parse_msg(data)
+                        if msg is None:
+                            continue
+                        metrics.inc('snpm_msgs_total')
+                        if ring is not None:
+                            shard_msgs = SnippetManager.split_msg_by_shard(msg, ring, config.shard_index)
+                            for shard, shard_msg in shard_msgs.items():
+                                if shard != config.shard_index:
+                                    forward(shard, shard_msg)
+                            if config.shard_index not in shard_msgs:
+                                continue
+                            if len(shard_msgs) > 1:
+                                msg = shard_msgs[config.shard_index]
+                                data = SkaiEventMsg.pack(msg)
+                        if job_store is not None:
+                            event_id = job_store.add_event(data)
+                        tasks = SnippetManager.create_tasks(msg, config)
+                        if job_store is not None:
+                            job_store.add_tasks(event_id, tasks)
+                        schedule(tasks)
+                    logger.info(f'tasks waiting or running: {len(executor)}, parked: {len(deferred)}')
+                except Exception as e:
+                    logger.exception(e)
+                    error_logger.exception(e)
+                    metrics.inc('snpm_msg_failures_total', reason=type(e).__name__)
+                    if event_id is not None:
+                        job_store.add_tasks(event_id, [])  # not retried on restart
+                        fail_unscheduled(tasks, e)
+
+            # one durable write per batch of messages / finished tasks
+            if job_store is not None:
+                try:
+                    job_store.commit()
+                except Exception as e:
+                    logger.exception(e)
+                    error_logger.exception(e)
+        executor.shutdown(wait=False)
+        if job_store is not None:
+            job_store.close()
+        if retention is not None:
+            retention.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
 
     def multiport_callback(self, data, server_address):
+        # raw message bytes go to the handler as is. it does the only protobuf parse (see parse_msg)
         try:
-            msg_type, msg = SkaiMsg.unpack(data)
-            if msg_type == SkaiMsg.MsgType.SKAI_EVENT:
-                self.msg_q.put_nowait(msg)
-        except Exception as e:
-            logger.exception(e)
+            self.msg_q.put_nowait(data)
+        except queue.Full:
+            try:
+                msg = SnippetManager.parse_msg(data)
+                if msg is None:
+                    return
+                printmsg = f'msg_q full ({self.config.msg_queue_size} msgs). dropping msg event {msg.event}'
+                self.logger.error(printmsg)
+                self.error_logger.error(printmsg)
+                AdmissionControl.AdmissionControl.record(self.config.dropped_file or None, 'queue_full',
+                                                         **SnippetManager.get_msg_record(msg))
+            except Exception as e:
+                logger.exception(e)
 
 
 if __name__ == '__main__':
     #### argparse config ####
     parser = argparse.ArgumentParser()
-    # parser.add_argument()
+    parser.add_argument('--snippet-mode', help='reencode: exact frame cut (slow). copy: keyframe aligned packet copy (fast). '
+                        'fused: single decode writing plain and bbox snippets',
+                        choices=snpg.snippet_modes, default='reencode')
+    parser.add_argument('--reencode-head', help='copy mode only. re-encode the partial GOP so snippet starts on exact frame',
+                        action='store_true')
+    parser.add_argument('--boxes-only', help='fused mode only. write just the bbox snippet when there are boxes',
+                        action='store_true')
+    parser.add_argument('--workers', help='task worker processes (default 0 = host cpu count)', type=int, default=0)
+    parser.add_argument('--per-camera-workers', help='max tasks running at once per camera (default 1)',
+                        type=int, default=1)
+    parser.add_argument('--defer-margin', help='seconds after a snippet end time before it is generated (default 10)',
+                        type=float, default=10)
+    parser.add_argument('--coalesce-grace', help='fused mode only. merge waiting tasks of a camera whose ranges overlap '
+                        'or are less than this many seconds apart into one decode (default -1 = off)',
+                        type=float, default=-1)
+    parser.add_argument('--live-tail', help='generate snippets ending in the segment still being recorded as soon as '
+                        'their frames land (needs fragmented mp4 recording)', action='store_true')
+    parser.add_argument('--interpolation', help='how boxes move between box updates. linear / spline: precomputed '
+                        'per frame (fast). tracker: opencv tracker per object (slow)',
+                        choices=BBoxInterpolator.BBoxInterpolator.methods, default='linear')
+    parser.add_argument('--tracking-scale', help='tracker interpolation only. frame scale trackers run at, boxes are '
+                        'scaled back for drawing (default 0 = long side down to '
+                        f'{BBoxAnnotator.BBoxAnnotator.tracking_max_side} pixels)', type=float, default=0.0)
+    parser.add_argument('--metrics-port', help='local http port serving prometheus metrics (default 9201, 0 = off). '
+                        'shard i serves on this + i',
+                        type=int, default=9201)
+    parser.add_argument('--no-metrics', help='turn off metrics timers and counters', action='store_true')
+    parser.add_argument('--event-priorities', help='task priority per event type as type=priority pairs, e.g. 3=10,5=-1. '
+                        'higher runs first (default 0 for every type)', default='')
+    parser.add_argument('--long-snippet-sec', help='snippets at least this long wait in a separate lane (default 120)',
+                        type=float, default=120)
+    parser.add_argument('--long-lane-workers', help='max long snippet jobs running at once '
+                        '(default 0 = half the workers, at least 1)', type=int, default=0)
+    parser.add_argument('--long-lane-reserved', help='workers long snippet jobs get before short ones when both are '
+                        'waiting, so long snippets aren\'t starved (default 1, 0 = short first)', type=int, default=1)
+    parser.add_argument('--msg-queue-size', help='max messages waiting to be handled. more are dropped (default 10000)',
+                        type=int, default=10000)
+    parser.add_argument('--max-pending-tasks', help='max tasks waiting for a worker. more are shed by --shed-policy '
+                        '(default 1000, 0 = unbounded)', type=int, default=1000)
+    parser.add_argument('--max-task-age', help='drop tasks ending longer ago than this many seconds '
+                        '(default 3600, 0 = off)', type=float, default=3600)
+    parser.add_argument('--shed-policy', help='comma separated ranking of the tasks dropped first past '
+                        f'--max-pending-tasks, from {",".join(AdmissionControl.AdmissionControl.policies)} '
+                        '(default boxless,priority,oldest)', default='boxless,priority,oldest')
+    parser.add_argument('--dropped-file', help="json lines record of dropped tasks / messages for backfill "
+                        "(default /skailogs/snpm_dropped.jsonl, '' = off)", default='/skailogs/snpm_dropped.jsonl')
+    parser.add_argument('--shard-index', help='this instance\'s shard when running several snippet managers '
+                        '(default 0). shard i listens on --shard-base-port + i', type=int, default=0)
+    parser.add_argument('--shard-count', help='snippet manager instances splitting the cameras by mac (default 1 = '
+                        'no sharding). messages are forwarded to the shard owning each camera', type=int, default=1)
+    parser.add_argument('--shard-base-port', help='port of shard 0 (default 7201)', type=int, default=7201)
+    parser.add_argument('--shard-host', help='host the other shards listen on (default 127.0.0.1)',
+                        default='127.0.0.1')
+    parser.add_argument('--snippet-cache', help="folder caching produced snippets so identical tasks are served by "
+                        "hardlink, e.g. /snippets/.cache (default '' = off)", default='')
+    parser.add_argument('--snippet-cache-gb', help='max size of the snippet cache (default 10)', type=float, default=10)
+    parser.add_argument('--retention-catalog', help="sqlite catalog of produced snippets used to delete the oldest "
+                        "past the retention quotas (default /snippets/.catalog.db, '' = off)",
+                        default='/snippets/.catalog.db')
+    parser.add_argument('--retention-max-gb', help='max total size of produced snippets (default 0 = unbounded)',
+                        type=float, default=0)
+    parser.add_argument('--retention-max-age-days', help='delete produced snippets older than this '
+                        '(default 0 = keep forever)', type=float, default=0)
+    parser.add_argument('--event-retention-gb', help='max total size of the snippets of an event type as type=gb '
+                        'pairs, e.g. 3=50,5=10', default='')
+    parser.add_argument('--event-retention-days', help='max age of the snippets of an event type as type=days '
+                        'pairs, e.g. 3=90,5=7. overrides --retention-max-age-days', default='')
+    parser.add_argument('--job-store', help='sqlite file recording received events and task states so they are '
+                        "resumed after a restart (default /skailogs/snpm_jobs.db, '' = off)",
+                        default='/skailogs/snpm_jobs.db')
     args = parser.parse_args()
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error(f'--shard-index must be in 0 to {args.shard_count - 1}')
+    # shards share /skailogs and the host network, so each gets its own files and metrics port
+    shard_path = lambda path: SnippetManager.get_shard_path(path, args.shard_index, args.shard_count)
+    config = SnippetManager.Config(snippet_mode=args.snippet_mode, reencode_head=args.reencode_head,
+                                   write_plain=not args.boxes_only, workers=args.workers,
+                                   per_camera_workers=args.per_camera_workers, defer_margin_sec=args.defer_margin,
+                                   coalesce_grace_sec=args.coalesce_grace, live_tail=args.live_tail,
+                                   interpolation=args.interpolation, tracking_scale=args.tracking_scale,
+                                   metrics=not args.no_metrics,
+                                   metrics_port=args.metrics_port + args.shard_index if args.metrics_port > 0 else 0,
+                                   job_store_path=shard_path(args.job_store),
+                                   event_priorities=SnippetManager.parse_event_pairs(args.event_priorities),
+                                   long_snippet_sec=args.long_snippet_sec, long_lane_workers=args.long_lane_workers,
+                                   long_lane_reserved=args.long_lane_reserved,
+                                   msg_queue_size=args.msg_queue_size, max_pending_tasks=args.max_pending_tasks,
+                                   max_task_age_sec=args.max_task_age, shed_policy=tuple(args.shed_policy.split(',')),
+                                   dropped_file=shard_path(args.dropped_file), shard_index=args.shard_index,
+                                   shard_count=args.shard_count, shard_base_port=args.shard_base_port,
+                                   shard_host=args.shard_host, snippet_cache_dir=args.snippet_cache,
+                                   snippet_cache_gb=args.snippet_cache_gb, retention_catalog=args.retention_catalog,
+                                   retention_max_gb=args.retention_max_gb,
+                                   retention_max_age_days=args.retention_max_age_days,
+                                   event_retention_gb=SnippetManager.parse_event_pairs(args.event_retention_gb, float),
+                                   event_retention_days=SnippetManager.parse_event_pairs(args.event_retention_days, float))
 
     #### logger config ####
     # lowest_log_level = logging.INFO
@@ -177,15 +690,28 @@ if __name__ == '__main__':
     sg_error_logger = logging.getLogger(f'{SnippetGenerator.__name__}_errors')
     sg_error_logger.setLevel(lowest_log_level)
 
+    # loggers of helper modules used by the snippet generator
+    helper_loggers = []
+    helper_error_loggers = []
+    for helper_module in (StreamCopy, SegmentIndex, MediaProbe, BBoxAnnotator, BBoxInterpolator, BoxStore,
+                          TaskExecutor, TaskScheduler, Metrics, JobStore, AdmissionControl, ShardRing,
+                          SnippetCache, SnippetRetention):
+        helper_logger = logging.getLogger(helper_module.__name__)
+        helper_logger.setLevel(lowest_log_level)
+        helper_loggers.append(helper_logger)
+        helper_error_logger = logging.getLogger(f'{helper_module.__name__}_errors')
+        helper_error_logger.setLevel(lowest_log_level)
+        helper_error_loggers.append(helper_error_logger)
+
     # setup same format and file handler for both main and SnippetManager loggers
     log_format = logging.Formatter('%(asctime)s [%(levelname)8s] %(message)s')
 
     # file logging config
-    fh = logging.FileHandler('/skailogs/snpm.log', mode='w')
+    fh = logging.FileHandler(shard_path('/skailogs/snpm.log'), mode='w')
     fh.setLevel(logging.DEBUG)
     fh.setFormatter(log_format)
 
-    error_fh = logging.FileHandler('/skailogs/snpm_errors.log', mode='w')
+    error_fh = logging.FileHandler(shard_path('/skailogs/snpm_errors.log'), mode='w')
     error_fh.setLevel(logging.DEBUG)
     error_fh.setFormatter(log_format)
 
@@ -203,6 +729,12 @@ if __name__ == '__main__':
     sg_logger.addHandler(ch)
     sg_error_logger.addHandler(error_fh)
     sg_error_logger.addHandler(ch)
+    for helper_logger in helper_loggers:
+        helper_logger.addHandler(fh)
+        helper_logger.addHandler(ch)
+    for helper_error_logger in helper_error_loggers:
+        helper_error_logger.addHandler(error_fh)
+        helper_error_logger.addHandler(ch)
 
     # init messages
     logger.info('==== Snippet Manager Logger Started ====')
@@ -211,15 +743,14 @@ if __name__ == '__main__':
 
     #### Snippet Manager setup ####
     print_q = mp.Queue()
-    snp_mgr = SnippetManager(print_q)
+    snp_mgr = SnippetManager(print_q, config)
     logger.info('Snippet Manager started!')
 
     #### stay active until ctrl+c input ####
     try:
         while True:
-            if not print_q.empty():
-                logger.info(print_q.get_nowait())
-            time.sleep(0.0000001)
+            for printmsg in SnippetManager.get_batch(print_q, timeout=1.0, max_batch=100):
+                logger.info(printmsg)
     except KeyboardInterrupt:
         logger.info('snippet manager got keyboard interrupt!')
     finally:
@@ -1,27 +1,43 @@
 #!/usr/bin/python3
 import time
+import json
+import random
+import datetime
+from dataclasses import dataclass
 from pathlib import Path
 from argparse import ArgumentParser
 
+import numpy as np
+
 from skaimsginterface.skaimessages import *
 from skaimsginterface.tcp import TcpSender
 from skaimsginterface.udp import UdpSender
 
 
-def create_example_skaievent(num_cams=3):
+def create_example_skaievent(num_cams=3, num_ids=3, event_type=3, primary_global_id=42, event_age=0,
+                             video_clip_length=30, num_frames_in_clip=5, camera_mac='00:10:FA:66:42:11'):
+    """
+    Args:
+        num_cams (int): camera time ranges in the event. camera ids count up from camera_mac
+        num_ids (int): boxes per tr_boxes entry
+        event_type (int): msg.event
+        primary_global_id (int): primary object id. also names the event output folder
+        event_age (float): seconds between the event end and now
+        video_clip_length (float): seconds per camera time range
+        num_frames_in_clip (int): tr_boxes entries per camera time range
+        camera_mac (str): mac of the first camera
+    """
     msg = SkaiEventMsg.new_msg()
 
-    fake_primary_global_id = [42]
+    fake_primary_global_id = [primary_global_id]
     fake_assoc_global_id = [69]
     fake_veh_assoc_global_id = [10]
     all_ids = [*fake_primary_global_id, *fake_assoc_global_id, *fake_veh_assoc_global_id]
-    num_ids = 3
+    all_ids += [primary_global_id + 1000 + k for k in range(max(num_ids - len(all_ids), 0))]
 
     event_length = 120 # seconds
-    video_clip_length = 30 #seconds
-    num_frames_in_clip = 5
 
-    timestamp = int(time.time() * 1e9)  # integer version of double * 1e9
+    timestamp = int((time.time() - event_age) * 1e9)  # integer version of double * 1e9
     initial_event_timestamp = timestamp - int(event_length * 1e9)
 
     initial_clip_timestamp = timestamp - int(video_clip_length * 1e9)
@@ -31,8 +47,7 @@ def create_example_skaievent(num_cams=3):
     example_employee_tags = ['elite_janitor_vp', 'associate_to_the_regional_manager']
     example_customer_tags = ['vip_customer']
     example_vehicle_tags = ['1234567', 'blue sedan']
-    
-    camera_mac = '00:10:FA:66:42:11'
+
     camera_id = SkaiMsg.convert_mac_addr_to_camera_identifier_number(camera_mac)
     fake_camera_ids = list(range(num_cams))
     for cam_count in range(num_cams):
@@ -40,7 +55,7 @@ def create_example_skaievent(num_cams=3):
     example_event_confidence = 0.80
     fake_tlbr_box = [0.2, 0.2, 0.2, 0.2]
 
-    msg.event = 3 #customer greeting
+    msg.event = event_type  # 3 is customer greeting
     msg.confidence = example_event_confidence
     msg.event_starttime = initial_event_timestamp
     msg.event_endtime = timestamp
@@ -84,6 +99,108 @@ def create_example_skaievent(num_cams=3):
     return msg
 
 
+@dataclass
+class SentEvent:
+    """Class for matching a sent event to the snippets written for it"""
+    primary_global_id: int
+    num_cams: int
+    event_folder: str  # /snippets/{date}/E{event}/ID{primary_global_id}
+    sent_at: float  # time.time() when sent
+    has_boxes: bool = True  # False if no camera time range has boxes, so no bbox snippets are written
+    done_at: float = None  # mtime of the last snippet written for the event
+
+
+def get_event_folder(msg):
+    """event output folder, named the way main.SnippetManager.create_tasks names it"""
+    # same conversion as SnippetGenerator.convert_protobuf_ts_to_utc_datetime
+    event_start_time_dt = datetime.datetime.fromtimestamp(msg.event_starttime / 1e9) + datetime.timedelta(hours=5)
+    return f"/snippets/{event_start_time_dt.strftime('%Y-%m-%d')}/E{msg.event}/ID{msg.primary_obj.global_id}"
+
+
+def has_boxes(msg) -> bool:
+    return any(len(tr_box.bboxes) > 0 for ctr in msg.camera_time_ranges for tr_box in ctr.tr_boxes)
+
+
+def check_done(event) -> bool:
+    """sets event.done_at once the snippet written last exists for each of its cameras
+
+    that is the bbox snippet if the event has boxes, else the plain snippet
+    """
+    pattern = '*/*_boxes.mp4' if event.has_boxes else '*/*_UTC.mp4'
+    snippets = list(Path(event.event_folder).glob(pattern))
+    if len(snippets) < event.num_cams:
+        return False
+    event.done_at = max(p.stat().st_mtime for p in snippets)
+    return True
+
+
+def parse_int_list(s):
+    return [int(v) for v in s.split(',') if v]
+
+
+def run_load(sender, args):
+    """sends events at args.rate per second and waits for their snippets
+
+    Returns:
+        sent (list): SentEvent list
+    """
+    rng = random.Random(args.seed)
+    # unique primary ids per run so output folders of earlier runs don't match
+    id_base = (int(time.time()) % 100000) * 10000
+    cam_macs = args.cam_macs.split(',') if args.cam_macs else ['00:10:FA:66:42:11']
+
+    sent = []
+    waiting = []
+    t0 = time.time()
+    next_check = t0
+    for k in range(args.count):
+        # fixed schedule so a slow send doesn't lower the overall rate
+        delay = t0 + k / args.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        msg = create_example_skaievent(num_cams=rng.choice(args.cams), num_ids=rng.choice(args.boxes),
+                                       event_type=rng.choice(args.event_types), primary_global_id=id_base + k,
+                                       event_age=args.event_age, video_clip_length=args.clip_length,
+                                       camera_mac=rng.choice(cam_macs))
+        sender.send(SkaiEventMsg.pack(msg))
+        event = SentEvent(msg.primary_obj.global_id, len(msg.camera_time_ranges), get_event_folder(msg), time.time(),
+                          has_boxes=has_boxes(msg))
+        sent.append(event)
+        waiting.append(event)
+        if time.time() >= next_check:
+            waiting = [e for e in waiting if not check_done(e)]
+            next_check = time.time() + args.poll
+    send_sec = time.time() - t0
+    print(f'sent {len(sent)} events in {send_sec:.1f}s ({len(sent) / max(send_sec, 1e-9):.1f} events/s)')
+
+    deadline = time.time() + args.timeout
+    while len(waiting) > 0 and time.time() < deadline:
+        time.sleep(args.poll)
+        waiting = [e for e in waiting if not check_done(e)]
+    if len(waiting) > 0:
+        print(f'{len(waiting)} events had no snippets after {args.timeout}s')
+    return sent
+
+
+def report_load(sent):
+    done = [e for e in sent if e.done_at is not None]
+    report = {'sent': len(sent), 'done': len(done)}
+    if len(done) > 0:
+        latencies = np.array([e.done_at - e.sent_at for e in done])
+        elapsed = max(e.done_at for e in done) - min(e.sent_at for e in sent)
+        report.update({
+            'throughput_events_per_sec': len(done) / elapsed if elapsed > 0 else 0.0,
+            'throughput_snippets_per_sec': sum(e.num_cams for e in done) / elapsed if elapsed > 0 else 0.0,
+            'latency_p50_sec': float(np.percentile(latencies, 50)),
+            'latency_p95_sec': float(np.percentile(latencies, 95)),
+            'latency_p99_sec': float(np.percentile(latencies, 99)),
+            'latency_max_sec': float(latencies.max()),
+        })
+    for key, value in report.items():
+        print(f'{key:30s} {value:.3f}' if isinstance(value, float) else f'{key:30s} {value}')
+    return report
+
+
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('udp_or_tcp', type=str,
@@ -92,7 +209,62 @@ if __name__ == '__main__':
                         nargs='?', type=bool, const=True, default=False)
     parser.add_argument(
         '--camgroup', help='camera group number (default 0)', nargs='?', type=int, default=0)
+    parser.add_argument('--port', type=int, default=None,
+                        help='port to send to (default 7201 with --rate, else the SkaiEventMsg port of --camgroup)')
+
+    # load test options. sending a single example message if --rate isn't given
+    parser.add_argument('--rate', type=float, default=None,
+                        help='load test: events per second to send. waits for their snippets and reports latency')
+    parser.add_argument('--count', type=int, default=100, help='load test: events to send (default 100)')
+    parser.add_argument('--cams', type=parse_int_list, default=[3],
+                        help='load test: camera counts per event, picked at random per event (default 3)')
+    parser.add_argument('--boxes', type=parse_int_list, default=[3],
+                        help='load test: box counts per frame, picked at random per event (default 3)')
+    parser.add_argument('--event-types', type=parse_int_list, default=[3],
+                        help='load test: event types, picked at random per event. repeat a type to weight it '
+                             '(default 3)')
+    parser.add_argument('--cam-macs', type=str, default=None,
+                        help='load test: comma separated first camera macs picked at random per event. '
+                             'their folders must exist under /skaivideos (default 00:10:FA:66:42:11)')
+    parser.add_argument('--clip-length', type=float, default=30, help='load test: seconds per camera time range')
+    parser.add_argument('--event-age', type=float, default=30,
+                        help='load test: seconds between event end and send time. small values make the '
+                             'snippet manager wait for footage (default 30)')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='load test: seconds to wait for snippets after the last send (default 300)')
+    parser.add_argument('--poll', type=float, default=0.5, help='load test: seconds between output checks')
+    parser.add_argument('--seed', type=int, default=0, help='load test: random seed for the event mix')
+    parser.add_argument('--report', type=str, default=None, help='load test: json file to write the report to')
+    parser.add_argument('--smoke', action='store_true',
+                        help='smoke test: send one single camera event through the running snippet manager and '
+                             'exit 1 unless its snippet is written within --timeout')
     args = parser.parse_args()
+    if args.smoke:
+        # a load test of one event, so it takes the same listener / handler / worker pool path as real events
+        args.rate = args.rate or 1.0
+        args.count = 1
+        args.cams = [1]
+
+    cam_group_idx = args.camgroup
+    port = args.port
+    if port is None:
+        port = 7201 if args.rate is not None else SkaiEventMsg.ports[cam_group_idx]
+    if args.udp_or_tcp == 'udp':
+        sender = UdpSender(
+            '127.0.0.1', port, verbose=args.rate is None)
+    else:
+        sender = TcpSender(
+            '127.0.0.1', port, verbose=args.rate is None)
+
+    if args.rate is not None:
+        sent = run_load(sender, args)
+        report = report_load(sent)
+        if args.report:
+            Path(args.report).write_text(json.dumps({'args': vars(args), 'report': report}, indent=2))
+        if args.smoke and report['done'] < report['sent']:
+            print('smoke test failed: no snippet was written')
+            raise SystemExit(1)
+        raise SystemExit(0)
 
     msg = create_example_skaievent()
     # print(msg)
@@ -106,11 +278,4 @@ if __name__ == '__main__':
         p.write_text(f'{msg}')
 
     msg_bytes = SkaiEventMsg.pack(msg, verbose=True)
-    cam_group_idx = args.camgroup
-    if args.udp_or_tcp == 'udp':
-        sender = UdpSender(
-            '127.0.0.1', SkaiEventMsg.ports[cam_group_idx], verbose=True)
-    else:
-        sender = TcpSender(
-            '127.0.0.1', SkaiEventMsg.ports[cam_group_idx], verbose=True)
     sender.send(msg_bytes)
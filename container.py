@@ -26,7 +26,8 @@ class CommandManager:
     basename = cfg['name']
 
     # choices of actions you can take
-    action_choices = ('up', 'down', 'restart', 'attach', 'logs', 'status', 'push', 'init_remotes')
+    action_choices = ('up', 'down', 'restart', 'attach', 'logs', 'status', 'push', 'init_remotes',
+                      'shards_up', 'shards_down')
 
     # set service name in the docker-compose.yaml using container config name
     @staticmethod
@@ -107,6 +108,9 @@ class CommandManager:
         starting_env.append(f'MAP_SSH=~/.ssh:/root/.ssh:ro')
         starting_env.append(f'MAP_TIMEZONE=/etc/localtime:/etc/localtime:ro')
         starting_env.append(f'DEALERSHIP_CONFIG_FOLDER={dealership_config_folder}')
+        # single instance defaults. shards_up overrides these per shard
+        starting_env.append(f'SNPM_ARGS=')
+        starting_env.append(f'SHARD_SUFFIX=')
         return starting_env
 
     @classmethod
@@ -168,6 +172,14 @@ class CommandManager:
             cmdlist.append(logcmd)
         elif args.action == 'status':
             cmdlist.append(statuscmd)
+        elif args.action == 'shards_up':
+            # one project / container per shard, each handling the cameras the shard ring gives it
+            for shard_idx in range(args.shards):
+                shard_env = f'SNPM_ARGS="--shard-index {shard_idx} --shard-count {args.shards}" SHARD_SUFFIX=_shard{shard_idx}'
+                cmdlist.append(f'{shard_env} docker-compose -f {composefile} -p {projectname}_shard{shard_idx} up --detach --build')
+        elif args.action == 'shards_down':
+            for shard_idx in range(args.shards):
+                cmdlist.append(f'SHARD_SUFFIX=_shard{shard_idx} docker-compose -f {composefile} -p {projectname}_shard{shard_idx} down -t 0')
         elif args.action == 'push':
             cls.push_all_remotes()
             exit()
@@ -277,6 +289,9 @@ if __name__ == '__main__':
     parser.add_argument('action',
                         help='action to do on local track handler container',
                         choices=CommandManager.action_choices)
+    parser.add_argument('--shards',
+                        help='shards_up / shards_down only. number of snippet manager shards (default 2)',
+                        type=int, default=2)
 
     args = parser.parse_args()
     cmdlist, envlist = CommandManager.parsecommand(args)